@@ -97,6 +97,34 @@ DATABASES = {
 }
 
 
+# Cache configuration
+# The shared tier defaults to the database cache so every worker and server sees the same entries
+# without an external service, create its table with `python manage.py createcachetable`
+
+CACHES = {
+    'default': {
+        'BACKEND': env('CACHE_BACKEND', default='django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': env('CACHE_LOCATION', default='nestegg_cache'),
+        'OPTIONS': {
+            # Every write counts the table and culls it past this size, expired entries first. Keys of old
+            # cache versions are never read again, so the bound keeps them from piling up. The version
+            # counters live in the CacheVersion table and are never culled
+            'MAX_ENTRIES': env.int('CACHE_MAX_ENTRIES', default=20000),
+            'CULL_FREQUENCY': env.int('CACHE_CULL_FREQUENCY', default=4),  # cull 1/4 of the entries when full
+        },
+    }
+}
+
+# in-process tier and stampede protection in front of the shared cache
+TWO_TIER_CACHE = {
+    'LOCAL_SIZE': env.int('LOCAL_CACHE_SIZE', default=1024),  # entries kept per process
+    'LOCAL_TTL': env.int('LOCAL_CACHE_TTL', default=5),  # seconds an entry is served from the process without checking the shared tier
+    'STALE_TTL': env.int('CACHE_STALE_TTL', default=60),  # seconds an expired entry may be served while it is recomputed
+    'LOCK_TIMEOUT': env.int('CACHE_LOCK_TIMEOUT', default=30),  # seconds a worker may hold the recompute lock
+    'EARLY_REFRESH_BETA': env.float('CACHE_EARLY_REFRESH_BETA', default=1.0),  # 0 disables probabilistic early refresh
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -171,6 +199,86 @@ REST_FRAMEWORK = {
 # exchange API configuration
 EXCHANGE_API_KEY = env('EXCHANGE_API_KEY')
 
+# exchange rates are fetched as one table against this currency and cached for FX_RATES_TTL seconds
+FX_BASE_CURRENCY = env('FX_BASE_CURRENCY', default='USD')
+FX_RATES_TTL = env.int('FX_RATES_TTL', default=3600)
+# persisted daily rates up to this many days old are used before fetching from the network
+FX_HISTORY_MAX_AGE = env.int('FX_HISTORY_MAX_AGE', default=1)
+
+# market data provider, use 'investments.providers.LocalProvider' to run without network access
+MARKET_DATA_PROVIDER = env('MARKET_DATA_PROVIDER', default='investments.api.LiveProvider')
+
+# local provider configuration
+LOCAL_MARKET_DATA = {
+    'FIXTURES': env('LOCAL_MARKET_DATA_FIXTURES', default=None),  # defaults to investments/recordings/market_data.json
+    'LATENCY': env.float('LOCAL_MARKET_DATA_LATENCY', default=0),  # seconds added to every request
+    'ERROR_RATE': env.float('LOCAL_MARKET_DATA_ERROR_RATE', default=0),  # fraction of requests that fail
+    'SEED': env.int('LOCAL_MARKET_DATA_SEED', default=0),
+    'SYNTHETIC': env.bool('LOCAL_MARKET_DATA_SYNTHETIC', default=True),  # synthesise prices for unrecorded symbols
+}
+
 # add cors headers configuration
 CORS_ALLOW_ALL_ORIGINS = True  # Allow all origins in development
-CORS_ALLOW_CREDENTIALS = True  # Allow credentials in development
\ No newline at end of file
+CORS_ALLOW_CREDENTIALS = True  # Allow credentials in development
+
+# asset data fetch configuration
+ASSET_FETCH = {
+    'MAX_WORKERS': env.int('ASSET_FETCH_MAX_WORKERS', default=8),  # concurrent requests to the data provider
+    'RATE_LIMIT': env.float('ASSET_FETCH_RATE_LIMIT', default=5),  # requests per second per process
+    'BURST': env.int('ASSET_FETCH_BURST', default=10),
+    'MAX_RETRIES': env.int('ASSET_FETCH_MAX_RETRIES', default=3),
+    'BACKOFF': env.float('ASSET_FETCH_BACKOFF', default=0.5),  # seconds, doubled on each retry
+}
+
+# number of assets fetched and written per batch when refreshing prices
+ASSET_UPDATE_CHUNK_SIZE = env.int('ASSET_UPDATE_CHUNK_SIZE', default=200)
+
+# number of users valued and written per batch when recording the daily total value history
+HISTORY_UPDATE_CHUNK_SIZE = env.int('HISTORY_UPDATE_CHUNK_SIZE', default=2000)
+
+# value history chart: points per response and days of daily entries kept before folding them into rollups
+VALUE_HISTORY = {
+    'MAX_POINTS': env.int('VALUE_HISTORY_MAX_POINTS', default=366),
+    'DAILY_RETENTION_DAYS': env.int('VALUE_HISTORY_DAILY_RETENTION_DAYS', default=730),
+}
+
+# embed the dashboard widget data in the page so the charts render without a separate request
+DASHBOARD_INLINE_PAYLOAD = env.bool('DASHBOARD_INLINE_PAYLOAD', default=True)
+
+# directory where sharded batch commands write their run reports
+BATCH_REPORT_DIR = env('BATCH_REPORT_DIR', default=str(BASE_DIR / 'reports'))
+
+# market-hours-aware price refresh scheduler configuration, in seconds
+PRICE_SCHEDULER = {
+    'INTERVAL': env.int('PRICE_SCHEDULER_INTERVAL', default=60),  # pause between refresh passes
+    'OPEN_MAX_AGE': env.int('PRICE_SCHEDULER_OPEN_MAX_AGE', default=300),  # price age that triggers a refresh while open
+    'CLOSED_GRACE': env.int('PRICE_SCHEDULER_CLOSED_GRACE', default=3600),  # window after the close to fetch closing prices
+    'UNKNOWN_MAX_AGE': env.int('PRICE_SCHEDULER_UNKNOWN_MAX_AGE', default=21600),  # for assets without known market hours
+    'BATCH_LIMIT': env.int('PRICE_SCHEDULER_BATCH_LIMIT', default=1000),  # maximum assets refreshed per pass
+}
+
+# local symbol search index and upstream search cache configuration
+SYMBOL_SEARCH = {
+    'MIN_LOCAL_RESULTS': env.int('SYMBOL_SEARCH_MIN_LOCAL_RESULTS', default=5),  # local matches needed to skip the upstream API
+    'INDEX_REFRESH': env.int('SYMBOL_SEARCH_INDEX_REFRESH', default=60),  # seconds between indexing newly added assets
+    'CACHE_SIZE': env.int('SYMBOL_SEARCH_CACHE_SIZE', default=2048),  # upstream queries kept per process
+    'CACHE_TTL': env.int('SYMBOL_SEARCH_CACHE_TTL', default=3600),  # seconds
+}
+
+# cached JSON endpoint responses: seconds browsers may reuse a response and the body size from which it is gzipped
+JSON_RESPONSE_CACHE = {
+    'MAX_AGE': env.int('JSON_RESPONSE_MAX_AGE', default=30),
+    'GZIP_MIN_SIZE': env.int('JSON_RESPONSE_GZIP_MIN_SIZE', default=1024),
+}
+
+# database-backed job queue run by the run_jobs worker
+JOB_QUEUE = {
+    'BATCH_SIZE': env.int('JOB_QUEUE_BATCH_SIZE', default=50),  # jobs claimed per worker pass
+    'POLL_INTERVAL': env.float('JOB_QUEUE_POLL_INTERVAL', default=1.0),  # seconds an idle worker waits before polling again
+    'MAX_ATTEMPTS': env.int('JOB_QUEUE_MAX_ATTEMPTS', default=5),  # runs before a job is marked failed
+    'RETRY_DELAY': env.int('JOB_QUEUE_RETRY_DELAY', default=30),  # seconds before the first retry, doubled after each failure
+    'LOCK_TIMEOUT': env.int('JOB_QUEUE_LOCK_TIMEOUT', default=600),  # seconds before a running job is assumed abandoned
+}
+
+# lifetime in seconds of cached values whose keys embed the user version and price epoch
+VERSIONED_CACHE_TTL = env.int('VERSIONED_CACHE_TTL', default=86400)
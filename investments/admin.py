@@ -1,3 +1,12 @@
 from django.contrib import admin
+from .models import Job
 
 # Register your models here.
+
+
+# Failed jobs stay in the queue for inspection
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('kind', 'key', 'status', 'priority', 'attempts', 'run_after', 'created_at')
+    list_filter = ('status', 'kind')
+    search_fields = ('key', 'last_error')
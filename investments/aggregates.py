@@ -0,0 +1,85 @@
+import logging
+from collections import namedtuple
+from decimal import Decimal
+from django.db.models import Count, Sum, F, DecimalField, ExpressionWrapper, Case, When, Value, CharField
+from .constants import TIMEZONE_TO_REGION
+from .models import Portfolio, PortfolioAsset
+from . import fx
+
+# This file contains dashboard aggregates computed in the database
+# Holdings are summed per asset currency in SQL, so Python only converts one subtotal per currency
+# The widget totals are converted from these subtotals in the holdings snapshot, see snapshot.py
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+HOLDING_VALUE = ExpressionWrapper(
+    F('position') * F('asset__latest_price'),
+    output_field=DecimalField(max_digits=19, decimal_places=4)
+)
+
+PORTFOLIO_HOLDING_VALUE = ExpressionWrapper(
+    F('portfolio_assets__position') * F('portfolio_assets__asset__latest_price'),
+    output_field=DecimalField(max_digits=19, decimal_places=4)
+)
+
+CATEGORY = Case(
+    When(asset__asset_type__in=['STOCK', 'EQUITY'], then=Value('Aggressive')),
+    default=Value('Passive'),
+    output_field=CharField()
+)
+
+REGION = Case(
+    *[When(asset__timezone_full_name=tz, then=Value(region)) for tz, region in TIMEZONE_TO_REGION.items()],
+    default=Value('Other'),
+    output_field=CharField()
+)
+
+
+def get_currency_subtotals(queryset, *fields, **groups):
+    """Return rows of asset currency, the group fields and the summed holding value"""
+    return queryset.annotate(**groups)\
+        .values('asset__currency', *fields, *groups)\
+        .annotate(subtotal=Sum(HOLDING_VALUE))\
+        .order_by()
+
+
+def get_user_holdings(user):
+    return PortfolioAsset.objects.filter(portfolio__user=user)
+
+
+PortfolioSummary = namedtuple('PortfolioSummary', 'id name currency created_at updated_at asset_count portfolio_value')
+
+
+def get_portfolio_summaries(user):
+    """
+    Return one plain (id, name, currency, created_at, updated_at, asset_count, portfolio_value) tuple per portfolio
+    of the user, from a single query grouped by portfolio and asset currency. Values are in the portfolio currency.
+    """
+    rows = Portfolio.objects.filter(user=user)\
+        .values('id', 'name', 'currency', 'created_at', 'updated_at', 'portfolio_assets__asset__currency')\
+        .annotate(asset_count=Count('portfolio_assets'), subtotal=Sum(PORTFOLIO_HOLDING_VALUE))\
+        .order_by('id')
+
+    rates = {}
+    summaries = {}
+    for row in rows:
+        portfolio_id = row['id']
+        if portfolio_id not in summaries:
+            summaries[portfolio_id] = [portfolio_id, row['name'], row['currency'], row['created_at'], row['updated_at'], 0, Decimal(0)]
+        summary = summaries[portfolio_id]
+        summary[5] += row['asset_count']
+
+        currency = row['portfolio_assets__asset__currency']
+        if currency is None or row['subtotal'] is None:
+            continue  # A portfolio without holdings, or holdings without prices
+        pair = (currency, row['currency'])
+        if pair not in rates:
+            rates[pair] = fx.get_rate(*pair)
+        if rates[pair] is None:
+            logger.error(f"Skipping {currency} subtotal that could not be converted to {row['currency']}")
+            continue
+        summary[6] += Decimal(row['subtotal']) * rates[pair]
+
+    # Plain tuples with a float value keep the cached payload small
+    return [tuple(summary[:6]) + (float(summary[6]),) for summary in summaries.values()]
@@ -1,9 +1,13 @@
 import yfinance as yf
+import pandas as pd
 import logging
 import requests
+from datetime import timedelta
 from decimal import Decimal
-from typing import List, Dict
+from typing import List, Dict, Tuple
 from django.conf import settings
+from .fetcher import fetch_all
+from .providers import MarketDataProvider, get_provider
 
 # This file contains all the API-related functions
 
@@ -11,83 +15,174 @@ from django.conf import settings
 logger = logging.getLogger(__name__)
 
 
-def get_asset_data(symbols: List[str]) -> Dict[str, Dict]:
-    """Fetch data for multiple assets from YFinance in a single call"""
-    try:
-        tickers = yf.Tickers(' '.join(symbols))
-        result = {}
+def parse_asset_info(info: Dict) -> Dict:
+    """Map a YFinance info dict to the fields stored on an Asset"""
+    latest_price = info.get('currentPrice') or info.get('previousClose')
+    return {
+        'name': info.get('shortName'),
+        'long_name': info.get('longName'),
+        'latest_price': latest_price,
+        'asset_type': info.get('quoteType'),
+        'currency': info.get('currency'),
+        'timezone_full_name': info.get('timeZoneFullName'),
+        'timezone_short_name': info.get('timeZoneShortName'),
+    }
+
+
+class LiveProvider(MarketDataProvider):
+    """Market data from YFinance and exchange rates from exchangerate-api"""
+    request_delay = 2
 
-        for symbol in symbols:
+    def get_asset_data_with_failures(self, symbols):
+        try:
+            tickers = yf.Tickers(' '.join(symbols))
+        except Exception as e:
+            logger.error(f"Error preparing tickers for symbols {symbols}: {e}")
+            return {}, {symbol: str(e) for symbol in symbols}
+
+        def fetch_one(symbol):
             info = tickers.tickers[symbol].info
-            latest_price = info.get('currentPrice') or info.get('previousClose')
-            result[symbol] = {
-                'name': info.get('shortName'),
-                'long_name': info.get('longName'),
-                'latest_price': latest_price,
-                'asset_type': info.get('quoteType'),
-                'currency': info.get('currency'),
-                'timezone_full_name': info.get('timeZoneFullName'),
-                'timezone_short_name': info.get('timeZoneShortName'),
-            }
-        return result
-    
-    except Exception as e:
-        logger.error(f"Error fetching asset data for symbols {symbols}: {e}")
-        return None
-    
+            if not info:
+                raise ValueError(f"No data returned for symbol: {symbol}")
+            return parse_asset_info(info)
 
-def get_asset_price(symbol):
-    """Fetch the latest price for an asset from YFinance"""
-    try:
+        return fetch_all(symbols, fetch_one)
+
+    def get_asset_price(self, symbol):
         ticker = yf.Ticker(symbol)
         data = ticker.history(period='1d')
         latest_price = data['Close'].iloc[-1]
         return Decimal(str(latest_price))
-    
+
+    def get_price_history(self, symbols, start, end):
+        # A single multi-symbol download rather than one history request per ticker
+        data = yf.download(symbols, start=start, end=end + timedelta(days=1), auto_adjust=False,
+                           progress=False, threads=True)
+        closes = data['Close']
+        if isinstance(closes, pd.Series):
+            closes = closes.to_frame(symbols[0])
+
+        history = {}
+        for symbol in closes.columns:
+            series = closes[symbol].dropna()
+            history[symbol] = {timestamp.date(): Decimal(str(round(float(close), 4))) for timestamp, close in series.items()}
+        return history
+
+    def get_exchange_rates(self, base_currency):
+        response = requests.get(f"https://v6.exchangerate-api.com/v6/{settings.EXCHANGE_API_KEY}/latest/{base_currency}")
+        data = response.json()
+        if data['result'] != 'success':
+            raise ValueError(f"Exchange rate API returned {data['result']} for {base_currency}")
+        return {currency: Decimal(str(rate)) for currency, rate in data['conversion_rates'].items()}
+
+    def get_historical_exchange_rates(self, base_currency, day):
+        response = requests.get(f"https://v6.exchangerate-api.com/v6/{settings.EXCHANGE_API_KEY}/history/{base_currency}/{day.year}/{day.month}/{day.day}")
+        data = response.json()
+        if data['result'] != 'success':
+            raise ValueError(f"Exchange rate API returned {data['result']} for {base_currency} on {day}")
+        return {currency: Decimal(str(rate)) for currency, rate in data['conversion_rates'].items()}
+
+    def search_assets(self, query, limit=10):
+        # Use Yahoo Finance search API directly to search for assets
+        url = f"https://query2.finance.yahoo.com/v1/finance/search?q={query}&quotesCount={limit}&newsCount=0&enableFuzzyQuery=false&quotesQueryId=tss_match_phrase_query"
+        headers = {'User-Agent': 'Mozilla/5.0'}
+        response = requests.get(url, headers=headers)
+        response.raise_for_status()
+        data = response.json()
+
+        results = []
+        for quote in data.get('quotes', []):
+            results.append({
+                'symbol': quote.get('symbol'),
+                'name': quote.get('shortname') or quote.get('longname'),
+                'exchange': quote.get('exchange'),
+                'asset_type': quote.get('quoteType')
+            })
+        return results
+
+
+def get_asset_data_with_failures(symbols: List[str]) -> Tuple[Dict[str, Dict], Dict[str, str]]:
+    """
+    Fetch data for multiple assets from the market data provider concurrently.
+    Return a tuple of (data, failures) where failures maps each symbol that
+    could not be fetched to its error message.
+    """
+    try:
+        result, failures = get_provider().get_asset_data_with_failures(symbols)
+    except Exception as e:
+        logger.error(f"Error fetching asset data for symbols {symbols}: {e}")
+        return {}, {symbol: str(e) for symbol in symbols}
+
+    if failures:
+        logger.error(f"Failed to fetch asset data for {len(failures)} of {len(symbols)} symbols: {sorted(failures)}")
+    return result, failures
+
+
+def get_asset_data(symbols: List[str]) -> Dict[str, Dict]:
+    """Fetch data for multiple assets, skipping symbols that failed"""
+    result, _ = get_asset_data_with_failures(symbols)
+    return result
+
+
+def get_asset_price(symbol):
+    """Fetch the latest price for an asset"""
+    try:
+        return get_provider().get_asset_price(symbol)
+
     except Exception as e:
         logger.error(f"Error fetching latest price for {symbol}: {e}")
         return None
 
 
+def get_price_history(symbols: List[str], start, end) -> Dict[str, Dict]:
+    """Fetch the daily closes of several assets between start and end inclusive"""
+    try:
+        return get_provider().get_price_history(symbols, start, end)
+
+    except Exception as e:
+        logger.error(f"Error fetching price history for {len(symbols)} symbols from {start} to {end}: {e}")
+        return {}
+
+
+def get_exchange_rates(base_currency) -> Dict[str, Decimal]:
+    """Fetch the rates of all currencies against the base currency"""
+    try:
+        return get_provider().get_exchange_rates(base_currency)
+
+    except Exception as e:
+        logger.error(f"Error fetching exchange rates for {base_currency}: {e}")
+        return None
+
+
+def get_historical_exchange_rates(base_currency, day) -> Dict[str, Decimal]:
+    """Fetch the rates of all currencies against the base currency on a past day"""
+    try:
+        return get_provider().get_historical_exchange_rates(base_currency, day)
+
+    except Exception as e:
+        logger.error(f"Error fetching exchange rates for {base_currency} on {day}: {e}")
+        return None
+
+
 def get_exchange_rate(from_currency, to_currency):
     """Fetch the exchange rate for the two currencies"""
     try:
-        response = requests.get(f"https://v6.exchangerate-api.com/v6/{settings.EXCHANGE_API_KEY}/latest/{from_currency}")
-        data = response.json()
-        if data['result'] == 'success':
-            return Decimal(str(data['conversion_rates'][to_currency]))
+        return get_provider().get_exchange_rate(from_currency, to_currency)
 
     except Exception as e:
         logger.error(f"Error fetching exchange rate for {from_currency} to {to_currency}: {e}")
         return None
-    
+
 
 def search_assets(query: str, limit: int = 10) -> List[Dict]:
     """
     Search for assets based on the query, matching shortName, longName, and symbol.
     Support partial matches and limits the number of results for performance.
+    Errors are logged and raised, so callers can tell a failure from an empty result.
     """
     try:
-        # Use Yahoo Finance search API directly to search for assets
-        url = f"https://query2.finance.yahoo.com/v1/finance/search?q={query}&quotesCount={limit}&newsCount=0&enableFuzzyQuery=false&quotesQueryId=tss_match_phrase_query"
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        response = requests.get(url, headers=headers)
-        data = response.json()
+        return get_provider().search_assets(query, limit)
 
-        if 'quotes' in data:
-            results = []
-            for quote in data['quotes']:
-                results.append({
-                    'symbol': quote.get('symbol'),
-                    'name': quote.get('shortname') or quote.get('longname'),
-                    'exchange': quote.get('exchange'),
-                    'asset_type': quote.get('quoteType')
-                })
-            # print(results)
-            return results
-        else:
-            return []
-    
     except Exception as e:
         logger.error(f"Error searching for assets with query '{query}': {e}")
-        return []
+        raise
@@ -0,0 +1,163 @@
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connections
+from django.utils import timezone
+from . import sharding
+from . import utils
+
+# This file contains the sharded, multi-process runners behind the batch management commands
+# A command run handles one shard, splits it again across a process pool and writes a run report
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+def run_asset_shard(shard, chunk_size=None, progress=None):
+    """Update the assets of one hash shard and return its counts"""
+    updated, failed = utils.update_all_assets(chunk_size=chunk_size, progress=progress, shard=shard)
+    return {'updated': updated, 'failed': failed}
+
+
+def run_history_shard(id_range, chunk_size=None, progress=None):
+    """Record today's total value for the users of one id range and return its counts"""
+    if id_range is None:
+        return {'updated': 0, 'failed': 0}
+    updated = utils.update_all_total_value_history(chunk_size=chunk_size, progress=progress, id_range=id_range)
+    return {'updated': updated, 'failed': 0}
+
+
+def init_worker():
+    """Set Django up in a freshly started worker process"""
+    django.setup()
+
+
+class QueueProgress:
+    """A picklable progress callback that forwards a worker's progress to the parent process"""
+
+    def __init__(self, queue, index):
+        self.queue = queue
+        self.index = index
+
+    def __call__(self, *counts):
+        self.queue.put((self.index, counts))
+
+
+def relay_progress(queue, progress):
+    """Pass worker progress to the callback in the parent until the None sentinel arrives"""
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        index, counts = item
+        progress(index, *counts)
+
+
+def run_job(func, part, chunk_size, progress=None):
+    """Run one worker's part and time it, capturing any error in the result"""
+    started = time.monotonic()
+    try:
+        result = func(part, chunk_size, progress)
+        result['error'] = None
+    except Exception as e:
+        logger.error(f"Batch part {part} failed: {e}")
+        result = {'updated': 0, 'failed': 0, 'error': str(e)}
+    result['part'] = list(part) if part else None
+    result['seconds'] = round(time.monotonic() - started, 3)
+    return result
+
+
+def run_parts(func, parts, workers=1, chunk_size=None, progress=None):
+    """
+    Run func over the parts, in this process or across a pool of worker processes.
+    The optional progress callback receives the part index followed by the part's progress counts.
+    """
+    if workers < 1:
+        raise ValueError(f"At least one worker is needed, got {workers}")
+    if workers == 1 or len(parts) <= 1:
+        return [
+            run_job(func, part, chunk_size, partial(progress, index) if progress else None)
+            for index, part in enumerate(parts)
+        ]
+
+    # Forked workers must not share the parent's database connections
+    connections.close_all()
+    # Workers report progress through a managed queue that a thread in this process relays
+    manager = multiprocessing.Manager() if progress else None
+    queue = manager.Queue() if manager else None
+    relay = threading.Thread(target=relay_progress, args=(queue, progress), daemon=True) if manager else None
+    try:
+        if relay:
+            relay.start()
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            futures = [
+                executor.submit(run_job, func, part, chunk_size, QueueProgress(queue, index) if queue else None)
+                for index, part in enumerate(parts)
+            ]
+            results = [future.result() for future in futures]
+    finally:
+        if relay:
+            queue.put(None)
+            relay.join()
+        if manager:
+            manager.shutdown()
+    return results
+
+
+def update_assets(shard=(0, 1), workers=1, chunk_size=None, progress=None):
+    """Update one shard of the assets, split across the workers by symbol hash"""
+    if workers < 1:
+        raise ValueError(f"At least one worker is needed, got {workers}")
+    started_at = timezone.now()
+    parts = sharding.split_hash_shard(shard, workers)
+    results = run_parts(run_asset_shard, parts, workers, chunk_size, progress)
+    return build_report('update_assets', shard, workers, started_at, results)
+
+
+def update_total_value_history(shard=(0, 1), workers=1, chunk_size=None, progress=None):
+    """Record today's totals for one shard of the users, split across the workers by id range"""
+    if workers < 1:
+        raise ValueError(f"At least one worker is needed, got {workers}")
+    started_at = timezone.now()
+    id_range = sharding.get_id_range(get_user_model().objects.all(), shard)
+    parts = sharding.split_id_range(id_range, workers) if id_range else [None]
+    results = run_parts(run_history_shard, parts, workers, chunk_size, progress)
+    return build_report('update_total_value_history', shard, workers, started_at, results)
+
+
+def build_report(command, shard, workers, started_at, results):
+    """Summarise the worker results of one shard run"""
+    finished_at = timezone.now()
+    return {
+        'command': command,
+        'shard': f'{shard[0]}/{shard[1]}',
+        'workers': workers,
+        'started_at': started_at.isoformat(),
+        'finished_at': finished_at.isoformat(),
+        'seconds': round((finished_at - started_at).total_seconds(), 3),
+        'updated': sum(result['updated'] for result in results),
+        'failed': sum(result['failed'] for result in results),
+        'errors': [result['error'] for result in results if result['error']],
+        'parts': results,
+    }
+
+
+def write_report(report, report_dir=None):
+    """Write the run report as JSON and return its path"""
+    report_dir = report_dir or settings.BATCH_REPORT_DIR
+    os.makedirs(report_dir, exist_ok=True)
+    shard = report['shard'].replace('/', 'of')
+    stamp = report['finished_at'][:19].replace(':', '').replace('-', '')
+    path = os.path.join(report_dir, f"{report['command']}_shard{shard}_{stamp}.json")
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Wrote run report to {path}")
+    return path
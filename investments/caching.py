@@ -0,0 +1,129 @@
+import logging
+import math
+import random
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+
+# This file contains the two-tier cache used for the valuation hot paths
+# A small in-process LRU tier sits in front of the shared Django cache, misses are
+# computed by a single worker across the fleet, and entries are refreshed early
+# with a probability that rises as they approach expiry
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+LOCK_POLL_INTERVAL = 0.05  # Seconds between checks while another worker computes a value
+
+
+class LRUCache:
+    """A thread-safe least recently used cache whose entries also expire after a TTL"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def get_setting(name):
+    return settings.TWO_TIER_CACHE[name]
+
+
+_local = LRUCache(get_setting('LOCAL_SIZE'), get_setting('LOCAL_TTL'))
+
+
+def should_refresh_early(expires_at, compute_time):
+    """
+    Decide whether to recompute a fresh entry before it expires.
+    The chance grows as expiry approaches and with how long the value takes to compute,
+    so one worker usually refreshes it before the others see it expire.
+    """
+    beta = get_setting('EARLY_REFRESH_BETA')
+    if beta <= 0:
+        return False
+    return time.time() - compute_time * beta * math.log(1 - random.random()) >= expires_at
+
+
+def compute_and_store(key, compute, ttl):
+    """Compute the value and store it in both tiers with its logical expiry and compute time"""
+    started = time.monotonic()
+    value = compute()
+    compute_time = time.monotonic() - started
+    entry = (value, time.time() + ttl, compute_time)
+    # Keep stale entries around a little longer so they can be served while being recomputed
+    cache.set(key, entry, ttl + get_setting('STALE_TTL'))
+    _local.set(key, entry, min(ttl, get_setting('LOCAL_TTL')))
+    return value
+
+
+def get_or_set(key, compute, ttl):
+    """Return the cached value for key, computing it at most once across workers on a miss"""
+    entry = _local.get(key)
+    if entry is not None:
+        return entry[0]
+
+    entry = cache.get(key)
+    if entry is not None:
+        value, expires_at, compute_time = entry
+        if time.time() < expires_at and not should_refresh_early(expires_at, compute_time):
+            _local.set(key, entry, min(expires_at - time.time(), get_setting('LOCAL_TTL')))
+            return value
+
+    lock_key = f'{key}_lock'
+    lock_timeout = get_setting('LOCK_TIMEOUT')
+    if cache.add(lock_key, True, lock_timeout):
+        try:
+            return compute_and_store(key, compute, ttl)
+        finally:
+            cache.delete(lock_key)
+
+    # Another worker is computing, serve the stale value while it does
+    if entry is not None:
+        return entry[0]
+
+    deadline = time.monotonic() + lock_timeout
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[0]
+        if cache.get(lock_key) is None:
+            break
+
+    logger.warning(f"Timed out waiting for another worker to compute {key}")
+    return compute_and_store(key, compute, ttl)
+
+
+def clear_local():
+    """Drop the in-process tier"""
+    _local.clear()
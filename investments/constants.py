@@ -17,4 +17,23 @@ TIMEZONE_TO_REGION = {
     'Asia/Hong_Kong': 'Hong Kong',
     'Australia/Sydney': 'Australia',
     'Pacific/Auckland': 'New Zealand',
-}
\ No newline at end of file
+}
+
+# Regular trading hours (local open, local close) by exchange timezone, Monday to Friday
+MARKET_HOURS = {
+    'America/New_York': ('09:30', '16:00'),
+    'America/Chicago': ('08:30', '15:00'),
+    'America/Los_Angeles': ('06:30', '13:00'),
+    'America/Toronto': ('09:30', '16:00'),
+    'Europe/London': ('08:00', '16:30'),
+    'Europe/Paris': ('09:00', '17:30'),
+    'Europe/Berlin': ('09:00', '17:30'),
+    'Europe/Zurich': ('09:00', '17:30'),
+    'Asia/Tokyo': ('09:00', '15:00'),
+    'Asia/Shanghai': ('09:30', '15:00'),
+    'Asia/Hong_Kong': ('09:30', '16:00'),
+    'Asia/Singapore': ('09:00', '17:00'),
+    'Asia/Kolkata': ('09:15', '15:30'),
+    'Australia/Sydney': ('10:00', '16:00'),
+    'Pacific/Auckland': ('10:00', '16:45'),
+}
@@ -0,0 +1,120 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Tuple
+from django.conf import settings
+
+# This file contains the concurrent, rate-limited fetch engine used by the API functions
+# Every fetch in a process draws from one shared token bucket, so the rate limit caps the process's
+# total upstream traffic. Separate processes, such as --workers pools, each have their own bucket
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+# Default fetch settings, can be overridden in settings.py
+DEFAULT_MAX_WORKERS = 8  # Number of symbols fetched in parallel
+DEFAULT_RATE_LIMIT = 5  # Requests per second across all workers
+DEFAULT_BURST = 10  # Requests allowed in a single burst
+DEFAULT_MAX_RETRIES = 3  # Retries per symbol after the first attempt
+DEFAULT_BACKOFF = 0.5  # Seconds before the first retry, doubled on each retry
+
+# Connection, timeout and HTTP errors, requests' exceptions included, are worth retrying
+# Anything else, such as a symbol without data, fails the same way on every attempt
+TRANSIENT_ERRORS = (OSError,)
+
+
+class TokenBucket:
+    """A thread-safe token bucket rate limiter"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then consume it"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(rate, burst):
+    """Return the process-wide token bucket for the rate and burst, shared by every caller"""
+    with _limiters_lock:
+        if (rate, burst) not in _limiters:
+            _limiters[(rate, burst)] = TokenBucket(rate, burst)
+        return _limiters[(rate, burst)]
+
+
+def get_fetch_setting(name, default):
+    """Read a fetch engine setting from settings.ASSET_FETCH"""
+    return getattr(settings, 'ASSET_FETCH', {}).get(name, default)
+
+
+def fetch_with_retry(key, fetch_one, limiter, max_retries, backoff):
+    """Fetch a single key, retrying transient errors with exponential backoff"""
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            return fetch_one(key)
+        except TRANSIENT_ERRORS as e:
+            if attempt >= max_retries:
+                raise
+            delay = backoff * (2 ** attempt)
+            logger.warning(f"Fetch failed for {key} (attempt {attempt + 1}), retrying in {delay:.2f}s: {e}")
+            time.sleep(delay)
+            attempt += 1
+
+
+def fetch_all(keys: Iterable[str], fetch_one: Callable, max_workers=None, rate=None, burst=None,
+              max_retries=None, backoff=None) -> Tuple[Dict, Dict]:
+    """
+    Fetch every key with a bounded worker pool and the process-wide token bucket.
+    Return a tuple of (results, failures), each keyed by the input key, so a
+    failing key never drops the rest of the batch.
+    """
+    keys = list(dict.fromkeys(keys))  # Drop duplicates but keep the order
+    if not keys:
+        return {}, {}
+
+    max_workers = max_workers or get_fetch_setting('MAX_WORKERS', DEFAULT_MAX_WORKERS)
+    rate = rate if rate is not None else get_fetch_setting('RATE_LIMIT', DEFAULT_RATE_LIMIT)
+    burst = burst or get_fetch_setting('BURST', DEFAULT_BURST)
+    max_retries = max_retries if max_retries is not None else get_fetch_setting('MAX_RETRIES', DEFAULT_MAX_RETRIES)
+    backoff = backoff if backoff is not None else get_fetch_setting('BACKOFF', DEFAULT_BACKOFF)
+
+    limiter = get_limiter(rate, burst)
+    results = {}
+    failures = {}
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(keys))) as executor:
+        futures = {
+            key: executor.submit(fetch_with_retry, key, fetch_one, limiter, max_retries, backoff)
+            for key in keys
+        }
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                failures[key] = str(e)
+                logger.error(f"Giving up fetching {key}: {e}")
+
+    return results, failures
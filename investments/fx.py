@@ -0,0 +1,212 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from typing import Dict
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from .models import ExchangeRate
+from . import api
+from . import versions
+
+# This file contains the exchange rate service, which keeps the full rate matrix in memory
+# and the persisted daily rate history in an in-memory index
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+RATES_CACHE_KEY = 'fx_rates_{base}'
+RATES_LOCK_KEY = 'fx_rates_{base}_lock'
+LOCK_TIMEOUT = 30  # Seconds a fetch may hold the shared lock
+LOCK_POLL_INTERVAL = 0.1  # Seconds between checks while another worker fetches
+
+
+class RateTable:
+    """The rates of all currencies against one base currency, fetched once per refresh period"""
+
+    def __init__(self):
+        self.rates = None
+        self.expires_at = 0
+        self.lock = threading.Lock()
+
+    def is_fresh(self):
+        return self.rates is not None and time.monotonic() < self.expires_at
+
+    def store(self, rates):
+        self.rates = rates
+        self.expires_at = time.monotonic() + settings.FX_RATES_TTL
+
+    def clear(self):
+        self.rates = None
+        self.expires_at = 0
+
+
+class RateHistory:
+    """In-memory index of the persisted daily rate tables, with an entry for every day in range"""
+
+    def __init__(self):
+        self.tables = {}
+        self.first_day = None
+        self.last_day = None
+        self.expires_at = 0
+        self.lock = threading.Lock()
+
+    def is_fresh(self):
+        return time.monotonic() < self.expires_at
+
+    def load(self):
+        """Load the rate tables for the base currency, filling days without rates from the day before"""
+        tables = {}
+        rows = ExchangeRate.objects.filter(base_currency=settings.FX_BASE_CURRENCY)\
+            .order_by('date').values_list('date', 'currency', 'rate')
+        for day, currency, rate in rows.iterator():
+            tables.setdefault(day, {})[currency] = rate
+
+        first_day = min(tables) if tables else None
+        last_day = max(tables) if tables else None
+        if tables:
+            day = first_day
+            while day < last_day:
+                day += timedelta(days=1)
+                tables.setdefault(day, tables[day - timedelta(days=1)])
+
+        self.tables, self.first_day, self.last_day = tables, first_day, last_day
+        self.expires_at = time.monotonic() + settings.FX_RATES_TTL
+
+    def get_table(self, day):
+        """Return the rate table in effect on the day, or None before the first stored day"""
+        if not self.is_fresh():
+            with self.lock:
+                if not self.is_fresh():
+                    self.load()
+        if self.last_day is not None and day > self.last_day:
+            return self.tables[self.last_day]
+        return self.tables.get(day)
+
+    def clear(self):
+        self.tables = {}
+        self.first_day = None
+        self.last_day = None
+        self.expires_at = 0
+
+
+_table = RateTable()
+_history = RateHistory()
+
+
+def store_rates(day, rates, base=None):
+    """Persist a day's rate table, replacing any rates already stored for that day"""
+    base = base or settings.FX_BASE_CURRENCY
+    ExchangeRate.objects.bulk_create(
+        [ExchangeRate(date=day, base_currency=base, currency=currency, rate=rate) for currency, rate in rates.items()],
+        update_conflicts=True,
+        unique_fields=['base_currency', 'currency', 'date'],
+        update_fields=['rate'],
+    )
+    _history.clear()
+    versions.bump_price_epoch()
+
+
+def get_persisted_rates():
+    """Return the most recent persisted rate table if it is recent enough to use instead of the network"""
+    today = timezone.localdate()
+    table = _history.get_table(today)
+    if table is None or _history.last_day < today - timedelta(days=settings.FX_HISTORY_MAX_AGE):
+        return None
+    return table
+
+
+def fetch_rates_once(base):
+    """
+    Fetch the base table from the provider, letting only one worker across the
+    fleet do so at a time. Other workers wait for it to appear in the shared cache.
+    """
+    cache_key = RATES_CACHE_KEY.format(base=base)
+    lock_key = RATES_LOCK_KEY.format(base=base)
+
+    if cache.add(lock_key, True, LOCK_TIMEOUT):
+        try:
+            rates = api.get_exchange_rates(base)
+            if rates:
+                cache.set(cache_key, rates, settings.FX_RATES_TTL)
+                try:
+                    store_rates(timezone.localdate(), rates, base)
+                except Exception as e:
+                    logger.error(f"Error persisting {base} exchange rates: {e}")
+            return rates
+        finally:
+            cache.delete(lock_key)
+
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        rates = cache.get(cache_key)
+        if rates is not None:
+            return rates
+        if cache.get(lock_key) is None:
+            break
+
+    logger.warning(f"Timed out waiting for another worker to fetch {base} exchange rates")
+    return api.get_exchange_rates(base)
+
+
+def get_rates() -> Dict[str, Decimal]:
+    """Return the rate of every currency against settings.FX_BASE_CURRENCY"""
+    if _table.is_fresh():
+        return _table.rates
+
+    # Concurrent misses in this process wait for the first one to finish
+    with _table.lock:
+        if _table.is_fresh():
+            return _table.rates
+
+        base = settings.FX_BASE_CURRENCY
+        cache_key = RATES_CACHE_KEY.format(base=base)
+        rates = cache.get(cache_key)
+        if rates is None:
+            rates = get_persisted_rates()
+            if rates is not None:
+                cache.set(cache_key, rates, settings.FX_RATES_TTL)
+        if rates is None:
+            rates = fetch_rates_once(base)
+        if rates:
+            _table.store(rates)
+        return rates
+
+
+def get_rate(from_currency, to_currency):
+    """Derive the rate from one currency to another from the base table, including inverse and cross rates"""
+    if from_currency == to_currency:
+        return Decimal(1)
+
+    rates = get_rates()
+    if not rates or from_currency not in rates or to_currency not in rates:
+        logger.error(f"No exchange rate available for {from_currency} to {to_currency}")
+        return None
+    return rates[to_currency] / rates[from_currency]
+
+
+def get_historical_table(day):
+    """Return the persisted base rate table in effect on the day, or None before the first stored day"""
+    return _history.get_table(day)
+
+
+def get_historical_rate(from_currency, to_currency, day):
+    """Return the rate from one currency to another in effect on a past day, from the persisted history"""
+    if from_currency == to_currency:
+        return Decimal(1)
+
+    rates = get_historical_table(day)
+    if not rates or from_currency not in rates or to_currency not in rates:
+        logger.error(f"No exchange rate stored for {from_currency} to {to_currency} on {day}")
+        return None
+    return rates[to_currency] / rates[from_currency]
+
+
+def clear():
+    """Drop the in-process rate tables and the shared cached copy"""
+    _table.clear()
+    _history.clear()
+    cache.delete(RATES_CACHE_KEY.format(base=settings.FX_BASE_CURRENCY))
@@ -0,0 +1,221 @@
+import logging
+from datetime import timedelta
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from .models import TotalValueHistory, TotalValueRollup
+from . import versions
+
+# This file contains the bounded queries behind the value history chart
+# Recent history is read from the daily entries, older history from weekly and monthly rollups
+# that the compaction job folds the daily entries into, and every response is capped in points
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+RANGES = {
+    '1m': 31,
+    '3m': 92,
+    '6m': 183,
+    '1y': 366,
+    '5y': 1827,
+    'all': None,
+}
+RESOLUTIONS = ('auto', 'day', 'week', 'month')
+RESOLUTION_DAYS = {'day': 1, 'week': 7, 'month': 31}
+
+
+def get_setting(name):
+    return settings.VALUE_HISTORY[name]
+
+
+def get_period_start(day, resolution):
+    """Return the first day of the week (Monday) or month that contains day"""
+    if resolution == 'week':
+        return day - timedelta(days=day.weekday())
+    if resolution == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def bucket_closes(rows, resolution):
+    """Reduce day-ordered (day, timestamp, value) rows to the last (timestamp, value) of each period"""
+    closes = {}
+    for day, timestamp, value in rows:
+        closes[get_period_start(day, resolution)] = (timestamp, value)
+    return closes
+
+
+def downsample(points, threshold):
+    """
+    Reduce time-ordered (timestamp, value) points to at most threshold points with
+    largest-triangle-three-buckets, which keeps the first and last points and the visible peaks.
+    """
+    if threshold >= len(points) or threshold < 3:
+        return points
+    x = np.array([timestamp.timestamp() for timestamp, _ in points], dtype=np.float64)
+    y = np.array([float(value) for _, value in points], dtype=np.float64)
+    bucket_size = (len(points) - 2) / (threshold - 2)
+
+    selected = [0]
+    for bucket in range(threshold - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+        next_end = min(int((bucket + 2) * bucket_size) + 1, len(points))
+        average_x, average_y = x[end:next_end].mean(), y[end:next_end].mean()
+        previous = selected[-1]
+        areas = np.abs(
+            (x[previous] - average_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (average_y - y[previous])
+        )
+        selected.append(start + int(areas.argmax()))
+    selected.append(len(points) - 1)
+    return [points[index] for index in selected]
+
+
+def get_first_day(user):
+    """The earliest day with history, from the rollups once the daily entries have been compacted"""
+    rollup = TotalValueRollup.objects.filter(user=user, resolution='month')\
+        .order_by('period_start').values_list('period_start', flat=True).first()
+    if rollup:
+        return rollup
+    return TotalValueHistory.objects.filter(user=user)\
+        .order_by('day').values_list('day', flat=True).first()
+
+
+def get_last_modified(user):
+    """When the user's latest history entry was written, or None without history"""
+    return TotalValueHistory.objects.filter(user=user).aggregate(last=Max('updated_at'))['last']
+
+
+def choose_resolution(days):
+    """Pick the finest resolution that fits the range in the point budget"""
+    for resolution in ('day', 'week'):
+        if days <= get_setting('MAX_POINTS') * RESOLUTION_DAYS[resolution]:
+            return resolution
+    return 'month'
+
+
+def get_history_points(user, range_name='all', resolution='auto'):
+    """
+    Return time-ordered (timestamp, value) points for the chart, at most MAX_POINTS of them.
+    Periods still covered by daily entries are bucketed on the fly, older periods come from the rollups.
+    """
+    today = timezone.localdate()
+    days = RANGES[range_name]
+    start_day = today - timedelta(days=days) if days else get_first_day(user)
+    if start_day is None:
+        return []
+    if resolution == 'auto':
+        resolution = choose_resolution((today - start_day).days)
+
+    max_points = get_setting('MAX_POINTS')
+    retention_start = today - timedelta(days=get_setting('DAILY_RETENTION_DAYS'))
+    daily = TotalValueHistory.objects.filter(user=user, day__gte=max(start_day, retention_start))\
+        .order_by('day').values_list('day', 'timestamp', 'total_value')
+
+    if resolution == 'day':
+        return downsample([(timestamp, value) for _, timestamp, value in daily], max_points)
+
+    periods = {}
+    if start_day < retention_start:
+        rollups = TotalValueRollup.objects.filter(
+            user=user, resolution=resolution, period_start__gte=get_period_start(start_day, resolution)
+        ).order_by('-period_start').values_list('period_start', 'timestamp', 'total_value')[:max_points]
+        periods.update({period_start: (timestamp, value) for period_start, timestamp, value in rollups})
+    # The daily entries are newer than any rollup of the same period
+    periods.update(bucket_closes(daily, resolution))
+    return [periods[period_start] for period_start in sorted(periods)][-max_points:]
+
+
+def compact_history(retention_days=None, chunk_size=5000):
+    """
+    Fold the daily entries older than the retention window into weekly and monthly closing values,
+    then delete them. Returns the number of daily entries compacted.
+    """
+    retention_days = get_setting('DAILY_RETENTION_DAYS') if retention_days is None else retention_days
+    cutoff = timezone.localdate() - timedelta(days=retention_days)
+    old_entries = TotalValueHistory.objects.filter(day__lt=cutoff)
+    compacted = 0
+
+    while True:
+        # Take whole users at a time so each user's periods are folded in one pass
+        user_ids = list(old_entries.order_by('user_id').values_list('user_id', flat=True).distinct()[:chunk_size])
+        if not user_ids:
+            break
+        rows = old_entries.filter(user_id__in=user_ids).order_by('user_id', 'day')\
+            .values_list('user_id', 'day', 'timestamp', 'total_value')
+
+        closes = {}
+        for user_id, day, timestamp, value in rows.iterator():
+            for resolution in ('week', 'month'):
+                closes[(user_id, resolution, get_period_start(day, resolution))] = (timestamp, value)
+        rollups = [
+            TotalValueRollup(user_id=user_id, resolution=resolution, period_start=period_start,
+                             timestamp=timestamp, total_value=value)
+            for (user_id, resolution, period_start), (timestamp, value) in closes.items()
+        ]
+
+        with transaction.atomic():
+            TotalValueRollup.objects.bulk_create(
+                rollups,
+                update_conflicts=True,
+                unique_fields=['user', 'resolution', 'period_start'],
+                update_fields=['timestamp', 'total_value'],
+            )
+            deleted, _ = old_entries.filter(user_id__in=user_ids).delete()
+        versions.bump_user_versions(user_ids)  # Neither the upsert nor the delete sends signals
+        compacted += deleted
+        logger.info(f"Compacted {deleted} daily value history entries for {len(user_ids)} users")
+
+    return compacted
+
+
+def select_duplicates(rows):
+    """
+    Split (id, user_id, day, timestamp) rows, ordered oldest write first, into the ids of entries that a later
+    entry of the same user and day replaces, and a {id: day} dict of the kept entries that have no day yet
+    """
+    # Later rows win, so each (user, day) keeps its most recently written entry
+    keep = {}
+    duplicate_ids = []
+    for entry_id, user_id, day, timestamp in rows:
+        key = (user_id, day or timezone.localdate(timestamp))
+        if key in keep:
+            duplicate_ids.append(keep[key][0])
+        keep[key] = (entry_id, day)
+    backfill = {entry_id: day for (_, day), (entry_id, stored_day) in keep.items() if stored_day is None}
+    return duplicate_ids, backfill
+
+
+def deduplicate_history(chunk_size=1000):
+    """
+    Backfill the day of entries written before the day column existed and keep only the most
+    recently written entry per user and day. Only finds work while the column is still nullable,
+    between the two upgrade migrations. Returns the number of duplicate entries deleted.
+    """
+    undated = TotalValueHistory.objects.filter(day__isnull=True)
+    deleted = 0
+
+    while True:
+        user_ids = list(undated.order_by('user_id').values_list('user_id', flat=True).distinct()[:chunk_size])
+        if not user_ids:
+            break
+        rows = TotalValueHistory.objects.filter(user_id__in=user_ids)\
+            .order_by('user_id', 'updated_at', 'timestamp', 'id')\
+            .values_list('id', 'user_id', 'day', 'timestamp')
+        duplicate_ids, backfill = select_duplicates(rows.iterator())
+
+        with transaction.atomic():
+            for start in range(0, len(duplicate_ids), 1000):
+                TotalValueHistory.objects.filter(id__in=duplicate_ids[start:start + 1000]).delete()
+            TotalValueHistory.objects.bulk_update(
+                [TotalValueHistory(id=entry_id, day=day) for entry_id, day in backfill.items()], ['day'], batch_size=1000
+            )
+        versions.bump_user_versions(user_ids)  # Neither the delete nor the update sends signals
+        deleted += len(duplicate_ids)
+        logger.info(f"Backfilled {len(backfill)} and removed {len(duplicate_ids)} duplicate history entries for {len(user_ids)} users")
+
+    return deleted
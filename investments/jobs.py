@@ -0,0 +1,126 @@
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from .models import Job
+from . import utils
+
+# This file contains the database-backed job queue that takes slow recomputation off write requests
+# Views enqueue a job keyed by the work it does, so repeated requests collapse into one pending job,
+# and the run_jobs worker claims jobs by priority and retries failures with a growing delay
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+USER_INTERACTIVE_PRIORITY = 10  # Work a user is waiting to see, ahead of background jobs
+
+HANDLERS = {}
+
+
+def get_setting(name):
+    return settings.JOB_QUEUE[name]
+
+
+def handler(kind):
+    """Register a function as the handler of a job kind, its payload is passed as keyword arguments"""
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+@handler('update_total_value_history')
+def update_total_value_history(user_id):
+    user = get_user_model().objects.filter(id=user_id).first()
+    if user is None:
+        logger.info(f"Skipping total value update for deleted user {user_id}")
+        return
+    utils.update_total_value_history(user)
+
+
+def enqueue(kind, key, payload=None, priority=0, delay=0):
+    """
+    Queue a job unless a pending job with the same key exists, in which case that job
+    is kept and raised to the higher priority
+    """
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    job = Job(kind=kind, key=key, payload=payload or {}, priority=priority,
+              run_after=timezone.now() + timedelta(seconds=delay))
+    Job.objects.bulk_create([job], ignore_conflicts=True)
+    Job.objects.filter(key=key, status='pending', priority__lt=priority).update(priority=priority)
+
+
+def enqueue_total_value_update(user_id, priority=USER_INTERACTIVE_PRIORITY):
+    """Queue a recomputation of the user's total value for today"""
+    enqueue('update_total_value_history', f'update_total_value_history:{user_id}', {'user_id': user_id}, priority)
+
+
+def claim_jobs(limit):
+    """Mark up to limit due pending jobs as running and return them, highest priority first"""
+    now = timezone.now()
+    with transaction.atomic():
+        # Workers on databases with row locks skip each other's jobs instead of waiting
+        jobs = list(
+            Job.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', run_after__lte=now)
+            .order_by('-priority', 'run_after', 'id')[:limit]
+        )
+        Job.objects.filter(id__in=[job.id for job in jobs]).update(status='running', locked_at=now)
+    return jobs
+
+
+def retry_or_fail(job, error):
+    """Put a failed job back in the queue after a growing delay, or mark it failed once out of attempts"""
+    job.attempts += 1
+    job.last_error = error
+    job.locked_at = None
+    if job.attempts >= get_setting('MAX_ATTEMPTS'):
+        job.status = 'failed'
+        job.save()
+        logger.error(f"Job {job.id} {job.kind} failed after {job.attempts} attempts: {error}")
+        return
+
+    job.status = 'pending'
+    job.run_after = timezone.now() + timedelta(seconds=get_setting('RETRY_DELAY') * 2 ** (job.attempts - 1))
+    try:
+        with transaction.atomic():
+            job.save()
+    except IntegrityError:
+        # The same work was queued again while this job ran, the newer job will do it
+        job.delete()
+    logger.warning(f"Job {job.id} {job.kind} failed, attempt {job.attempts}: {error}")
+
+
+def requeue_stale_jobs():
+    """Retry running jobs whose worker stopped before finishing them"""
+    cutoff = timezone.now() - timedelta(seconds=get_setting('LOCK_TIMEOUT'))
+    stale = list(Job.objects.filter(status='running', locked_at__lt=cutoff))
+    for job in stale:
+        retry_or_fail(job, 'Worker stopped before the job finished')
+    return len(stale)
+
+
+def run_job(job):
+    """Run one claimed job, deleting it once it succeeds. Returns whether it succeeded."""
+    try:
+        HANDLERS[job.kind](**job.payload)
+    except Exception as e:
+        retry_or_fail(job, str(e) or e.__class__.__name__)
+        return False
+    job.delete()
+    return True
+
+
+def run_pending(batch_size=None):
+    """Claim and run one batch of due jobs and return the (succeeded, failed) counts"""
+    requeue_stale_jobs()
+    succeeded = failed = 0
+    for job in claim_jobs(batch_size or get_setting('BATCH_SIZE')):
+        if run_job(job):
+            succeeded += 1
+        else:
+            failed += 1
+    return succeeded, failed
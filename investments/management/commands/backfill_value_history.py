@@ -0,0 +1,27 @@
+from datetime import date, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from investments.prices import backfill_history
+
+
+class Command(BaseCommand):
+    help = 'Rebuild daily total value history from current holdings, stored closes and stored exchange rates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=date.fromisoformat, help='First day (YYYY-MM-DD), defaults to a year ago')
+        parser.add_argument('--end', type=date.fromisoformat, help='Last day (YYYY-MM-DD), defaults to yesterday')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Number of users valued per batch')
+        parser.add_argument('--overwrite', action='store_true', help='Replace existing history entries')
+
+    def handle(self, *args, **options):
+        end = options['end'] or timezone.localdate() - timedelta(days=1)
+        start = options['start'] or end - timedelta(days=365)
+        if start > end:
+            raise CommandError('--start must not be after --end')
+
+        def progress(processed, total, valued):
+            self.stdout.write(f'Processed {processed}/{total} users ({valued} user days valued)')
+
+        valued = backfill_history(start, end, chunk_size=options['chunk_size'], overwrite=options['overwrite'],
+                                  progress=progress)
+        self.stdout.write(self.style.SUCCESS(f'Backfilled {valued} user days from {start} to {end}'))
@@ -0,0 +1,59 @@
+import random
+import time
+from decimal import Decimal
+import numpy as np
+from django.core.management.base import BaseCommand
+from investments import money
+
+CURRENCIES = ['USD', 'NZD', 'CNY', 'HKD']
+RATES = {'USD': Decimal('1'), 'NZD': Decimal('1.6108'), 'CNY': Decimal('7.0712'), 'HKD': Decimal('7.8125')}
+
+
+class Command(BaseCommand):
+    help = 'Compares the Decimal and fixed-point valuation paths on a synthetic portfolio'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--holdings', type=int, default=10000, help='Number of synthetic holdings')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per path, the best time is reported')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        holdings = [
+            (rng.randint(1, 5000), Decimal(rng.randint(1, 500000)) / 100, rng.choice(CURRENCIES))
+            for _ in range(options['holdings'])
+        ]
+        target = 'NZD'
+        rates = {currency: RATES[target] / RATES[currency] for currency in CURRENCIES}
+
+        def decimal_path():
+            # The per-holding Decimal arithmetic the views used before
+            total = sum((price * position * rates[currency] for position, price, currency in holdings), Decimal(0))
+            return float(total)
+
+        # Valuation.load reads prices from the database already scaled to units
+        price_units = [money.to_units(price) for _, price, _ in holdings]
+        positions = [position for position, _, _ in holdings]
+        currency_rates = [float(rates[currency]) for _, _, currency in holdings]
+
+        def fixed_point_path():
+            units = np.array(positions, dtype=np.int64) * np.array(price_units, dtype=np.int64)
+            units = money.convert_units_array(units, np.array(currency_rates, dtype=np.float64))
+            return float(money.from_units(int(units.sum())))
+
+        results = {}
+        for name, path in (('Decimal', decimal_path), ('Fixed', fixed_point_path)):
+            timings = []
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                value = path()
+                timings.append(time.perf_counter() - started)
+            results[name] = (min(timings), value)
+
+        baseline = results['Decimal'][0]
+        for name, (elapsed, value) in results.items():
+            self.stdout.write(
+                f'{name:<10} {elapsed * 1000:9.3f} ms  {baseline / elapsed:6.1f}x  total {value:,.2f} {target}'
+            )
+        if abs(results['Fixed'][1] - results['Decimal'][1]) > 0.01 * len(holdings):
+            self.stdout.write(self.style.WARNING('Fixed-point total differs from the Decimal total by more than a cent per holding'))
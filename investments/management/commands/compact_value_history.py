@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from investments.history import compact_history
+
+
+class Command(BaseCommand):
+    help = 'Fold daily total value history older than the retention window into weekly and monthly rollups'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention-days', type=int, default=settings.VALUE_HISTORY['DAILY_RETENTION_DAYS'],
+                            help='Days of daily entries to keep')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Number of users compacted per batch')
+
+    def handle(self, *args, **options):
+        compacted = compact_history(retention_days=options['retention_days'], chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Compacted {compacted} daily value history entries'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from investments.history import deduplicate_history
+
+
+class Command(BaseCommand):
+    help = 'Backfill the day of existing total value history entries and remove duplicate entries per user and day'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Number of users processed per batch')
+
+    def handle(self, *args, **options):
+        deleted = deduplicate_history(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Removed {deleted} duplicate total value history entries'))
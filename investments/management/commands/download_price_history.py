@@ -0,0 +1,25 @@
+from datetime import date, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from investments.prices import download_price_history, DOWNLOAD_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Download and store daily closing prices for all assets, many symbols per request'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=date.fromisoformat, help='First day (YYYY-MM-DD), defaults to a year ago')
+        parser.add_argument('--end', type=date.fromisoformat, help='Last day (YYYY-MM-DD), defaults to today')
+        parser.add_argument('--chunk-size', type=int, default=DOWNLOAD_CHUNK_SIZE, help='Symbols per history request')
+
+    def handle(self, *args, **options):
+        end = options['end'] or timezone.localdate()
+        start = options['start'] or end - timedelta(days=365)
+        if start > end:
+            raise CommandError('--start must not be after --end')
+
+        def progress(processed, total, stored):
+            self.stdout.write(f'Processed {processed}/{total} symbols ({stored} closes stored)')
+
+        stored = download_price_history(start, end, chunk_size=options['chunk_size'], progress=progress)
+        self.stdout.write(self.style.SUCCESS(f'Stored {stored} daily closes from {start} to {end}'))
@@ -1,11 +1,12 @@
 from django.core.management.base import BaseCommand
-from investments.models import Portfolio, Asset, PortfolioAsset, TotalValueHistory
+from investments.models import Portfolio, Asset, PortfolioAsset
 from django.contrib.auth import get_user_model
-from investments.utils import create_asset, get_total_value
+from investments.utils import create_asset
+from investments.prices import download_price_history, backfill_history
+from investments.providers import get_provider
 import random
 import time
 from datetime import datetime, timedelta
-from decimal import Decimal
 from django.utils import timezone
 
 
@@ -52,36 +53,15 @@ class Command(BaseCommand):
                         position=position
                     )
             
-            time.sleep(2)  # Add a delay of 2 seconds between requests 
+            time.sleep(get_provider().request_delay)  # Add a delay between requests to live providers
 
-        # Add total value history for the test user
+        # Rebuild the last 30 days of total value history from downloaded closes
         self.stdout.write('Creating total value history...')
-        end_date = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)  # Today at midnight
+        end_date = timezone.localdate()
         start_date = end_date - timedelta(days=30)  # Start from 30 days ago
-        
-        # Get all portfolio assets for the user
-        portfolio_assets = PortfolioAsset.objects.filter(portfolio__user=user)
-        
-        # Initialise a dictionary to store the simulated prices for each asset
-        asset_prices = {pa.asset.id: pa.asset.latest_price for pa in portfolio_assets}
-        
-        for i in range(31):  # Create 31 data points (one for each day)
-            date = start_date + timedelta(days=i)
-            
-            # Simulate price changes for each asset
-            for asset_id in asset_prices:
-                # Apply a random daily change between -2% and 2%
-                daily_change = random.uniform(0.98, 1.02)
-                asset_prices[asset_id] *= Decimal(daily_change)
-            
-            # Calculate total value based on simulated prices
-            total_value = sum(pa.position * asset_prices[pa.asset.id] for pa in portfolio_assets)
-            
-            TotalValueHistory.objects.create(
-                user=user,
-                timestamp=date,
-                total_value=total_value
-            )
-            self.stdout.write(f'Created total value history for {date.date()}: {total_value}')
-        
+        stored = download_price_history(start_date, end_date)
+        self.stdout.write(f'Stored {stored} daily closes')
+        valued = backfill_history(start_date, end_date, overwrite=True)
+        self.stdout.write(f'Created {valued} days of total value history')
+
         self.stdout.write(self.style.SUCCESS(f'Successfully populated the database with fake data and updated asset prices.'))
\ No newline at end of file
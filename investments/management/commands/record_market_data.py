@@ -0,0 +1,35 @@
+import json
+from pathlib import Path
+from django.core.management.base import BaseCommand
+from investments.api import LiveProvider
+from investments.providers import DEFAULT_FIXTURES
+
+
+class Command(BaseCommand):
+    help = 'Record live asset data and exchange rates into a fixtures file for the local provider'
+
+    def add_arguments(self, parser):
+        parser.add_argument('symbols', nargs='+', help='Symbols to record')
+        parser.add_argument('--output', default=str(DEFAULT_FIXTURES), help='Fixtures file to update')
+
+    def handle(self, *args, **options):
+        output = Path(options['output'])
+        recording = {'assets': {}, 'exchange_rates': {}}
+        if output.exists():
+            with open(output) as f:
+                recording.update(json.load(f))
+
+        provider = LiveProvider()
+        data, failures = provider.get_asset_data_with_failures(options['symbols'])
+        recording['assets'].update(data)
+        recording['exchange_rates']['USD'] = {
+            currency: float(rate) for currency, rate in provider.get_exchange_rates('USD').items()
+        }
+
+        output.parent.mkdir(parents=True, exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(recording, f, indent=4)
+
+        self.stdout.write(self.style.SUCCESS(f'Recorded {len(data)} assets to {output}'))
+        if failures:
+            self.stdout.write(self.style.WARNING(f'Failed to record: {", ".join(sorted(failures))}'))
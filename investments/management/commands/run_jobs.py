@@ -0,0 +1,26 @@
+import time
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from investments import jobs
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs, such as total value updates after portfolio edits'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=settings.JOB_QUEUE['POLL_INTERVAL'],
+                            help='Seconds to wait before polling again when the queue is empty')
+        parser.add_argument('--batch-size', type=int, default=settings.JOB_QUEUE['BATCH_SIZE'],
+                            help='Number of jobs claimed per pass')
+        parser.add_argument('--once', action='store_true', help='Run until the queue has no due jobs and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            succeeded, failed = jobs.run_pending(batch_size=options['batch_size'])
+            if succeeded or failed:
+                self.stdout.write(f'Ran {succeeded} jobs, {failed} failed in {time.monotonic() - started:.1f}s')
+                continue
+            if options['once']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,27 @@
+import time
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from investments.scheduler import refresh_due_assets
+
+
+class Command(BaseCommand):
+    help = 'Continuously refresh asset prices for markets that are open or have just closed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=settings.PRICE_SCHEDULER['INTERVAL'],
+                            help='Seconds to wait between refresh passes')
+        parser.add_argument('--chunk-size', type=int, default=settings.ASSET_UPDATE_CHUNK_SIZE,
+                            help='Number of assets fetched and written per batch')
+        parser.add_argument('--once', action='store_true', help='Run a single refresh pass and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            updated_count, failed_count, skipped_count = refresh_due_assets(chunk_size=options['chunk_size'])
+            self.stdout.write(
+                f'Refreshed {updated_count} assets, {failed_count} failed, {skipped_count} skipped '
+                f'in {time.monotonic() - started:.1f}s'
+            )
+            if options['once']:
+                break
+            time.sleep(max(0, options['interval'] - (time.monotonic() - started)))
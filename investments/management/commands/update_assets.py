@@ -1,14 +1,39 @@
-from django.core.management.base import BaseCommand
-from investments.utils import update_all_assets
-from investments.models import Asset
-import time
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from investments import batch
+from investments.sharding import parse_shard
 
 
 class Command(BaseCommand):
     help = 'Updates the latest prices for all assets'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=settings.ASSET_UPDATE_CHUNK_SIZE,
+                            help='Number of assets fetched and written per batch')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of worker processes sharing this shard')
+        parser.add_argument('--shard', type=parse_shard, default=(0, 1),
+                            help='Zero-based i/n shard of the assets, partitioned by symbol hash, to update on this node')
+        parser.add_argument('--report-dir', default=settings.BATCH_REPORT_DIR,
+                            help='Directory the run report is written to')
+
     def handle(self, *args, **options):
-        updated_count, failed_count = update_all_assets()
-        self.stdout.write(self.style.SUCCESS(f'Successfully updated {updated_count} assets'))
-        if failed_count > 0:
-            self.stdout.write(self.style.WARNING(f'Failed to update {failed_count} assets'))
\ No newline at end of file
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+
+        def progress(part, processed, total, updated, failed):
+            prefix = f'Worker {part}: ' if options['workers'] > 1 else ''
+            self.stdout.write(f'{prefix}Processed {processed}/{total} assets ({updated} updated, {failed} failed)')
+
+        report = batch.update_assets(shard=options['shard'], workers=options['workers'],
+                                     chunk_size=options['chunk_size'], progress=progress)
+        path = batch.write_report(report, options['report_dir'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Successfully updated {report['updated']} assets in shard {report['shard']} in {report['seconds']}s"
+        ))
+        if report['failed'] > 0:
+            self.stdout.write(self.style.WARNING(f"Failed to update {report['failed']} assets"))
+        for error in report['errors']:
+            self.stdout.write(self.style.ERROR(f'Worker failed: {error}'))
+        self.stdout.write(f'Run report written to {path}')
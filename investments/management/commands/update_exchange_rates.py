@@ -0,0 +1,38 @@
+from datetime import date, timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from investments import api, fx
+
+
+class Command(BaseCommand):
+    help = 'Store the daily exchange rate table, optionally backfilling a range of past days'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=date.fromisoformat, help='First day to backfill (YYYY-MM-DD)')
+        parser.add_argument('--end', type=date.fromisoformat, help='Last day to backfill (YYYY-MM-DD), defaults to today')
+
+    def handle(self, *args, **options):
+        base = settings.FX_BASE_CURRENCY
+        today = timezone.localdate()
+        end = options['end'] or today
+        start = options['start'] or end
+        if start > end:
+            raise CommandError('--start must not be after --end')
+
+        stored = 0
+        day = start
+        while day <= end:
+            if day == today:
+                rates = api.get_exchange_rates(base)
+            else:
+                rates = api.get_historical_exchange_rates(base, day)
+
+            if rates:
+                fx.store_rates(day, rates, base)
+                stored += 1
+            else:
+                self.stdout.write(self.style.WARNING(f'No exchange rates available for {day}'))
+            day += timedelta(days=1)
+
+        self.stdout.write(self.style.SUCCESS(f'Stored {base} exchange rates for {stored} days'))
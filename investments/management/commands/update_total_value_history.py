@@ -1,24 +1,39 @@
-from django.core.management.base import BaseCommand
-from django.contrib.auth import get_user_model
-from django.utils import timezone
-from investments.models import TotalValueHistory
-from investments.utils import get_total_value
-
-User = get_user_model()
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from investments import batch
+from investments.sharding import parse_shard
 
 
 class Command(BaseCommand):
     help = 'Update total value history for all users'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=settings.HISTORY_UPDATE_CHUNK_SIZE,
+                            help='Number of users valued and written per batch')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of worker processes sharing this shard')
+        parser.add_argument('--shard', type=parse_shard, default=(0, 1),
+                            help='Zero-based i/n shard of the users, partitioned by id range, to update on this node')
+        parser.add_argument('--report-dir', default=settings.BATCH_REPORT_DIR,
+                            help='Directory the run report is written to')
+
     def handle(self, *args, **options):
-        today = timezone.now().date()
-        for user in User.objects.all():
-            total_value = get_total_value(user)
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+
+        def progress(part, processed, total):
+            prefix = f'Worker {part}: ' if options['workers'] > 1 else ''
+            self.stdout.write(f'{prefix}Processed {processed}/{total} users')
 
-            TotalValueHistory.objects.update_or_create(
-                user=user,
-                timestamp__date=today,
-                defaults={'total_value': total_value, 'timestamp': timezone.now()}
-            )
+        report = batch.update_total_value_history(
+            shard=options['shard'], workers=options['workers'], chunk_size=options['chunk_size'], progress=progress
+        )
+        path = batch.write_report(report, options['report_dir'])
 
-        self.stdout.write(self.style.SUCCESS('Successfully updated total value history for all users'))
\ No newline at end of file
+        self.stdout.write(self.style.SUCCESS(
+            f"Successfully updated total value history for {report['updated']} users "
+            f"in shard {report['shard']} in {report['seconds']}s"
+        ))
+        for error in report['errors']:
+            self.stdout.write(self.style.ERROR(f'Worker failed: {error}'))
+        self.stdout.write(f'Run report written to {path}')
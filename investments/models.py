@@ -47,16 +47,36 @@ class PortfolioAsset(models.Model):
         return Decimal(asset_value)
 
 
+class AssetPrice(models.Model):
+    asset = models.ForeignKey(Asset, on_delete=models.CASCADE, related_name='prices')
+    date = models.DateField()
+    close = models.DecimalField(max_digits=14, decimal_places=4)  # closing price in the asset currency
+
+    class Meta:
+        ordering = ['asset', 'date']
+        # Store one close per asset per day
+        constraints = [
+            models.UniqueConstraint(fields=['asset', 'date'], name='unique_daily_asset_price')
+        ]
+
+    def __str__(self):
+        return f"{self.asset.symbol} - {self.date} - {self.close}"
+
+
 class TotalValueHistory(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='total_value_history')
     timestamp = models.DateTimeField()
+    # Local day of the entry. Databases with entries from before this column existed add it as nullable,
+    # backfill it with dedupe_value_history and only then make it required
+    day = models.DateField()
     total_value = models.DecimalField(max_digits=15, decimal_places=2)
+    updated_at = models.DateTimeField(auto_now=True)  # Track when the value was last written, for Last-Modified
 
     class Meta:
         ordering = ['-timestamp']
         # Create an entry once per day
         constraints = [
-            models.UniqueConstraint(fields=['user', 'timestamp'], name='unique_user_daily_value')
+            models.UniqueConstraint(fields=['user', 'day'], name='unique_user_daily_value')
         ]
 
     def __str__(self):
@@ -66,4 +86,78 @@ class TotalValueHistory(models.Model):
     def save(self, *args, **kwargs):
         if not self.id and not self.timestamp:
             self.timestamp = timezone.now()
-        super().save(*args, **kwargs)
\ No newline at end of file
+        if not self.day:
+            self.day = timezone.localdate(self.timestamp)
+        super().save(*args, **kwargs)
+
+
+class TotalValueRollup(models.Model):
+    RESOLUTION_CHOICES = [('week', 'Week'), ('month', 'Month')]
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='total_value_rollups')
+    resolution = models.CharField(max_length=5, choices=RESOLUTION_CHOICES)
+    period_start = models.DateField()
+    timestamp = models.DateTimeField()  # timestamp of the last daily entry folded into the period
+    total_value = models.DecimalField(max_digits=15, decimal_places=2)  # closing value of the period
+
+    class Meta:
+        ordering = ['resolution', 'period_start']
+        # Keep one closing value per user per period
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'resolution', 'period_start'], name='unique_user_period_value')
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - {self.resolution} of {self.period_start} - {self.total_value}"
+
+
+class ExchangeRate(models.Model):
+    date = models.DateField()
+    base_currency = models.CharField(max_length=3)
+    currency = models.CharField(max_length=3)
+    rate = models.DecimalField(max_digits=20, decimal_places=10)  # units of currency per one unit of base_currency
+
+    class Meta:
+        ordering = ['date', 'currency']
+        # Store one rate per currency per day
+        constraints = [
+            models.UniqueConstraint(fields=['base_currency', 'currency', 'date'], name='unique_daily_exchange_rate')
+        ]
+
+    def __str__(self):
+        return f"{self.date} - {self.base_currency}/{self.currency} - {self.rate}"
+
+
+class Job(models.Model):
+    STATUS_CHOICES = [('pending', 'Pending'), ('running', 'Running'), ('failed', 'Failed')]
+
+    kind = models.CharField(max_length=50)  # name of the registered handler
+    key = models.CharField(max_length=100)  # identifies the work, pending jobs with the same key are collapsed
+    payload = models.JSONField(default=dict)  # keyword arguments for the handler
+    priority = models.SmallIntegerField(default=0)  # higher runs first
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)  # not claimed before this time, pushed back on retries
+    locked_at = models.DateTimeField(null=True, blank=True)  # when a worker claimed the job
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', '-priority', 'run_after'], name='job_claim_order'),
+        ]
+        # Queue each piece of work at most once until a worker picks it up
+        constraints = [
+            models.UniqueConstraint(fields=['key'], condition=models.Q(status='pending'), name='unique_pending_job_key')
+        ]
+
+    def __str__(self):
+        return f"{self.kind} - {self.key} - {self.status}"
+
+
+class CacheVersion(models.Model):
+    name = models.CharField(max_length=100, unique=True)  # e.g. user_1_version or price_epoch
+    version = models.BigIntegerField(default=0)  # embedded in cache keys, only ever incremented
+
+    def __str__(self):
+        return f"{self.name} - {self.version}"
@@ -0,0 +1,142 @@
+import logging
+from decimal import Decimal, ROUND_HALF_EVEN
+from functools import total_ordering
+import numpy as np
+
+# This file contains the fixed-point money type used on the valuation hot paths
+#
+# Rounding rules:
+# - Amounts are held as an integer number of units, one unit being 1/10000 of the currency (SCALE)
+# - Amounts entering fixed point (Decimal, float or a currency conversion) are rounded half to even to the nearest unit
+# - Adding, subtracting and multiplying by whole numbers (positions) is exact
+# - Amounts leave fixed point as Decimal rounded half to even to cents, only at the model and template boundaries
+# - Vectorized conversions multiply by a float64 rate, which is exact for amounts below about 900 billion
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+SCALE_DIGITS = 4
+SCALE = 10 ** SCALE_DIGITS
+UNIT = Decimal(1).scaleb(-SCALE_DIGITS)
+CENT = Decimal('0.01')
+
+
+def to_units(amount) -> int:
+    """Convert a Decimal, float, int or string amount into units, rounding half to even"""
+    if isinstance(amount, float):
+        amount = repr(amount)  # Use the shortest repr so 0.1 stays 0.1
+    return int(Decimal(amount).quantize(UNIT, rounding=ROUND_HALF_EVEN).scaleb(SCALE_DIGITS))
+
+
+def from_units(units, places=CENT) -> Decimal:
+    """Convert units back into a Decimal, rounded half to even to cents by default"""
+    return Decimal(int(units)).scaleb(-SCALE_DIGITS).quantize(places, rounding=ROUND_HALF_EVEN)
+
+
+def convert_units(units, rate) -> int:
+    """Convert units with a Decimal exchange rate, rounding half to even"""
+    return int((Decimal(int(units)) * Decimal(rate)).quantize(Decimal(1), rounding=ROUND_HALF_EVEN))
+
+
+def convert_units_array(units, rates):
+    """Multiply int64 units by float64 rates and round half to even back to int64 units"""
+    return np.rint(units * rates).astype(np.int64)
+
+
+def sum_units(keys, units) -> dict:
+    """Sum int64 units per key exactly"""
+    if not len(keys):
+        return {}
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    sums = np.zeros(len(unique_keys), dtype=np.int64)
+    np.add.at(sums, inverse, units)
+    return {int(key): int(total) for key, total in zip(unique_keys, sums)}
+
+
+@total_ordering
+class Money:
+    """An amount of a currency held as a whole number of units"""
+
+    __slots__ = ('units', 'currency')
+
+    def __init__(self, units, currency):
+        self.units = int(units)
+        self.currency = currency
+
+    @classmethod
+    def from_decimal(cls, amount, currency):
+        return cls(to_units(amount), currency)
+
+    @classmethod
+    def zero(cls, currency):
+        return cls(0, currency)
+
+    def to_decimal(self, places=CENT) -> Decimal:
+        return from_units(self.units, places)
+
+    def convert(self, rate, currency):
+        """Convert into another currency with a Decimal rate"""
+        if currency == self.currency:
+            return self
+        return Money(convert_units(self.units, rate), currency)
+
+    def check_currency(self, other):
+        if not isinstance(other, Money):
+            return NotImplemented
+        if other.currency != self.currency:
+            raise ValueError(f"Cannot combine {self.currency} and {other.currency} amounts")
+        return other
+
+    def __add__(self, other):
+        if isinstance(other, int) and other == 0:
+            return self  # Lets sum() start from 0
+        other = self.check_currency(other)
+        if other is NotImplemented:
+            return other
+        return Money(self.units + other.units, self.currency)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        other = self.check_currency(other)
+        if other is NotImplemented:
+            return other
+        return Money(self.units - other.units, self.currency)
+
+    def __mul__(self, quantity):
+        if not isinstance(quantity, int):
+            return NotImplemented
+        return Money(self.units * quantity, self.currency)
+
+    __rmul__ = __mul__
+
+    def __neg__(self):
+        return Money(-self.units, self.currency)
+
+    def __eq__(self, other):
+        if isinstance(other, Money):
+            return self.units == other.units and self.currency == other.currency
+        if isinstance(other, int) and other == 0:
+            return self.units == 0
+        return NotImplemented
+
+    def __lt__(self, other):
+        other = self.check_currency(other)
+        if other is NotImplemented:
+            return other
+        return self.units < other.units
+
+    def __hash__(self):
+        return hash((self.units, self.currency))
+
+    def __bool__(self):
+        return self.units != 0
+
+    def __float__(self):
+        return float(self.to_decimal())
+
+    def __repr__(self):
+        return f"Money({self.to_decimal(UNIT)} {self.currency})"
+
+    def __str__(self):
+        return f"{self.to_decimal()} {self.currency}"
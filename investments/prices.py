@@ -0,0 +1,197 @@
+import logging
+from datetime import timedelta
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.db.models import F, BigIntegerField
+from django.db.models.functions import Cast, Round
+from .models import Asset, AssetPrice, PortfolioAsset, TotalValueHistory
+from . import api
+from . import fx
+from . import money
+from . import utils
+from . import versions
+
+# This file contains the daily close price store and the vectorized history backfill
+# Closes are downloaded for many symbols per request, and past total values are rebuilt from
+# current holdings, stored closes and stored exchange rates as (holding x day) NumPy arrays
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_CHUNK_SIZE = 100  # Symbols per multi-symbol history request
+PRICE_LOOKBACK_DAYS = 10  # Days before the start searched for a close to carry into the first days
+WRITE_BATCH_SIZE = 5000  # History entries per insert statement
+
+CLOSE_UNITS = Cast(Round(F('close') * money.SCALE), BigIntegerField())
+
+
+def store_prices(asset_ids, history):
+    """Upsert the closes of a {symbol: {date: close}} download for the assets of a {symbol: asset_id} dict"""
+    prices = [
+        AssetPrice(asset_id=asset_ids[symbol], date=day, close=close)
+        for symbol, closes in history.items() if symbol in asset_ids
+        for day, close in closes.items()
+    ]
+    AssetPrice.objects.bulk_create(
+        prices,
+        batch_size=WRITE_BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=['asset', 'date'],
+        update_fields=['close'],
+    )
+    return len(prices)
+
+
+def download_price_history(start, end, assets=None, chunk_size=DOWNLOAD_CHUNK_SIZE, progress=None):
+    """
+    Download and store the daily closes of the assets between start and end, one request per chunk of symbols.
+    The optional progress callback receives (processed, total, stored) after each chunk.
+    Returns the number of closes stored.
+    """
+    assets = Asset.objects.all() if assets is None else assets
+    symbols = dict(assets.order_by('symbol').values_list('symbol', 'id'))
+    ordered = list(symbols)
+    stored = 0
+
+    for offset in range(0, len(ordered), chunk_size):
+        chunk = ordered[offset:offset + chunk_size]
+        history = api.get_price_history(chunk, start, end)
+        missing = [symbol for symbol in chunk if not history.get(symbol)]
+        if missing:
+            logger.warning(f"No price history returned for {len(missing)} symbols: {missing}")
+        stored += store_prices(symbols, history)
+        if progress:
+            progress(offset + len(chunk), len(ordered), stored)
+
+    return stored
+
+
+def forward_fill(matrix, valid):
+    """Fill the invalid cells of each row with the last valid value to their left, returns (filled, filled valid mask)"""
+    index = np.where(valid, np.arange(matrix.shape[1]), 0)
+    np.maximum.accumulate(index, axis=1, out=index)
+    filled = matrix[np.arange(matrix.shape[0])[:, np.newaxis], index]
+    return filled, np.maximum.accumulate(valid, axis=1)  # Nothing to carry before the first close
+
+
+def load_price_matrix(asset_ids, start, end):
+    """
+    Return an (asset x day) int64 array of closes in money units, carried forward over days without a close,
+    and a mask of the cells that have a close
+    """
+    days = (end - start).days + 1
+    index = {asset_id: i for i, asset_id in enumerate(asset_ids)}
+    lookback = start - timedelta(days=PRICE_LOOKBACK_DAYS)
+    matrix = np.zeros((len(asset_ids), days + PRICE_LOOKBACK_DAYS), dtype=np.int64)
+    valid = np.zeros(matrix.shape, dtype=bool)
+
+    rows = AssetPrice.objects.filter(asset_id__in=asset_ids, date__gte=lookback, date__lte=end)\
+        .annotate(close_units=CLOSE_UNITS).values_list('asset_id', 'date', 'close_units')
+    for asset_id, day, close_units in rows.iterator():
+        matrix[index[asset_id], (day - lookback).days] = close_units
+        valid[index[asset_id], (day - lookback).days] = True
+
+    filled, filled_valid = forward_fill(matrix, valid)
+    return filled[:, PRICE_LOOKBACK_DAYS:], filled_valid[:, PRICE_LOOKBACK_DAYS:]
+
+
+def load_rate_matrix(currencies, start, end):
+    """
+    Return a (currency x day) float array of rates against the FX base currency from the stored daily tables.
+    Days before the first stored table use the latest rates.
+    """
+    days = [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+    matrix = np.full((len(currencies), len(days)), np.nan)
+    latest = None
+    for column, day in enumerate(days):
+        table = fx.get_historical_table(day)
+        if table is None:
+            latest = latest or fx.get_rates() or {}
+            table = latest
+        matrix[:, column] = [float(table[currency]) if currency in table else np.nan for currency in currencies]
+    if latest is not None:
+        logger.warning(f"No stored exchange rates for some days from {start}, used the latest rates for them")
+    return matrix
+
+
+def value_user_days(holdings, start, end):
+    """
+    Value (user_id, asset_id, position, asset currency, user currency) holdings on every day from start to end.
+    Returns the user ids, a (user x day) array of totals in money units and a mask of the days that could be valued.
+    """
+    user_ids, asset_ids, positions, asset_currencies, user_currencies = zip(*holdings)
+    unique_users, user_idx = np.unique(np.array(user_ids, dtype=np.int64), return_inverse=True)
+    unique_assets, asset_idx = np.unique(np.array(asset_ids, dtype=np.int64), return_inverse=True)
+    currencies = sorted(set(asset_currencies) | set(user_currencies))
+    currency_index = {currency: i for i, currency in enumerate(currencies)}
+    asset_currency_idx = np.array([currency_index[c] for c in asset_currencies], dtype=np.int64)
+    user_currency_idx = np.array([currency_index[c] for c in user_currencies], dtype=np.int64)
+
+    price_units, has_price = load_price_matrix(unique_assets.tolist(), start, end)
+    base_rates = load_rate_matrix(currencies, start, end)
+
+    # (holding x day) values, exact int64 units in the asset currency and only the FX ratio as a float
+    positions = np.array(positions, dtype=np.int64)[:, np.newaxis]
+    local_units = price_units[asset_idx] * positions
+    same_currency = (asset_currency_idx == user_currency_idx)[:, np.newaxis]
+    rates = base_rates[user_currency_idx] / base_rates[asset_currency_idx]
+    converted = money.convert_units_array(local_units, np.where(np.isnan(rates), 0.0, rates))
+    values = np.where(same_currency, local_units, converted)  # Holdings in the user currency stay exact
+    missing_rates = np.isnan(rates) & ~same_currency
+    missing = ~has_price[asset_idx] | missing_rates
+
+    totals = np.zeros((len(unique_users), values.shape[1]), dtype=np.int64)
+    np.add.at(totals, user_idx, np.where(missing, 0, values))
+    incomplete = np.zeros(totals.shape, dtype=bool)
+    np.logical_or.at(incomplete, user_idx, missing)
+    return unique_users, totals, ~incomplete
+
+
+def backfill_history(start, end, chunk_size=500, overwrite=False, id_range=None, progress=None):
+    """
+    Rebuild the daily total value of every user from start to end from their current holdings,
+    the stored closes and the stored exchange rates, one chunk of users at a time.
+    Existing entries are kept unless overwrite is set. Days on which any holding has no close are skipped.
+    The optional progress callback receives (processed, total, valued) after each chunk.
+    Returns the number of user days valued.
+    """
+    users = get_user_model().objects.order_by('id')
+    if id_range:
+        users = users.filter(id__gte=id_range[0], id__lt=id_range[1])
+    total = users.count()
+    days = [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+    timestamps = [utils.get_history_timestamp(day) for day in days]
+    processed = 0
+    valued = 0
+    last_id = 0
+
+    while True:
+        user_ids = list(users.filter(id__gt=last_id).values_list('id', flat=True)[:chunk_size])
+        if not user_ids:
+            break
+        last_id = user_ids[-1]
+
+        holdings = list(
+            PortfolioAsset.objects.filter(portfolio__user_id__gte=user_ids[0], portfolio__user_id__lte=last_id)
+            .values_list('portfolio__user_id', 'asset_id', 'position', 'asset__currency', 'portfolio__user__default_currency')
+        )
+        if holdings:
+            valued_users, totals, complete = value_user_days(holdings, start, end)
+            entries = [
+                TotalValueHistory(user_id=int(user_id), day=day, timestamp=timestamps[column],
+                                  total_value=money.from_units(totals[row, column]))
+                for row, user_id in enumerate(valued_users)
+                for column, day in enumerate(days) if complete[row, column]
+            ]
+            if overwrite:
+                utils.upsert_history_entries(entries, batch_size=WRITE_BATCH_SIZE)
+            else:
+                TotalValueHistory.objects.bulk_create(entries, batch_size=WRITE_BATCH_SIZE, ignore_conflicts=True)
+                versions.bump_user_versions(valued_users.tolist())  # bulk_create sends no signals
+            valued += len(entries)
+
+        processed += len(user_ids)
+        if progress:
+            progress(processed, total, valued)
+
+    return valued
@@ -0,0 +1,195 @@
+import json
+import logging
+import threading
+import time
+import zlib
+from datetime import date, timedelta
+from decimal import Decimal
+from pathlib import Path
+from typing import List, Dict, Tuple
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+from .fetcher import fetch_all
+
+# This file contains the market data provider interface and the local (offline) provider
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROVIDER = 'investments.api.LiveProvider'
+DEFAULT_FIXTURES = Path(__file__).resolve().parent / 'recordings' / 'market_data.json'
+
+
+class MarketDataProvider:
+    """
+    Interface for a source of asset and exchange rate data.
+    Methods may raise, the functions in api.py log errors and apply fallbacks.
+    """
+    # Seconds to pause between single-symbol requests in bulk scripts
+    request_delay = 0
+
+    def get_asset_data_with_failures(self, symbols: List[str]) -> Tuple[Dict[str, Dict], Dict[str, str]]:
+        """Return (data, failures) for the symbols, keyed by symbol"""
+        raise NotImplementedError
+
+    def get_asset_price(self, symbol: str) -> Decimal:
+        """Return the latest price for the symbol"""
+        raise NotImplementedError
+
+    def get_exchange_rates(self, base_currency: str) -> Dict[str, Decimal]:
+        """Return the rate of every known currency against the base currency"""
+        raise NotImplementedError
+
+    def get_historical_exchange_rates(self, base_currency: str, day: date) -> Dict[str, Decimal]:
+        """Return the rate of every known currency against the base currency on a past day"""
+        raise NotImplementedError
+
+    def get_price_history(self, symbols: List[str], start: date, end: date) -> Dict[str, Dict[date, Decimal]]:
+        """Return the daily closes of the symbols between start and end inclusive, in one request"""
+        raise NotImplementedError
+
+    def get_exchange_rate(self, from_currency: str, to_currency: str) -> Decimal:
+        """Return the rate to convert from_currency into to_currency"""
+        return self.get_exchange_rates(from_currency)[to_currency]
+
+    def search_assets(self, query: str, limit: int = 10) -> List[Dict]:
+        """Return assets matching the query"""
+        raise NotImplementedError
+
+
+class LocalProvider(MarketDataProvider):
+    """
+    Deterministic offline provider for tests and benchmarks.
+    Serves recorded fixtures and synthesises stable prices for unknown symbols,
+    with optional injected latency and error rate, configured in settings.LOCAL_MARKET_DATA.
+    """
+
+    def __init__(self, fixtures=None, latency=None, error_rate=None, seed=None, synthetic=None):
+        options = getattr(settings, 'LOCAL_MARKET_DATA', {})
+        self.fixtures_path = Path(fixtures or options.get('FIXTURES') or DEFAULT_FIXTURES)
+        self.latency = float(latency if latency is not None else options.get('LATENCY', 0))
+        self.error_rate = float(error_rate if error_rate is not None else options.get('ERROR_RATE', 0))
+        self.seed = seed if seed is not None else options.get('SEED', 0)
+        self.synthetic = synthetic if synthetic is not None else options.get('SYNTHETIC', True)
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.load_fixtures()
+
+    def load_fixtures(self):
+        """Load recorded assets and exchange rates from the fixtures file"""
+        self.assets = {}
+        self.exchange_rates = {'USD': {'USD': 1}}
+        if self.fixtures_path.exists():
+            with open(self.fixtures_path) as f:
+                data = json.load(f)
+            self.assets = data.get('assets', {})
+            self.exchange_rates = data.get('exchange_rates', self.exchange_rates)
+
+    def unit_hash(self, *parts):
+        """Map the parts to a stable float in [0, 1)"""
+        key = ':'.join(str(part) for part in (self.seed,) + parts)
+        return zlib.crc32(key.encode()) / 2**32
+
+    def simulate_request(self, key):
+        """Apply the configured latency and fail deterministically at the configured rate"""
+        with self.lock:
+            call = self.calls[key] = self.calls.get(key, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and self.unit_hash(key, call) < self.error_rate:
+            raise ConnectionError(f"Injected error for {key} (call {call})")
+
+    def synthetic_asset(self, symbol):
+        """Build a stable fake asset for a symbol without a recording"""
+        return {
+            'name': f'{symbol} Synthetic',
+            'long_name': f'{symbol} Synthetic Asset',
+            'latest_price': round(1 + self.unit_hash(symbol, 'price') * 999, 2),
+            'asset_type': 'EQUITY',
+            'currency': 'USD',
+            'timezone_full_name': 'America/New_York',
+            'timezone_short_name': 'EST',
+        }
+
+    def get_asset(self, symbol):
+        self.simulate_request(symbol)
+        if symbol in self.assets:
+            return dict(self.assets[symbol])
+        if self.synthetic:
+            return self.synthetic_asset(symbol)
+        raise KeyError(f"No recorded data for symbol: {symbol}")
+
+    def get_asset_data_with_failures(self, symbols):
+        return fetch_all(symbols, self.get_asset, rate=0)
+
+    def get_asset_price(self, symbol):
+        return Decimal(str(self.get_asset(symbol)['latest_price']))
+
+    def get_price_history(self, symbols, start, end):
+        """Synthesise stable weekday closes within 10% either side of each symbol's latest price"""
+        self.simulate_request(f"history:{','.join(symbols)}")
+        history = {}
+        for symbol in symbols:
+            if symbol not in self.assets and not self.synthetic:
+                continue
+            latest_price = (self.assets.get(symbol) or self.synthetic_asset(symbol))['latest_price']
+            closes = {}
+            day = start
+            while day <= end:
+                if day.weekday() < 5:
+                    change = 0.9 + self.unit_hash(symbol, day.isoformat()) * 0.2
+                    closes[day] = Decimal(str(round(latest_price * change, 4)))
+                day += timedelta(days=1)
+            history[symbol] = closes
+        return history
+
+    def get_exchange_rates(self, base_currency):
+        self.simulate_request(f'fx:{base_currency}')
+        # Rates are recorded against USD, derive the requested base from them
+        usd_rates = self.exchange_rates['USD']
+        base_rate = Decimal(str(usd_rates[base_currency]))
+        return {currency: Decimal(str(rate)) / base_rate for currency, rate in usd_rates.items()}
+
+    def get_historical_exchange_rates(self, base_currency, day):
+        # Recordings hold a single table, so every day shares it
+        return self.get_exchange_rates(base_currency)
+
+    def search_assets(self, query, limit=10):
+        self.simulate_request(f'search:{query}')
+        query = query.lower()
+        results = []
+        for symbol, data in self.assets.items():
+            if query in symbol.lower() or query in (data.get('name') or '').lower():
+                results.append({
+                    'symbol': symbol,
+                    'name': data.get('name') or data.get('long_name'),
+                    'exchange': data.get('exchange'),
+                    'asset_type': data.get('asset_type'),
+                })
+        return results[:limit]
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_provider() -> MarketDataProvider:
+    """Return the provider configured in settings.MARKET_DATA_PROVIDER"""
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                provider_class = import_string(getattr(settings, 'MARKET_DATA_PROVIDER', DEFAULT_PROVIDER))
+                _provider = provider_class()
+    return _provider
+
+
+def reset_provider(**kwargs):
+    """Drop the cached provider so the next call picks up changed settings"""
+    global _provider
+    if kwargs.get('setting') in (None, 'MARKET_DATA_PROVIDER', 'LOCAL_MARKET_DATA'):
+        _provider = None
+
+
+setting_changed.connect(reset_provider)
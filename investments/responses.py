@@ -0,0 +1,100 @@
+import hashlib
+import json
+import logging
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from django.utils.text import compress_string
+from . import caching
+from . import versions
+
+# This file contains the response cache behind the JSON endpoints
+# Response bodies are serialized and compressed once per user version and query, and a hit
+# returns the stored bytes with a strong ETag instead of rebuilding and re-encoding the data
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class Uncacheable(Exception):
+    """Raised by compute() with data that should be served once but not cached, such as partial results"""
+
+    def __init__(self, data):
+        super().__init__()
+        self.data = data
+
+
+def get_setting(name):
+    return settings.JSON_RESPONSE_CACHE[name]
+
+
+def build_body(data):
+    """Serialize data like JsonResponse does and return (body, gzipped body or None, etag, built at)"""
+    body = json.dumps(data, cls=DjangoJSONEncoder).encode()
+    gzipped = None
+    if len(body) >= get_setting('GZIP_MIN_SIZE'):
+        gzipped = compress_string(body)
+        if len(gzipped) >= len(body):
+            gzipped = None
+    etag = f'"{hashlib.md5(body).hexdigest()}"'
+    return body, gzipped, etag, timezone.now().timestamp()
+
+
+def get_cache_key(request, name):
+    """Key the body on the user's version, the price epoch and the query string"""
+    cache_key = versions.user_cache_key(request.user.id, f'{name}_response')
+    query = request.GET.urlencode()
+    if query:
+        cache_key = f'{cache_key}_{hashlib.md5(query.encode()).hexdigest()}'
+    return cache_key
+
+
+def accepts_gzip(request):
+    return 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+
+
+def conditional_response(request, body, gzipped, etag, last_modified):
+    """Return the body, gzipped when the client accepts it, with validators and a 304 when they match"""
+    response = HttpResponse(content_type='application/json')
+    if gzipped is not None:
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if accepts_gzip(request):
+            body = gzipped
+            etag = f'{etag[:-1]}-gzip"'  # Each encoding is its own representation
+            response['Content-Encoding'] = 'gzip'
+    response.content = body
+    response['Content-Length'] = str(len(body))
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = f"private, max-age={get_setting('MAX_AGE')}"
+
+    return get_conditional_response(request, etag=etag, last_modified=int(last_modified), response=response)
+
+
+def cached_json_response(request, name, compute, last_modified=None):
+    """
+    Return the JSON response for compute(), whose data may only change with the user's cache version.
+    Last-Modified is the given datetime, or when the body was built.
+    Conditional requests matching the stored ETag or Last-Modified get a 304.
+    """
+    try:
+        body, gzipped, etag, built_at = caching.get_or_set(
+            get_cache_key(request, name),
+            lambda: build_body(compute()),
+            versions.get_cache_ttl(),
+        )
+    except Uncacheable as e:
+        # The next request computes the data again
+        response = JsonResponse(e.data, safe=False)
+        response['Cache-Control'] = 'no-store'
+        return response
+    return conditional_response(request, body, gzipped, etag, last_modified.timestamp() if last_modified else built_at)
+
+
+def json_response(request, data, last_modified=None):
+    """Return data with the same validators as a cached response, without storing its body"""
+    body, gzipped, etag, built_at = build_body(data)
+    return conditional_response(request, body, gzipped, etag, last_modified.timestamp() if last_modified else built_at)
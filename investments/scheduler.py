@@ -0,0 +1,111 @@
+import logging
+from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from django.conf import settings
+from django.db.models import Count, Q
+from django.utils import timezone
+from .constants import MARKET_HOURS
+from .models import Asset
+from . import utils
+
+# This file contains the market-hours-aware price refresh scheduler
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Market session states
+OPEN = 'open'
+JUST_CLOSED = 'just_closed'
+CLOSED = 'closed'
+UNKNOWN = 'unknown'
+
+
+def get_scheduler_setting(name):
+    return settings.PRICE_SCHEDULER[name]
+
+
+def get_last_close(local_now, close_time):
+    """Return the most recent weekday close at or before local_now"""
+    day = local_now.date()
+    if local_now.weekday() >= 5 or local_now.time() < close_time:
+        day -= timedelta(days=1)
+    while day.weekday() >= 5:
+        day -= timedelta(days=1)
+    return datetime.combine(day, close_time, tzinfo=local_now.tzinfo)
+
+
+def get_market_session(tz_name, now):
+    """Return (state, last_close) for the market trading in tz_name at now"""
+    hours = MARKET_HOURS.get(tz_name)
+    if hours is None:
+        return UNKNOWN, None
+    try:
+        local_now = now.astimezone(ZoneInfo(tz_name))
+    except ZoneInfoNotFoundError:
+        return UNKNOWN, None
+
+    open_time, close_time = (time.fromisoformat(hour) for hour in hours)
+    if local_now.weekday() < 5 and open_time <= local_now.time() < close_time:
+        return OPEN, None
+
+    last_close = get_last_close(local_now, close_time)
+    if local_now - last_close <= timedelta(seconds=get_scheduler_setting('CLOSED_GRACE')):
+        return JUST_CLOSED, last_close
+    return CLOSED, last_close
+
+
+def get_due_assets(now=None):
+    """
+    Return the assets that need a refresh, most widely held first.
+    Assets are grouped by exchange timezone, and only open or just closed markets
+    whose prices are older than their freshness cutoff are included.
+    """
+    now = now or timezone.now()
+    timezones = Asset.objects.values_list('timezone_full_name', flat=True).distinct()
+
+    due = Q()
+    sessions = {}
+    for tz_name in timezones:
+        state, last_close = get_market_session(tz_name, now)
+        sessions[tz_name] = state
+        if state == OPEN:
+            cutoff = now - timedelta(seconds=get_scheduler_setting('OPEN_MAX_AGE'))
+        elif state == JUST_CLOSED:
+            cutoff = last_close  # Fetch the closing price once
+        elif state == UNKNOWN:
+            cutoff = now - timedelta(seconds=get_scheduler_setting('UNKNOWN_MAX_AGE'))
+        else:
+            continue
+        tz_filter = Q(timezone_full_name__isnull=True) if tz_name is None else Q(timezone_full_name=tz_name)
+        due |= tz_filter & Q(updated_at__lt=cutoff)
+
+    logger.debug(f"Market sessions at {now}: {sessions}")
+    if not due:
+        return Asset.objects.none()
+
+    return Asset.objects.filter(due)\
+        .annotate(holders=Count('portfolio_assets'))\
+        .order_by('-holders', 'updated_at')
+
+
+def refresh_due_assets(now=None, chunk_size=None, limit=None):
+    """Refresh the due assets in priority order and return (updated, failed, skipped) counts"""
+    chunk_size = chunk_size or settings.ASSET_UPDATE_CHUNK_SIZE
+    limit = limit or get_scheduler_setting('BATCH_LIMIT')
+
+    total = Asset.objects.count()
+    due_assets = list(get_due_assets(now)[:limit])
+    updated_count = 0
+    failed_count = 0
+
+    for start in range(0, len(due_assets), chunk_size):
+        chunk = due_assets[start:start + chunk_size]
+        try:
+            chunk_updated, chunk_failed = utils.update_asset_chunk(chunk)
+        except Exception as e:
+            chunk_updated, chunk_failed = 0, len(chunk)
+            logger.error(f"Error refreshing scheduled asset chunk: {e}")
+        updated_count += chunk_updated
+        failed_count += chunk_failed
+
+    return updated_count, failed_count, total - len(due_assets)
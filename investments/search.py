@@ -0,0 +1,153 @@
+import logging
+import re
+import threading
+import time
+from typing import List, Dict, Tuple
+from django.conf import settings
+from .caching import LRUCache
+from .models import Asset
+from . import api
+
+# This file contains the local symbol search index and the cache in front of the upstream search API
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text):
+    """Split text into lowercase alphanumeric tokens"""
+    return TOKEN_PATTERN.findall((text or '').lower())
+
+
+class SymbolIndex:
+    """
+    In-memory prefix index over asset symbols and names.
+    Every token prefix up to max_prefix characters maps to the symbols containing it.
+    """
+
+    def __init__(self, max_prefix=8):
+        self.max_prefix = max_prefix
+        self.entries = {}
+        self.tokens = {}
+        self.prefixes = {}
+        self.last_asset_id = 0
+        self.refreshed_at = 0
+        self.lock = threading.Lock()
+
+    def add(self, result):
+        """Add a search result dict with at least a symbol and a name"""
+        symbol = result.get('symbol')
+        if not symbol:
+            return
+        with self.lock:
+            if symbol in self.entries:
+                # Keep the richer entry, upstream results carry the exchange
+                self.entries[symbol] = {**self.entries[symbol], **{k: v for k, v in result.items() if v}}
+                return
+            self.entries[symbol] = {
+                'symbol': symbol,
+                'name': result.get('name'),
+                'exchange': result.get('exchange'),
+                'asset_type': result.get('asset_type'),
+            }
+            tokens = set(tokenize(symbol)) | set(tokenize(result.get('name'))) | {symbol.lower()}
+            self.tokens[symbol] = tokens
+            for token in tokens:
+                for length in range(1, min(len(token), self.max_prefix) + 1):
+                    self.prefixes.setdefault(token[:length], set()).add(symbol)
+
+    def refresh(self):
+        """Index assets added to the database since the last refresh"""
+        if time.monotonic() - self.refreshed_at < settings.SYMBOL_SEARCH['INDEX_REFRESH']:
+            return
+        self.refreshed_at = time.monotonic()
+        assets = Asset.objects.filter(id__gt=self.last_asset_id).order_by('id')\
+            .values('id', 'symbol', 'name', 'asset_type')
+        for asset in assets.iterator():
+            self.add(asset)
+            self.last_asset_id = asset['id']
+
+    def search(self, query, limit=10) -> List[Dict]:
+        """Return entries whose tokens start with every token of the query, best matches first"""
+        query_tokens = tokenize(query)
+        if not query_tokens:
+            return []
+
+        # add() changes the prefix sets in place, so read them under the same lock
+        with self.lock:
+            candidates = None
+            for token in query_tokens:
+                matches = self.prefixes.get(token[:self.max_prefix], set())
+                candidates = matches if candidates is None else candidates & matches
+                if not candidates:
+                    return []
+
+            # Tokens longer than the indexed prefix still need a full check
+            results = [
+                dict(self.entries[symbol]) for symbol in candidates
+                if all(any(token.startswith(query_token) for token in self.tokens[symbol]) for query_token in query_tokens)
+            ]
+
+        query_lower = query.lower()
+
+        def rank(entry):
+            symbol = entry['symbol'].lower()
+            return (symbol != query_lower, not symbol.startswith(query_lower), len(symbol), symbol)
+
+        results.sort(key=rank)
+        return results[:limit]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tokens.clear()
+            self.prefixes.clear()
+            self.last_asset_id = 0
+            self.refreshed_at = 0
+
+
+_index = SymbolIndex()
+_upstream_cache = LRUCache(settings.SYMBOL_SEARCH['CACHE_SIZE'], settings.SYMBOL_SEARCH['CACHE_TTL'])
+
+
+def search_with_status(query: str, limit: int = 10) -> Tuple[List[Dict], bool]:
+    """
+    Search the local index first and only call the upstream search API, through
+    an LRU cache, when the index has too few matches for the query.
+    Returns the results and whether they are complete, which they are not when the upstream search failed.
+    """
+    _index.refresh()
+    local_results = _index.search(query, limit)
+    if len(local_results) >= min(limit, settings.SYMBOL_SEARCH['MIN_LOCAL_RESULTS']):
+        return local_results, True
+
+    cache_key = (query.lower(), limit)
+    upstream_results = _upstream_cache.get(cache_key)
+    if upstream_results is None:
+        try:
+            upstream_results = api.search_assets(query, limit)
+        except Exception:
+            # Serve the local matches and let the next search try upstream again rather than caching the failure
+            return local_results, False
+        _upstream_cache.set(cache_key, upstream_results)
+        for result in upstream_results:
+            _index.add(result)
+
+    # Upstream results first, then any local matches it did not return
+    seen = {result['symbol'] for result in upstream_results}
+    results = [dict(result) for result in upstream_results]
+    results += [result for result in local_results if result['symbol'] not in seen]
+    return results[:limit], True
+
+
+def search_assets(query: str, limit: int = 10) -> List[Dict]:
+    """Search assets, serving only the local matches while the upstream search fails"""
+    return search_with_status(query, limit)[0]
+
+
+def clear():
+    """Drop the local index and the upstream result cache"""
+    _index.clear()
+    _upstream_cache.clear()
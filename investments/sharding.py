@@ -0,0 +1,54 @@
+import argparse
+import zlib
+from django.db.models import Min, Max
+
+# This file contains the helpers that split batch work into disjoint shards
+# Assets are sharded by a stable hash of their symbol and users by contiguous id ranges,
+# so shards can run in separate processes or on separate nodes without overlapping
+
+
+def parse_shard(value):
+    """Parse an 'i/n' command line value into a zero-based (index, count) tuple"""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shard must look like i/n, got {value!r}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard index must be between 0 and {count - 1}, got {value!r}")
+    return index, count
+
+
+def symbol_hash(symbol):
+    return zlib.crc32(symbol.encode())
+
+
+def symbol_in_shard(symbol, shard):
+    """Whether the symbol belongs to the (index, count) shard"""
+    index, count = shard
+    return symbol_hash(symbol) % count == index
+
+
+def split_hash_shard(shard, parts):
+    """
+    Split a hash shard into smaller hash shards that together cover exactly the same keys.
+    Keys with hash % n == i are split by hash % (n * parts) == i + n * part.
+    """
+    index, count = shard
+    return [(index + count * part, count * parts) for part in range(parts)]
+
+
+def get_id_range(queryset, shard):
+    """Return the [start, end) id range of the (index, count) shard of the queryset, or None if it is empty"""
+    index, count = shard
+    bounds = queryset.aggregate(first=Min('id'), last=Max('id'))
+    if bounds['first'] is None:
+        return None
+    return split_id_range((bounds['first'], bounds['last'] + 1), count)[index]
+
+
+def split_id_range(id_range, parts):
+    """Split a [start, end) id range into contiguous ranges of nearly equal width"""
+    start, end = id_range
+    width = end - start
+    bounds = [start + width * part // parts for part in range(parts + 1)]
+    return [(bounds[part], bounds[part + 1]) for part in range(parts)]
@@ -0,0 +1,29 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Asset, Portfolio, PortfolioAsset
+from . import versions
+
+# This file contains the signal handlers that move caches to new versions when data changes
+# Bulk writes do not send signals, so those write paths bump the versions themselves
+# History entries and rollups are only written in bulk, and a delete receiver on them would turn
+# every queryset delete into one signal and one version update per row
+
+
+@receiver([post_save, post_delete], sender=Portfolio)
+def portfolio_changed(sender, instance, **kwargs):
+    versions.bump_user_version(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=PortfolioAsset)
+def portfolio_asset_changed(sender, instance, **kwargs):
+    if PortfolioAsset.portfolio.is_cached(instance):
+        user_id = instance.portfolio.user_id
+    else:
+        user_id = Portfolio.objects.filter(id=instance.portfolio_id).values_list('user_id', flat=True).first()
+    if user_id is not None:
+        versions.bump_user_version(user_id)
+
+
+@receiver([post_save, post_delete], sender=Asset)
+def asset_changed(sender, instance, **kwargs):
+    versions.bump_price_epoch()
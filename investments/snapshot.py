@@ -0,0 +1,76 @@
+import logging
+from django.utils import timezone
+from .aggregates import get_currency_subtotals, get_user_holdings, REGION, CATEGORY
+from . import caching
+from . import fx
+from . import versions
+from .money import Money
+
+# This file contains the per-user holdings snapshot shared by the dashboard widgets
+# A snapshot is built from one grouped query and one FX table lookup, so every widget
+# sees the same prices and rates. Values are kept as fixed-point Money and only
+# become Decimal when a widget reads a total
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class HoldingsSnapshot:
+    """The value of each asset a user holds, in the user's default currency"""
+
+    def __init__(self, currency, assets, built_at=None):
+        self.currency = currency
+        self.assets = assets  # Dicts with symbol, name, region, category and value as Money
+        self.built_at = built_at or timezone.now()
+
+    @classmethod
+    def build(cls, user):
+        """Sum the user's holdings per asset in the database and convert each currency once"""
+        rows = get_currency_subtotals(
+            get_user_holdings(user),
+            'asset_id', 'asset__symbol', 'asset__name',
+            region=REGION, category=CATEGORY
+        )
+
+        rates = {}
+        assets = []
+        for row in rows:
+            currency = row['asset__currency']
+            if currency not in rates:
+                rates[currency] = fx.get_rate(currency, user.default_currency)
+            if rates[currency] is None or row['subtotal'] is None:
+                logger.error(f"Skipping {row['asset__symbol']} for user {user.id}, its value could not be converted")
+                continue
+            assets.append({
+                'symbol': row['asset__symbol'],
+                'name': row['asset__name'],
+                'region': row['region'],
+                'category': row['category'],
+                'value': Money.from_decimal(row['subtotal'], currency).convert(rates[currency], user.default_currency),
+            })
+        return cls(user.default_currency, assets)
+
+    @property
+    def total_value(self):
+        return sum((asset['value'] for asset in self.assets), Money.zero(self.currency)).to_decimal()
+
+    def top_assets(self, count=5):
+        return sorted(self.assets, key=lambda asset: asset['value'], reverse=True)[:count]
+
+    def totals_by(self, field, initial=()):
+        totals = {key: Money.zero(self.currency) for key in initial}
+        for asset in self.assets:
+            totals[asset[field]] = totals.get(asset[field], Money.zero(self.currency)) + asset['value']
+        return {key: total.to_decimal() for key, total in totals.items()}
+
+    def region_totals(self):
+        return self.totals_by('region')
+
+    def category_totals(self):
+        return self.totals_by('category', initial=('Aggressive', 'Passive'))
+
+
+def get_holdings_snapshot(user):
+    """Return the user's cached holdings snapshot, building it on a miss"""
+    cache_key = versions.user_cache_key(user.id, f'holdings_{user.default_currency}')
+    return caching.get_or_set(cache_key, lambda: HoldingsSnapshot.build(user), versions.get_cache_ttl())
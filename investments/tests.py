@@ -2,18 +2,58 @@ import pytest
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 from decimal import Decimal
-from .models import Portfolio, Asset, PortfolioAsset, TotalValueHistory
+from .models import Portfolio, Asset, PortfolioAsset, TotalValueHistory, ExchangeRate, AssetPrice, Job, CacheVersion
 from . import utils
 from . import api
+from . import fetcher
+from . import scheduler
+from . import fx
+from . import search
+from . import valuation
+from . import aggregates
+from . import snapshot
+from . import versions
+from . import caching
+from . import money
+from . import sharding
+from . import batch
+from . import history
+from . import jobs
+from . import prices
+from . import responses
+from .providers import LocalProvider
 from django.utils import timezone
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
 from unittest.mock import patch
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+import argparse
 import json
+from io import StringIO
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils.http import http_date
+import numpy as np
+import queue
+import threading
+import time
 
 
 # Create your tests here.
 User = get_user_model()
 
 
+@pytest.fixture(autouse=True)
+def clear_caches(db):
+    cache.clear()
+    caching.clear_local()
+    fx.clear()
+    search.clear()
+
+
 @pytest.fixture
 def user():
     return User.objects.create_user(username='testuser', password='12345')
@@ -92,7 +132,8 @@ class TestViews:
         assert response.status_code == 200
         assert 'AAPL' in response.json()['results'][0]['symbol']
 
-    def test_add_assets_view(self, client, user, portfolio):
+    def test_add_assets_view(self, client, user, portfolio, settings):
+        settings.MARKET_DATA_PROVIDER = 'investments.providers.LocalProvider'
         client.force_login(user)
         data = {'assets': [{'symbol': 'AAPL', 'quantity': 10}]}
         response = client.post(reverse('add_assets', kwargs={'portfolio_id': portfolio.id}), 
@@ -105,10 +146,47 @@ class TestViews:
 @pytest.mark.django_db
 class TestUtils:
     def test_convert_currency(self):
-        with patch('investments.api.get_exchange_rate', return_value=0.85):
+        with patch('investments.api.get_exchange_rates', return_value={'USD': Decimal('1'), 'EUR': Decimal('0.85')}):
             result = utils.convert_currency(Decimal('100'), 'USD', 'EUR')
             assert result == Decimal('85')
 
+    def test_convert_currency_derives_inverse_and_cross_rates(self):
+        rates = {'USD': Decimal('1'), 'NZD': Decimal('1.6'), 'CNY': Decimal('7.2')}
+        with patch('investments.api.get_exchange_rates', return_value=rates) as mock_rates:
+            assert utils.convert_currency(Decimal('16'), 'NZD', 'USD') == Decimal('10')
+            assert utils.convert_currency(Decimal('16'), 'NZD', 'CNY') == Decimal('72')
+        assert mock_rates.call_count == 1
+
+    def test_concurrent_fx_misses_fetch_once(self):
+        def slow_rates(base):
+            time.sleep(0.05)
+            return {'USD': Decimal('1'), 'EUR': Decimal('0.9')}
+
+        # Threads use their own database connections, so share an in-memory cache instead
+        with patch('investments.api.get_exchange_rates', side_effect=slow_rates) as mock_rates, \
+                patch('investments.fx.cache', LocMemCache('fx_test', {})), \
+                patch('investments.fx.get_persisted_rates', return_value=None), patch('investments.fx.store_rates'):
+            threads = [threading.Thread(target=fx.get_rate, args=('USD', 'EUR')) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert mock_rates.call_count == 1
+
+    def test_convert_currency_uses_persisted_rates(self):
+        fx.store_rates(timezone.localdate(), {'USD': Decimal('1'), 'NZD': Decimal('1.5')})
+        with patch('investments.api.get_exchange_rates') as mock_rates:
+            assert utils.convert_currency(Decimal('10'), 'USD', 'NZD') == Decimal('15')
+        mock_rates.assert_not_called()
+
+    def test_convert_currency_at_historical_rate(self):
+        fx.store_rates(date(2024, 1, 1), {'USD': Decimal('1'), 'NZD': Decimal('1.5')})
+        fx.store_rates(date(2024, 1, 5), {'USD': Decimal('1'), 'NZD': Decimal('2')})
+        assert utils.convert_currency(Decimal('10'), 'USD', 'NZD', day=date(2024, 1, 3)) == Decimal('15')
+        assert utils.convert_currency(Decimal('10'), 'USD', 'NZD', day=date(2024, 1, 5)) == Decimal('20')
+        assert utils.convert_currency(Decimal('10'), 'USD', 'NZD', day=date(2023, 12, 31)) is None
+        assert ExchangeRate.objects.count() == 4
+
     def test_get_portfolio_value(self, portfolio, portfolio_asset):
         value = utils.get_portfolio_value(portfolio)
         assert value == Decimal('1000')  # 10 shares * $100 per share
@@ -127,6 +205,20 @@ class TestUtils:
         assert asset.name == 'Apple Inc.'
         assert asset.latest_price == 150
 
+    def test_update_all_assets_in_chunks(self):
+        for symbol in ['AAA', 'BBB', 'CCC']:
+            Asset.objects.create(name=symbol, symbol=symbol, asset_type='EQUITY', latest_price=1, currency='USD')
+        fetched = {'AAA': {'latest_price': 10}, 'BBB': {'latest_price': 20}}
+        progress = []
+        with patch('investments.utils.api.get_asset_data', side_effect=lambda symbols: {
+                s: fetched[s] for s in symbols if s in fetched}) as mock_get_asset_data:
+            updated, failed = utils.update_all_assets(chunk_size=2, progress=lambda *args: progress.append(args))
+        assert (updated, failed) == (2, 1)
+        assert mock_get_asset_data.call_count == 2
+        assert progress[-1] == (3, 3, 2, 1)
+        assert Asset.objects.get(symbol='BBB').latest_price == 20
+        assert Asset.objects.get(symbol='CCC').latest_price == 1
+
 
 # API Tests
 @pytest.mark.django_db
@@ -156,4 +248,890 @@ class TestAPIIntegration:
             'conversion_rates': {'EUR': 0.85}
         }
         rate = api.get_exchange_rate('USD', 'EUR')
-        assert rate == Decimal('0.85')
\ No newline at end of file
+        assert rate == Decimal('0.85')
+
+    @patch('investments.api.yf.Tickers')
+    def test_get_asset_data_reports_failures(self, mock_tickers):
+        good = type('Ticker', (), {'info': {'shortName': 'Apple Inc.', 'currentPrice': 235.0, 'currency': 'USD'}})()
+        bad = type('Ticker', (), {'info': {}})()
+        mock_tickers.return_value.tickers = {'AAPL': good, 'BAD': bad}
+        with patch('investments.fetcher.time.sleep'):
+            data, failures = api.get_asset_data_with_failures(['AAPL', 'BAD'])
+        assert data['AAPL']['latest_price'] == 235.0
+        assert 'BAD' in failures
+        assert 'BAD' not in data
+
+
+# Fetch Engine Tests
+class TestFetcher:
+    def test_fetch_all_retries_and_isolates_failures(self):
+        attempts = {}
+
+        def fetch_one(key):
+            attempts[key] = attempts.get(key, 0) + 1
+            if key == 'FLAKY' and attempts[key] < 2:
+                raise ConnectionError('temporary')
+            if key == 'BROKEN':
+                raise ValueError('permanent')
+            return key.lower()
+
+        with patch('investments.fetcher.time.sleep'):
+            results, failures = fetcher.fetch_all(['OK', 'FLAKY', 'BROKEN'], fetch_one, rate=0, max_retries=2)
+        assert results == {'OK': 'ok', 'FLAKY': 'flaky'}
+        assert list(failures) == ['BROKEN']
+        assert attempts['BROKEN'] == 1  # Permanent errors are not retried
+
+    def test_token_bucket_limits_burst(self):
+        bucket = fetcher.TokenBucket(rate=1000, capacity=2)
+        bucket.acquire()
+        bucket.acquire()
+        assert bucket.tokens < 1
+
+    def test_callers_share_one_limiter(self):
+        fetcher.fetch_all(['A', 'B'], str.lower, rate=0.001, burst=2)
+        assert fetcher.get_limiter(0.001, 2).tokens < 1  # The next caller waits for the same bucket
+
+
+# Provider Tests
+@pytest.mark.django_db
+class TestLocalProvider:
+    def test_recorded_and_synthetic_assets(self):
+        provider = LocalProvider()
+        data, failures = provider.get_asset_data_with_failures(['AAPL', 'ZZZZ'])
+        assert not failures
+        assert data['AAPL']['name'] == 'Apple Inc.'
+        assert data['ZZZZ'] == LocalProvider().get_asset_data_with_failures(['ZZZZ'])[0]['ZZZZ']
+
+    def test_cross_exchange_rate(self):
+        provider = LocalProvider()
+        rate = provider.get_exchange_rate('NZD', 'CNY')
+        assert rate == Decimal('7.0712') / Decimal('1.6108')
+
+    def test_injected_errors_are_deterministic(self):
+        provider = LocalProvider(error_rate=0.5, seed=1, synthetic=True)
+        other = LocalProvider(error_rate=0.5, seed=1, synthetic=True)
+        symbols = [f'SYM{i}' for i in range(20)]
+        outcomes = []
+        for p in (provider, other):
+            failed = []
+            for symbol in symbols:
+                try:
+                    p.get_asset(symbol)
+                except ConnectionError:
+                    failed.append(symbol)
+            outcomes.append(failed)
+        assert outcomes[0] == outcomes[1]
+        assert 0 < len(outcomes[0]) < len(symbols)
+
+    def test_api_uses_configured_provider(self, settings):
+        settings.MARKET_DATA_PROVIDER = 'investments.providers.LocalProvider'
+        assert api.search_assets('apple')[0]['symbol'] == 'AAPL'
+        assert api.get_asset_price('BIL') == Decimal('91.62')
+
+
+# Scheduler Tests
+@pytest.mark.django_db
+class TestPriceScheduler:
+    # Tuesday 11:00 in New York, 03:00 Wednesday in Auckland
+    now = datetime(2024, 9, 10, 11, 0, tzinfo=ZoneInfo('America/New_York'))
+
+    def test_market_sessions(self):
+        assert scheduler.get_market_session('America/New_York', self.now)[0] == scheduler.OPEN
+        assert scheduler.get_market_session('Pacific/Auckland', self.now)[0] == scheduler.CLOSED
+        assert scheduler.get_market_session('America/New_York', self.now.replace(hour=16, minute=30))[0] == scheduler.JUST_CLOSED
+        assert scheduler.get_market_session('America/New_York', self.now + timedelta(days=4))[0] == scheduler.CLOSED
+        assert scheduler.get_market_session(None, self.now)[0] == scheduler.UNKNOWN
+
+    def test_due_assets_prioritise_open_stale_and_widely_held(self, portfolio):
+        stale = self.now - timedelta(hours=1)
+        assets = {}
+        for symbol, tz in [('US1', 'America/New_York'), ('US2', 'America/New_York'),
+                           ('FRESH', 'America/New_York'), ('NZ', 'Pacific/Auckland')]:
+            assets[symbol] = Asset.objects.create(name=symbol, symbol=symbol, asset_type='EQUITY',
+                                                  latest_price=1, timezone_full_name=tz)
+        Asset.objects.exclude(symbol='FRESH').update(updated_at=stale)
+        Asset.objects.filter(symbol='FRESH').update(updated_at=self.now)
+        PortfolioAsset.objects.create(portfolio=portfolio, asset=assets['US2'], position=1)
+
+        due = [asset.symbol for asset in scheduler.get_due_assets(self.now)]
+        assert due == ['US2', 'US1']
+
+
+# Search Index Tests
+@pytest.mark.django_db
+class TestSymbolSearch:
+    def test_index_matches_symbol_and_name_prefixes(self):
+        index = search.SymbolIndex(max_prefix=3)
+        index.add({'symbol': 'AAPL', 'name': 'Apple Inc.'})
+        index.add({'symbol': 'APLE', 'name': 'Apple Hospitality REIT'})
+        index.add({'symbol': 'MSFT', 'name': 'Microsoft Corporation'})
+        assert [r['symbol'] for r in index.search('apple hosp')] == ['APLE']
+        assert [r['symbol'] for r in index.search('aapl')] == ['AAPL']
+        assert [r['symbol'] for r in index.search('micro')] == ['MSFT']
+        assert index.search('applesauce') == []
+
+    def test_search_answers_locally_then_caches_upstream(self, settings):
+        settings.SYMBOL_SEARCH = {**settings.SYMBOL_SEARCH, 'MIN_LOCAL_RESULTS': 1}
+        Asset.objects.create(name='Tesla, Inc.', symbol='TSLA', asset_type='EQUITY', latest_price=1)
+        upstream = [{'symbol': 'NVDA', 'name': 'NVIDIA Corporation', 'exchange': 'NMS', 'asset_type': 'EQUITY'}]
+        with patch('investments.api.search_assets', return_value=upstream) as mock_search:
+            assert search.search_assets('tesla')[0]['symbol'] == 'TSLA'
+            assert search.search_assets('nvid')[0]['symbol'] == 'NVDA'
+            assert search.search_assets('nvid')[0]['symbol'] == 'NVDA'
+            assert search.search_assets('nvidia corp')[0]['symbol'] == 'NVDA'
+        assert mock_search.call_count == 1
+
+    def test_upstream_failures_are_not_cached(self):
+        upstream = [{'symbol': 'NVDA', 'name': 'NVIDIA Corporation', 'exchange': 'NMS', 'asset_type': 'EQUITY'}]
+        with patch('investments.api.get_provider') as get_provider:
+            get_provider.return_value.search_assets.side_effect = [RuntimeError('rate limited'), upstream]
+            assert search.search_assets('nvid') == []
+            assert search.search_assets('nvid')[0]['symbol'] == 'NVDA'
+
+    def test_search_while_indexing(self):
+        index = search.SymbolIndex()
+        errors = []
+
+        def add_symbols():
+            for i in range(20000):
+                index.add({'symbol': f'A{i}', 'name': f'Asset {i}'})
+
+        writer = threading.Thread(target=add_symbols)
+        writer.start()
+        while writer.is_alive():
+            try:
+                index.search('a')
+            except RuntimeError as e:
+                errors.append(e)
+        writer.join()
+        assert errors == []
+
+
+# Valuation Engine Tests
+@pytest.mark.django_db
+class TestValuation:
+    rates = {'USD': Decimal('1'), 'NZD': Decimal('1.6'), 'CNY': Decimal('7.2')}
+
+    def test_values_per_portfolio_and_user(self, user, portfolio, portfolio_asset):
+        nzd_portfolio = Portfolio.objects.create(user=user, name='NZ', currency='NZD')
+        cny_asset = Asset.objects.create(name='CNY Fund', symbol='CNYF', asset_type='ETF', latest_price=72, currency='CNY')
+        PortfolioAsset.objects.create(portfolio=nzd_portfolio, asset=cny_asset, position=10)
+        other = User.objects.create_user(username='other', email='other@example.com', password='12345', default_currency='NZD')
+        other_portfolio = Portfolio.objects.create(user=other, name='Other', currency='USD')
+        PortfolioAsset.objects.create(portfolio=other_portfolio, asset=cny_asset, position=1)
+
+        with patch('investments.api.get_exchange_rates', return_value=self.rates):
+            result = valuation.Valuation.load()
+            portfolio_values = result.portfolio_values()
+            user_values = result.user_values()
+
+        assert portfolio_values[portfolio.id] == Decimal('1000.00')
+        assert portfolio_values[nzd_portfolio.id] == Decimal('160.00')
+        assert portfolio_values[other_portfolio.id] == Decimal('10.00')
+        assert user_values[user.id] == Decimal('1100.00')
+        assert user_values[other.id] == Decimal('16.00')
+
+    def test_skips_holdings_without_price_or_rate(self, user, portfolio, portfolio_asset):
+        unpriced = Asset.objects.create(name='No Price', symbol='NOPE', asset_type='ETF', currency='USD')
+        unknown = Asset.objects.create(name='Unknown', symbol='UNK', asset_type='ETF', latest_price=5, currency='XXX')
+        PortfolioAsset.objects.create(portfolio=portfolio, asset=unpriced, position=10)
+        PortfolioAsset.objects.create(portfolio=portfolio, asset=unknown, position=10)
+        with patch('investments.api.get_exchange_rates', return_value=self.rates):
+            assert valuation.get_user_valuation(user).user_values() == {user.id: Decimal('1000.00')}
+
+    def test_empty_holdings(self, user):
+        assert valuation.get_user_valuation(user).user_values() == {}
+
+
+# Fixed-Point Money Tests
+class TestMoney:
+    def test_rounding_rules(self):
+        assert money.to_units(Decimal('1.23445')) == 12344  # Half to even at the fourth decimal
+        assert money.to_units(Decimal('1.23455')) == 12346
+        assert money.to_units(0.1) == 1000
+        assert money.from_units(12345) == Decimal('1.23')
+        assert money.from_units(12355) == Decimal('1.24')
+        assert money.convert_units(10001, Decimal('0.5')) == 5000
+
+    def test_money_arithmetic(self):
+        price = money.Money.from_decimal(Decimal('10.05'), 'USD')
+        holding = price * 3
+        assert holding.to_decimal() == Decimal('30.15')
+        assert sum([holding, price]) == money.Money.from_decimal('40.20', 'USD')
+        assert holding.convert(Decimal('1.6'), 'NZD').to_decimal() == Decimal('48.24')
+        assert float(holding) == 30.15
+        with pytest.raises(ValueError):
+            holding + money.Money.zero('NZD')
+
+    def test_sum_units_is_exact(self):
+        keys = np.array([1, 2, 1])
+        units = np.array([2 ** 53, 1, 1], dtype=np.int64)
+        assert money.sum_units(keys, units) == {1: 2 ** 53 + 1, 2: 1}
+
+
+# SQL Aggregate Tests
+@pytest.mark.django_db
+class TestAggregates:
+    rates = {'USD': Decimal('1'), 'NZD': Decimal('2')}
+
+    @pytest.fixture
+    def holdings(self, portfolio, portfolio_asset):
+        nz_asset = Asset.objects.create(name='NZ ETF', symbol='NZE', asset_type='ETF', latest_price=4, currency='NZD',
+                                        timezone_full_name='Pacific/Auckland')
+        us_asset = Asset.objects.create(name='US Stock', symbol='USS', asset_type='EQUITY', latest_price=10, currency='USD',
+                                        timezone_full_name='America/New_York')
+        PortfolioAsset.objects.create(portfolio=portfolio, asset=nz_asset, position=50)
+        PortfolioAsset.objects.create(portfolio=portfolio, asset=us_asset, position=5)
+
+    def test_portfolio_summaries_single_query(self, user, portfolio, holdings, django_assert_num_queries):
+        Portfolio.objects.create(user=user, name='Empty', currency='NZD')
+        with patch('investments.api.get_exchange_rates', return_value=self.rates):
+            fx.get_rates()
+            with django_assert_num_queries(1):
+                summaries = aggregates.get_portfolio_summaries(user)
+        assert [(row[1], row[5], row[6]) for row in summaries] == [('Test Portfolio', 3, 1150.0), ('Empty', 0, 0.0)]
+        assert all(type(row) is tuple for row in summaries)
+
+    def test_list_portfolios_query_count(self, client, user, portfolio, holdings, django_assert_max_num_queries):
+        client.force_login(user)
+        for index in range(5):
+            Portfolio.objects.create(user=user, name=f'Portfolio {index}', currency='NZD')
+        with patch('investments.api.get_exchange_rates', return_value=self.rates):
+            fx.get_rates()
+            response = client.get(reverse('list_portfolios'))
+            assert response.context['portfolios'][0].portfolio_value == 1150.0
+            # Session, user, cache versions and at most one cache read, however many portfolios
+            with django_assert_max_num_queries(4):
+                response = client.get(reverse('list_portfolios'))
+        assert len(response.context['portfolios']) == 6
+        assert b'3 assets' in response.content
+
+    def test_dashboard_endpoints(self, client, user, holdings):
+        client.force_login(user)
+        with patch('investments.api.get_exchange_rates', return_value=self.rates):
+            regions = client.get(reverse('geographic_distribution_data')).json()
+            categories = client.get(reverse('asset_types_data')).json()
+        assert regions[0] == {'region': 'Other', 'total_value': 1000.0}
+        assert {'category': 'Aggressive', 'total_value': 50.0} in categories
+
+
+# Holdings Snapshot Tests
+@pytest.mark.django_db
+class TestHoldingsSnapshot:
+    def test_widgets_share_one_snapshot(self, client, user, portfolio, portfolio_asset):
+        client.force_login(user)
+        with patch.object(snapshot.HoldingsSnapshot, 'build', wraps=snapshot.HoldingsSnapshot.build) as mock_build:
+            client.get(reverse('dashboard'))
+            regions = client.get(reverse('geographic_distribution_data')).json()
+            categories = client.get(reverse('asset_types_data')).json()
+        assert mock_build.call_count == 1
+        assert regions == [{'region': 'Other', 'total_value': 1000.0}]
+        assert {'category': 'Passive', 'total_value': 1000.0} in categories
+
+    def test_snapshot_totals(self, user, portfolio, portfolio_asset):
+        holdings = snapshot.get_holdings_snapshot(user)
+        assert holdings.total_value == Decimal('1000')
+        assert holdings.top_assets()[0]['symbol'] == 'TEST'
+        assert holdings.category_totals() == {'Aggressive': Decimal('0'), 'Passive': Decimal('1000')}
+
+    def test_snapshot_follows_user_version(self, user, portfolio, portfolio_asset):
+        assert snapshot.get_holdings_snapshot(user).total_value == Decimal('1000')
+        PortfolioAsset.objects.filter(id=portfolio_asset.id).update(position=20)
+        assert snapshot.get_holdings_snapshot(user).total_value == Decimal('1000')
+        versions.bump_user_version(user.id)
+        assert snapshot.get_holdings_snapshot(user).total_value == Decimal('2000')
+
+
+# Cache Versioning Tests
+@pytest.mark.django_db
+class TestCacheVersions:
+    def test_position_edit_bumps_user_version(self, user, portfolio, portfolio_asset):
+        key = versions.user_cache_key(user.id, 'holdings')
+        portfolio_asset.position = 20
+        portfolio_asset.save()
+        assert versions.user_cache_key(user.id, 'holdings') != key
+        assert snapshot.get_holdings_snapshot(user).total_value == Decimal('2000')
+
+    def test_price_refresh_bumps_price_epoch(self, user, portfolio, portfolio_asset, asset):
+        assert snapshot.get_holdings_snapshot(user).total_value == Decimal('1000')
+        with patch('investments.utils.api.get_asset_data', return_value={'TEST': {'latest_price': 150}}):
+            utils.update_all_assets()
+        assert snapshot.get_holdings_snapshot(user).total_value == Decimal('1500')
+
+    def test_dashboard_reflects_new_portfolio(self, client, user, portfolio, portfolio_asset, asset):
+        client.force_login(user)
+        assert client.get(reverse('dashboard')).context['total_value'] == Decimal('1000')
+        other = Portfolio.objects.create(user=user, name='Second', currency='USD')
+        PortfolioAsset.objects.create(portfolio=other, asset=asset, position=5)
+        assert client.get(reverse('dashboard')).context['total_value'] == Decimal('1500')
+
+    def test_bumped_versions_are_stored_in_table(self, user):
+        versions.bump_user_version(user.id)
+        versions.bump_user_version(user.id)
+        cache.clear()
+        assert CacheVersion.objects.get(name=versions.USER_VERSION_KEY.format(user_id=user.id)).version == 2
+
+    def test_versions_survive_many_cache_entries(self, user):
+        versions.bump_price_epoch()
+        versions.bump_price_epoch()
+        key = versions.user_cache_key(user.id, 'value_history')
+        cache.set_many({f'user_{index}_filler': index for index in range(400)})
+        assert versions.get_versions([versions.PRICE_EPOCH_KEY]) == {versions.PRICE_EPOCH_KEY: 2}
+        assert versions.user_cache_key(user.id, 'value_history') == key
+
+    def test_bulk_bump_is_set_based_and_increments(self, user, django_assert_max_num_queries):
+        versions.bump_user_version(user.id)
+        user_ids = [user.id] + list(range(10000, 11500))
+        # Inserts of the missing counters and one increment per thousand users, not statements per user
+        with django_assert_max_num_queries(8):
+            versions.bump_user_versions(user_ids)
+        stored = versions.get_versions([versions.USER_VERSION_KEY.format(user_id=user_id) for user_id in (user.id, 10000, 11499)])
+        assert sorted(stored.values()) == [1, 1, 2]
+
+# Two-Tier Cache Tests
+@pytest.mark.django_db
+class TestTwoTierCache:
+    def test_local_tier_serves_repeat_reads(self):
+        compute = lambda: {'value': 1}
+        assert caching.get_or_set('two_tier_test', compute, 60) == {'value': 1}
+        with patch('investments.caching.cache.get') as mock_get:
+            assert caching.get_or_set('two_tier_test', compute, 60) == {'value': 1}
+        mock_get.assert_not_called()
+
+    def test_stale_value_served_while_another_worker_recomputes(self):
+        caching.get_or_set('two_tier_test', lambda: 'old', 60)
+        value, expires_at, compute_time = cache.get('two_tier_test')
+        cache.set('two_tier_test', (value, expires_at - 120, compute_time), 60)
+        caching.clear_local()
+        cache.add('two_tier_test_lock', True, 30)  # Another worker holds the lock
+        assert caching.get_or_set('two_tier_test', lambda: 'new', 60) == 'old'
+        cache.delete('two_tier_test_lock')
+        caching.clear_local()
+        assert caching.get_or_set('two_tier_test', lambda: 'new', 60) == 'new'
+
+    def test_early_refresh_probability(self):
+        now = time.time()
+        assert not caching.should_refresh_early(now + 3600, compute_time=0.01)
+        assert caching.should_refresh_early(now - 1, compute_time=0.01)
+
+
+# Bulk Total Value History Tests
+@pytest.mark.django_db
+class TestBulkValueHistory:
+    def test_one_entry_per_user_per_day(self, user, portfolio, portfolio_asset, django_assert_max_num_queries):
+        others = [User.objects.create_user(username=f'bulk{i}', email=f'bulk{i}@example.com', password='12345') for i in range(3)]
+        with patch('investments.api.get_exchange_rates', return_value={'USD': Decimal('1')}):
+            fx.get_rates()
+            # A count, then per chunk of two users: ids, holdings, one upsert, two version bump statements,
+            # and a final empty page
+            with django_assert_max_num_queries(1 + 2 * 5 + 1):
+                assert utils.update_all_total_value_history(chunk_size=2) == 4
+            PortfolioAsset.objects.filter(id=portfolio_asset.id).update(position=20)
+            utils.update_all_total_value_history(chunk_size=2)
+            utils.update_total_value_history(user)
+
+        assert TotalValueHistory.objects.count() == 4
+        entry = TotalValueHistory.objects.get(user=user)
+        assert entry.total_value == Decimal('2000')
+        assert entry.timestamp == utils.get_history_timestamp(timezone.localdate())
+        assert TotalValueHistory.objects.get(user=others[0]).total_value == 0
+
+    def test_every_entry_has_a_day(self, user):
+        timestamp = utils.get_history_timestamp(timezone.localdate()) + timedelta(hours=9)
+        assert TotalValueHistory.objects.create(user=user, timestamp=timestamp, total_value=1).day == timezone.localdate()
+        with pytest.raises(IntegrityError), transaction.atomic():
+            TotalValueHistory.objects.bulk_create([TotalValueHistory(user=user, timestamp=timestamp, total_value=2)])
+        assert history.deduplicate_history() == 0
+        utils.write_total_values({user.id: Decimal(5)})
+        assert TotalValueHistory.objects.get(user=user).total_value == Decimal('5')
+
+    def test_dedupe_keeps_latest_entry_per_day(self, user):
+        today = timezone.localdate()
+        utils.write_total_values({user.id: Decimal(1)}, today - timedelta(days=1))
+        utils.write_total_values({user.id: Decimal(2)}, today)
+        morning = utils.get_history_timestamp(today - timedelta(days=2)) + timedelta(hours=9)
+        # Entries written before the day column existed, older than the dated ones
+        undated = [
+            (-1, user.id, None, utils.get_history_timestamp(today - timedelta(days=1)) + timedelta(hours=9)),
+            (-2, user.id, None, morning),
+            (-3, user.id, None, morning + timedelta(hours=1)),
+        ]
+        dated = TotalValueHistory.objects.filter(user=user).order_by('updated_at', 'timestamp', 'id')\
+            .values_list('id', 'user_id', 'day', 'timestamp')
+
+        duplicate_ids, backfill = history.select_duplicates(undated + list(dated))
+        assert sorted(duplicate_ids) == [-2, -1]
+        assert backfill == {-3: today - timedelta(days=2)}
+
+    def test_command_reports_users(self, user, tmp_path):
+        out = StringIO()
+        call_command('update_total_value_history', chunk_size=10, report_dir=str(tmp_path), stdout=out)
+        assert 'for 1 users' in out.getvalue()
+
+
+# Sharded Batch Tests
+@pytest.mark.django_db
+class TestSharding:
+    def test_hash_shards_split_without_overlap(self):
+        symbols = [f'SYM{i}' for i in range(200)]
+        shards = [(index, 3) for index in range(3)]
+        owners = [[shard for shard in shards if sharding.symbol_in_shard(symbol, shard)] for symbol in symbols]
+        assert all(len(owner) == 1 for owner in owners)
+        for shard in shards:
+            own = {symbol for symbol in symbols if sharding.symbol_in_shard(symbol, shard)}
+            parts = [{symbol for symbol in symbols if sharding.symbol_in_shard(symbol, part)}
+                     for part in sharding.split_hash_shard(shard, 4)]
+            assert set().union(*parts) == own
+            assert sum(len(part) for part in parts) == len(own)
+
+    def test_id_ranges_cover_all_ids(self):
+        assert sharding.split_id_range((1, 11), 3) == [(1, 4), (4, 7), (7, 11)]
+        with pytest.raises(argparse.ArgumentTypeError):
+            sharding.parse_shard('2/2')
+        assert sharding.parse_shard('1/4') == (1, 4)
+
+    def test_asset_shards_update_each_asset_once(self, tmp_path):
+        for i in range(6):
+            Asset.objects.create(name=f'Asset {i}', symbol=f'S{i}', asset_type='ETF', latest_price=1, currency='USD')
+        fetched = []
+
+        def fake_get_asset_data(symbols):
+            fetched.extend(symbols)
+            return {symbol: {'latest_price': 2} for symbol in symbols}
+
+        with patch('investments.api.get_asset_data', side_effect=fake_get_asset_data):
+            reports = [batch.update_assets(shard=(index, 2), chunk_size=2) for index in range(2)]
+
+        assert sorted(fetched) == [f'S{i}' for i in range(6)]
+        assert sum(report['updated'] for report in reports) == 6
+        path = batch.write_report(reports[0], str(tmp_path))
+        assert json.load(open(path))['shard'] == '0/2'
+
+    def test_history_shards_split_users_by_id(self, user):
+        others = [User.objects.create_user(username=f'shard{i}', email=f'shard{i}@example.com', password='12345')
+                  for i in range(3)]
+        reports = [batch.update_total_value_history(shard=(index, 2)) for index in range(2)]
+        assert [report['updated'] for report in reports] == [2, 2]
+        assert TotalValueHistory.objects.filter(user__in=[user, *others]).count() == 4
+
+
+    def test_commands_report_progress_and_reject_no_workers(self, user, tmp_path):
+        out = StringIO()
+        call_command('update_total_value_history', chunk_size=1, report_dir=str(tmp_path), stdout=out)
+        assert 'Processed 1/1 users' in out.getvalue()
+        with pytest.raises(CommandError):
+            call_command('update_assets', workers=0, report_dir=str(tmp_path), stdout=StringIO())
+        with pytest.raises(CommandError):
+            call_command('update_total_value_history', workers=0, report_dir=str(tmp_path), stdout=StringIO())
+        assert len(list(tmp_path.iterdir())) == 1
+
+    def test_worker_progress_is_relayed(self):
+        updates = queue.Queue()
+        batch.QueueProgress(updates, 1)(2, 4)
+        updates.put(None)
+        received = []
+        batch.relay_progress(updates, lambda *args: received.append(args))
+        assert received == [(1, 2, 4)]
+
+
+# Value History Rollup Tests
+@pytest.mark.django_db
+class TestValueHistoryRollups:
+    @pytest.fixture
+    def daily_history(self, user):
+        today = timezone.localdate()
+        utils.upsert_history_entries([
+            TotalValueHistory(user=user, day=today - timedelta(days=days),
+                              timestamp=utils.get_history_timestamp(today - timedelta(days=days)), total_value=1000 + days)
+            for days in range(1000)
+        ])
+
+    def test_points_are_capped(self, user, daily_history, settings):
+        settings.VALUE_HISTORY = {'MAX_POINTS': 50, 'DAILY_RETENTION_DAYS': 2000}
+        points = history.get_history_points(user, 'all', 'day')
+        assert len(points) == 50
+        assert points[-1][1] == 1000  # Downsampling keeps the latest value
+        assert len(history.get_history_points(user, '1m')) == 32
+        assert len(history.get_history_points(user, 'all', 'week')) == 50
+
+    def test_compaction_keeps_closing_values(self, user, daily_history, settings):
+        settings.VALUE_HISTORY = {'MAX_POINTS': 500, 'DAILY_RETENTION_DAYS': 2000}
+        monthly_before = history.get_history_points(user, 'all', 'month')
+        weekly_before = history.get_history_points(user, 'all', 'week')
+
+        settings.VALUE_HISTORY = {'MAX_POINTS': 500, 'DAILY_RETENTION_DAYS': 100}
+        assert history.compact_history() == 899
+        assert TotalValueHistory.objects.filter(user=user).count() == 101
+        assert history.get_history_points(user, 'all', 'month') == monthly_before
+        assert history.get_history_points(user, 'all', 'week') == weekly_before
+
+    def test_compaction_deletes_in_one_statement(self, user, daily_history, settings):
+        settings.VALUE_HISTORY = {'MAX_POINTS': 500, 'DAILY_RETENTION_DAYS': 100}
+        with CaptureQueriesContext(connection) as queries:
+            assert history.compact_history() == 899
+        statements = [query['sql'] for query in queries.captured_queries]
+        assert len([sql for sql in statements if sql.startswith('DELETE')]) == 1
+        assert len([sql for sql in statements if 'investments_cacheversion' in sql]) <= 2  # One bump per chunk
+
+    def test_view_validates_parameters(self, client, user, daily_history):
+        client.force_login(user)
+        response = client.get(reverse('value_history_data'), {'range': '3m', 'resolution': 'week'})
+        assert response.status_code == 200
+        assert 13 <= len(response.json()) <= 15
+        assert client.get(reverse('value_history_data'), {'range': '2w'}).status_code == 400
+
+
+# Conditional GET Tests
+@pytest.mark.django_db
+class TestConditionalGet:
+    def test_history_since_and_etag(self, client, user):
+        today = timezone.localdate()
+        for days in range(3):
+            utils.write_total_values({user.id: Decimal(100 + days)}, today - timedelta(days=days))
+        client.force_login(user)
+
+        response = client.get(reverse('value_history_data'))
+        assert len(response.json()) == 3
+        assert response.has_header('Last-Modified')
+        etag = response['ETag']
+        assert client.get(reverse('value_history_data'), HTTP_IF_NONE_MATCH=etag).status_code == 304
+
+        since = response.json()[-1]['timestamp']
+        assert client.get(reverse('value_history_data'), {'since': since}).json() == [{'timestamp': since, 'total_value': 100.0}]
+        assert client.get(reverse('value_history_data'), {'since': 'yesterday'}).status_code == 400
+
+        utils.write_total_values({user.id: Decimal(150)}, today)
+        response = client.get(reverse('value_history_data'), HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        assert response.json()[-1]['total_value'] == 150.0
+
+    def test_history_since_revalidates(self, client, user):
+        utils.write_total_values({user.id: Decimal(100)})
+        client.force_login(user)
+        since = client.get(reverse('value_history_data')).json()[0]['timestamp']
+
+        response = client.get(reverse('value_history_data'), {'since': since})
+        latest = TotalValueHistory.objects.get(user=user).updated_at
+        assert response['Last-Modified'] == http_date(latest.timestamp())
+        assert client.get(reverse('value_history_data'), {'since': since},
+                          HTTP_IF_NONE_MATCH=response['ETag']).status_code == 304
+        assert client.get(reverse('value_history_data'), {'since': since},
+                          HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code == 304
+
+        utils.write_total_values({user.id: Decimal(150)})
+        response = client.get(reverse('value_history_data'), {'since': since}, HTTP_IF_NONE_MATCH=response['ETag'])
+        assert response.json() == [{'timestamp': since, 'total_value': 150.0}]
+
+    def test_holdings_endpoints_revalidate(self, client, user, portfolio, portfolio_asset):
+        client.force_login(user)
+        for name in ('geographic_distribution_data', 'asset_types_data'):
+            response = client.get(reverse(name))
+            assert client.get(reverse(name), HTTP_IF_NONE_MATCH=response['ETag']).status_code == 304
+            assert client.get(reverse(name), HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code == 304
+
+        PortfolioAsset.objects.filter(id=portfolio_asset.id).update(position=20)
+        versions.bump_user_version(user.id)
+        assert client.get(reverse('asset_types_data'), HTTP_IF_NONE_MATCH=response['ETag']).status_code == 200
+
+
+# Price History Backfill Tests
+@pytest.mark.django_db
+class TestPriceHistoryBackfill:
+    start = date(2024, 1, 1)  # A Monday
+    end = date(2024, 1, 7)
+
+    def test_download_uses_one_request_per_chunk(self, asset):
+        Asset.objects.create(name='Other', symbol='OTH', asset_type='ETF', latest_price=5, currency='USD')
+        with patch('investments.api.get_price_history', wraps=lambda symbols, start, end: {
+            symbol: {start: Decimal('10'), end: Decimal('11')} for symbol in symbols
+        }) as mock_history:
+            assert prices.download_price_history(self.start, self.end, chunk_size=10) == 4
+        assert mock_history.call_count == 1
+        assert AssetPrice.objects.get(asset=asset, date=self.end).close == Decimal('11')
+
+    def test_local_provider_history_is_stable(self):
+        provider = LocalProvider()
+        history = provider.get_price_history(['AAPL'], self.start, self.end)
+        assert len(history['AAPL']) == 5  # Weekdays only
+        assert history == provider.get_price_history(['AAPL'], self.start, self.end)
+
+    def test_backfill_values_each_day(self, user, portfolio, portfolio_asset):
+        nzd_asset = Asset.objects.create(name='NZ', symbol='NZ', asset_type='ETF', latest_price=2, currency='NZD')
+        PortfolioAsset.objects.create(portfolio=portfolio, asset=nzd_asset, position=100)
+        AssetPrice.objects.bulk_create([
+            AssetPrice(asset=portfolio_asset.asset, date=date(2023, 12, 29), close=90),
+            AssetPrice(asset=portfolio_asset.asset, date=date(2024, 1, 3), close=110),
+            AssetPrice(asset=nzd_asset, date=date(2024, 1, 2), close=4),
+        ])
+        fx.store_rates(date(2024, 1, 1), {'USD': Decimal('1'), 'NZD': Decimal('2')})
+        fx.store_rates(date(2024, 1, 5), {'USD': Decimal('1'), 'NZD': Decimal('4')})
+        utils.write_total_values({user.id: Decimal('1')}, date(2024, 1, 7))
+
+        assert prices.backfill_history(self.start, self.end) == 6  # No NZ close on the 1st
+        values = dict(TotalValueHistory.objects.filter(user=user).values_list('day', 'total_value'))
+        assert values[date(2024, 1, 2)] == Decimal('1100')  # 10 x 90 carried over + 100 x 4 NZD / 2
+        assert values[date(2024, 1, 3)] == Decimal('1300')
+        assert values[date(2024, 1, 6)] == Decimal('1200')  # NZD rate changed on the 5th
+        assert values[date(2024, 1, 7)] == Decimal('1')  # Existing entries are kept
+
+        prices.backfill_history(self.start, self.end, overwrite=True)
+        assert TotalValueHistory.objects.get(user=user, day=date(2024, 1, 7)).total_value == Decimal('1200')
+
+    def test_backfill_values_are_exact_units(self, user, asset):
+        AssetPrice.objects.create(asset=asset, date=self.start, close=Decimal('10000.0001'))
+        fx.store_rates(self.start, {'USD': Decimal('1'), 'NZD': Decimal('3')})
+        holdings = [(user.id, asset.id, 99999999, 'USD', 'USD'), (user.id, asset.id, 1, 'USD', 'NZD')]
+
+        _, totals, complete = prices.value_user_days(holdings[:1], self.start, self.start)
+        assert totals.dtype == np.int64
+        assert totals[0, 0] == 100000001 * 99999999  # Past 2 ** 53, a float valuation would round it
+        assert complete.all()
+
+        _, totals, _ = prices.value_user_days(holdings[1:], self.start, self.start)
+        assert totals[0, 0] == 300000003
+
+
+# Dashboard Endpoint Tests
+@pytest.mark.django_db
+class TestDashboardEndpoint:
+    def test_one_request_returns_every_widget(self, client, user, portfolio, portfolio_asset):
+        utils.write_total_values({user.id: Decimal(100)})
+        client.force_login(user)
+
+        with patch('investments.views.get_holdings_snapshot', wraps=snapshot.get_holdings_snapshot) as get_snapshot:
+            response = client.get(reverse('dashboard_data'))
+        assert get_snapshot.call_count == 1
+        payload = response.json()
+        assert set(payload) == {'currency', 'total_value', 'top_assets', 'history', 'regions', 'categories'}
+        assert payload['history'][-1]['total_value'] == 100.0
+        assert payload['categories'] == client.get(reverse('asset_types_data')).json()
+        assert payload['regions'] == client.get(reverse('geographic_distribution_data')).json()
+
+        assert client.get(reverse('dashboard_data'), HTTP_IF_NONE_MATCH=response['ETag']).status_code == 304
+
+    def test_dashboard_embeds_payload(self, client, user, portfolio, portfolio_asset, settings):
+        client.force_login(user)
+        response = client.get(reverse('dashboard'))
+        assert response.context['dashboard_payload']['total_value'] == pytest.approx(float(snapshot.get_holdings_snapshot(user).total_value))
+        assert b'id="dashboard-data"' in response.content
+
+        settings.DASHBOARD_INLINE_PAYLOAD = False
+        response = client.get(reverse('dashboard'))
+        assert 'dashboard_payload' not in response.context
+        assert b'id="dashboard-data"' not in response.content
+
+
+# JSON Response Cache Tests
+@pytest.mark.django_db
+class TestJsonResponseCache:
+    def test_hit_reuses_serialized_body(self, client, user, portfolio, portfolio_asset):
+        client.force_login(user)
+        with patch('investments.responses.build_body', wraps=responses.build_body) as build_body:
+            first = client.get(reverse('asset_types_data'))
+            second = client.get(reverse('asset_types_data'))
+        assert build_body.call_count == 1
+        assert first.content == second.content
+        assert first['ETag'].startswith('"') and first['ETag'] == second['ETag']
+        assert first['Cache-Control'] == 'private, max-age=30'
+        assert client.get(reverse('asset_types_data'), HTTP_IF_NONE_MATCH=first['ETag']).status_code == 304
+
+        versions.bump_user_version(user.id)
+        with patch('investments.responses.build_body', wraps=responses.build_body) as build_body:
+            client.get(reverse('asset_types_data'))
+        assert build_body.call_count == 1
+
+    def test_large_bodies_are_gzipped(self, client, user, settings):
+        settings.JSON_RESPONSE_CACHE = {'MAX_AGE': 30, 'GZIP_MIN_SIZE': 100}
+        today = timezone.localdate()
+        for days in range(30):
+            utils.write_total_values({user.id: Decimal(100 + days)}, today - timedelta(days=days))
+        client.force_login(user)
+
+        plain = client.get(reverse('value_history_data'))
+        assert not plain.has_header('Content-Encoding')
+        assert 'Accept-Encoding' in plain['Vary']
+        zipped = client.get(reverse('value_history_data'), HTTP_ACCEPT_ENCODING='gzip, deflate')
+        assert zipped['Content-Encoding'] == 'gzip'
+        assert len(zipped.content) < len(plain.content)
+        assert zipped['ETag'] != plain['ETag']
+        assert client.get(reverse('value_history_data'), HTTP_ACCEPT_ENCODING='gzip',
+                          HTTP_IF_NONE_MATCH=zipped['ETag']).status_code == 304
+
+    def test_errors_are_not_cached(self, client, user, portfolio, portfolio_asset):
+        client.force_login(user)
+        with patch('investments.views.get_category_data', side_effect=RuntimeError('boom')):
+            response = client.get(reverse('asset_types_data'))
+        assert response.status_code == 500
+        assert response.json() == []
+        assert client.get(reverse('asset_types_data')).json() != []
+
+    def test_since_variants_are_not_cached(self, client, user):
+        utils.write_total_values({user.id: Decimal(100)})
+        client.force_login(user)
+        since = client.get(reverse('value_history_data')).json()[0]['timestamp']
+        with patch('investments.responses.cached_json_response') as cached_json_response:
+            response = client.get(reverse('value_history_data'), {'since': since})
+        cached_json_response.assert_not_called()
+        assert response.json() == [{'timestamp': since, 'total_value': 100.0}]
+
+    def test_search_results_cached_per_query(self, client, user, portfolio, portfolio_asset):
+        client.force_login(user)
+        results = [{'symbol': portfolio_asset.asset.symbol, 'name': 'Test'}]
+        with patch('investments.views.search.search_with_status', side_effect=lambda query: ([dict(r) for r in results], True)) as search_assets:
+            response = client.get(reverse('search_assets'), {'q': 'test', 'portfolio_id': portfolio.id})
+            client.get(reverse('search_assets'), {'q': 'test', 'portfolio_id': portfolio.id})
+            client.get(reverse('search_assets'), {'q': 'other', 'portfolio_id': portfolio.id})
+        assert search_assets.call_count == 2
+        assert response.json()['results'][0]['exists_in_portfolio'] is True
+
+    def test_search_is_not_cached_while_upstream_fails(self, client, user):
+        client.force_login(user)
+        upstream = [{'symbol': 'NVDA', 'name': 'NVIDIA Corporation', 'exchange': 'NMS', 'asset_type': 'EQUITY'}]
+        with patch('investments.api.get_provider') as get_provider:
+            get_provider.return_value.search_assets.side_effect = [RuntimeError('rate limited'), upstream]
+            response = client.get(reverse('search_assets'), {'q': 'nvid'})
+            assert response.json()['results'][0]['symbol'] == 'No results found'
+            assert response['Cache-Control'] == 'no-store'
+            assert client.get(reverse('search_assets'), {'q': 'nvid'}).json()['results'][0]['symbol'] == 'NVDA'
+
+
+# Position Edit Tests
+@pytest.mark.django_db
+class TestPositionEdits:
+    rates = {'USD': Decimal('1'), 'NZD': Decimal('2')}
+
+    @pytest.fixture
+    def holdings(self, portfolio):
+        assets = Asset.objects.bulk_create([
+            Asset(name=f'Asset {index}', symbol=f'A{index}', asset_type='ETF', latest_price=4, currency='NZD')
+            for index in range(50)
+        ])
+        return PortfolioAsset.objects.bulk_create([
+            PortfolioAsset(portfolio=portfolio, asset=asset, position=1) for asset in assets
+        ])
+
+    def post(self, client, portfolio, rows):
+        return client.post(reverse('portfolio_detail', kwargs={'portfolio_id': portfolio.id}),
+                           json.dumps({'assets': rows}), content_type='application/json')
+
+    def test_bulk_edit_in_portfolio_currency(self, client, user, portfolio, holdings, django_assert_max_num_queries):
+        client.force_login(user)
+        rows = [{'id': holding.id, 'position': 10} for holding in holdings]
+        with patch('investments.api.get_exchange_rates', return_value=self.rates):
+            fx.get_rates()
+            # A fixed number of queries and cache round trips, not one or two per edited row
+            with django_assert_max_num_queries(26):
+                response = self.post(client, portfolio, rows)
+
+        data = response.json()
+        assert data['success'] is True
+        assert data['portfolio_value'] == 1000.0  # 50 x 10 x 4 NZD in USD
+        assert data['updated_assets'][0] == {'id': holdings[0].id, 'market_value': 40.0, 'asset_ratio': 2.0}
+        assert set(PortfolioAsset.objects.filter(portfolio=portfolio).values_list('position', flat=True)) == {10}
+
+    def test_invalid_rows_write_nothing(self, client, user, portfolio, holdings):
+        client.force_login(user)
+        rows = [{'id': holdings[0].id, 'position': 5}, {'id': holdings[1].id, 'position': 'many'}]
+        assert self.post(client, portfolio, rows).status_code == 400
+        other = Portfolio.objects.create(user=user, name='Other', currency='USD')
+        rows = [{'id': holdings[0].id, 'position': 5}]
+        assert self.post(client, other, rows).status_code == 400
+        assert PortfolioAsset.objects.get(id=holdings[0].id).position == 1
+
+
+# Job Queue Tests
+@pytest.mark.django_db
+class TestJobQueue:
+    def test_enqueue_collapses_pending_jobs(self, user):
+        jobs.enqueue_total_value_update(user.id, priority=0)
+        jobs.enqueue_total_value_update(user.id, priority=5)
+        jobs.enqueue_total_value_update(user.id, priority=1)
+        assert list(Job.objects.values_list('status', 'priority')) == [('pending', 5)]
+
+        Job.objects.update(status='running')
+        jobs.enqueue_total_value_update(user.id)
+        assert Job.objects.filter(status='pending').count() == 1
+
+    def test_jobs_run_by_priority(self, user):
+        order = []
+        with patch.dict(jobs.HANDLERS, {'record': lambda name: order.append(name)}):
+            jobs.enqueue('record', 'low', {'name': 'low'}, priority=0)
+            jobs.enqueue('record', 'high', {'name': 'high'}, priority=10)
+            jobs.enqueue('record', 'later', {'name': 'later'}, priority=20, delay=60)
+            assert jobs.run_pending() == (2, 0)
+        assert order == ['high', 'low']
+        assert list(Job.objects.values_list('key', flat=True)) == ['later']
+
+    def test_failed_jobs_retry_then_fail(self, user, settings):
+        settings.JOB_QUEUE = {**settings.JOB_QUEUE, 'MAX_ATTEMPTS': 2, 'RETRY_DELAY': 30}
+        with patch.dict(jobs.HANDLERS, {'broken': lambda: 1 / 0}):
+            jobs.enqueue('broken', 'broken')
+            assert jobs.run_pending() == (0, 1)
+            job = Job.objects.get()
+            assert (job.status, job.attempts) == ('pending', 1)
+            assert job.run_after > timezone.now() + timedelta(seconds=25)
+
+            Job.objects.update(run_after=timezone.now())
+            assert jobs.run_pending() == (0, 1)
+        job = Job.objects.get()
+        assert (job.status, job.attempts, job.last_error) == ('failed', 2, 'division by zero')
+
+    def test_stale_running_jobs_are_requeued(self, user):
+        jobs.enqueue_total_value_update(user.id)
+        Job.objects.update(status='running', locked_at=timezone.now() - timedelta(hours=1))
+        assert jobs.requeue_stale_jobs() == 1
+        assert Job.objects.get().status == 'pending'
+
+    def test_views_enqueue_and_worker_records_value(self, client, user, portfolio, portfolio_asset):
+        client.force_login(user)
+        with patch('investments.utils.update_total_value_history') as update:
+            response = client.post(reverse('portfolio_detail', kwargs={'portfolio_id': portfolio.id}),
+                                   json.dumps({'assets': [{'id': portfolio_asset.id, 'position': 20}]}),
+                                   content_type='application/json')
+        assert response.json()['success'] is True
+        update.assert_not_called()
+        assert Job.objects.filter(kind='update_total_value_history', status='pending').count() == 1
+
+        call_command('run_jobs', once=True, stdout=StringIO())
+        assert not Job.objects.exists()
+        assert TotalValueHistory.objects.get(user=user).total_value == Decimal('2000')
+
+
+# Batched Asset Addition Tests
+@pytest.mark.django_db
+class TestBatchedAddAssets:
+    @staticmethod
+    def fetch(symbols):
+        data = {
+            symbol: {'name': f'{symbol} Inc.', 'asset_type': 'EQUITY', 'latest_price': Decimal('12.5'), 'currency': 'USD'}
+            for symbol in symbols if symbol != 'BAD'
+        }
+        return data, {'BAD': 'Not found'} if 'BAD' in symbols else {}
+
+    def test_symbols_resolved_in_one_batch(self, client, user, portfolio, portfolio_asset):
+        fresh = Asset.objects.create(name='Fresh', symbol='FRESH', asset_type='ETF', latest_price=5, currency='USD')
+        stale = Asset.objects.create(name='Stale', symbol='STALE', asset_type='ETF', latest_price=None, currency='USD')
+        symbols = [f'NEW{index}' for index in range(30)] + ['FRESH', 'STALE', 'BAD', 'TEST', 'NEW0']
+        client.force_login(user)
+
+        with patch('investments.utils.api.get_asset_data_with_failures', side_effect=self.fetch) as fetch:
+            with CaptureQueriesContext(connection) as queries:
+                response = client.post(reverse('add_assets', kwargs={'portfolio_id': portfolio.id}),
+                                       json.dumps({'assets': [{'symbol': symbol, 'quantity': 3} for symbol in symbols]}),
+                                       content_type='application/json')
+        fetch.assert_called_once()
+        # A fixed number of table queries, the rest are cache version bumps
+        table_queries = [query for query in queries.captured_queries
+                          if 'investments_' in query['sql'] and 'investments_cacheversion' not in query['sql']]
+        assert len(table_queries) == 8
+        assert sorted(fetch.call_args.args[0]) == sorted([f'NEW{index}' for index in range(30)] + ['STALE', 'BAD'])
+
+        data = response.json()
+        assert [asset['symbol'] for asset in data['added_assets']] == symbols[:32]
+        assert [asset['symbol'] for asset in data['existing_assets']] == ['TEST', 'NEW0']
+        assert data['failed_assets'] == [{'symbol': 'BAD', 'error': 'Not found'}]
+        assert PortfolioAsset.objects.filter(portfolio=portfolio).count() == 33
+        stale.refresh_from_db()
+        assert stale.latest_price == Decimal('12.5')
+        assert Asset.objects.get(id=fresh.id).latest_price == 5
+        assert snapshot.get_holdings_snapshot(user).total_value == Decimal('1000') + 31 * 3 * Decimal('12.5') + 15
@@ -3,6 +3,7 @@ from . import views
 
 urlpatterns = [
     path('dashboard/', views.dashboard, name='dashboard'),
+    path('api/dashboard/', views.dashboard_data, name='dashboard_data'),
     path('api/value-history/', views.value_history_data, name='value_history_data'),
     path('api/geographic-distribution/', views.geographic_distribution_data, name='geographic_distribution_data'),
     path('api/asset-types/', views.asset_types_data, name='asset_types_data'),
@@ -1,8 +1,15 @@
 import logging
+from datetime import datetime, time, timedelta
 from decimal import Decimal
 from . import api
-from .models import Portfolio, PortfolioAsset, Asset, TotalValueHistory
-from django.core.cache import cache
+from . import caching
+from . import fx
+from . import sharding
+from . import valuation
+from . import versions
+from .models import PortfolioAsset, Asset, TotalValueHistory
+from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.db import transaction
 from django.utils import timezone
 
@@ -78,21 +85,12 @@ def get_asset_value_in_portfolio_currency(portfolio_asset):
 
 def get_portfolio_value(portfolio):
     """Calculate the total value of the portfolio in the portfolio currency"""
-    cache_key = f'portfolio_value_{portfolio.id}'
-    cached_value = cache.get(cache_key)
-    if cached_value is not None:
-        return cached_value
-
-    portfolio_value = Decimal(0)
-    for portfolio_asset in portfolio.portfolio_assets.all():
-        asset_converted_value = get_asset_value_in_portfolio_currency(portfolio_asset)
-        if asset_converted_value:
-            portfolio_value += asset_converted_value
-        else:
-            logger.error(f"Error converting currency for asset: {portfolio_asset.asset.name} ({portfolio_asset.asset.symbol})")
-    
-    cache.set(cache_key, portfolio_value, 5)  # Cache for 5 seconds
-    return portfolio_value
+    def compute():
+        portfolio_valuation = valuation.Valuation.load(portfolio.portfolio_assets.all())
+        return portfolio_valuation.portfolio_values().get(portfolio.id, Decimal(0))
+
+    cache_key = versions.user_cache_key(portfolio.user_id, f'portfolio_value_{portfolio.id}_{portfolio.currency}')
+    return caching.get_or_set(cache_key, compute, versions.get_cache_ttl())
 
 
 def get_asset_ratio(portfolio_asset):
@@ -105,14 +103,33 @@ def get_asset_ratio(portfolio_asset):
     return asset_ratio
 
 
-def refresh_portfolio_data(portfolio):
-    portfolio_assets = PortfolioAsset.objects.filter(portfolio=portfolio).select_related('asset')
-    total_value = sum(asset.position * asset.asset.latest_price for asset in portfolio_assets)
-    
-    updates = []
+def refresh_portfolio_data(portfolio, portfolio_assets=None):
+    """
+    Return the portfolio value and each holding's market value and ratio for the detail page.
+    Market values stay in the asset currency, the portfolio value and ratios are in the portfolio currency.
+    Pass already loaded holdings (with their assets) to skip the query.
+    """
+    if portfolio_assets is None:
+        portfolio_assets = PortfolioAsset.objects.filter(portfolio=portfolio).select_related('asset')
+
+    rates = {}
+    values = []
     for asset in portfolio_assets:
-        market_value = asset.position * asset.asset.latest_price
-        asset_ratio = (market_value / total_value) * 100 if total_value else 0
+        market_value = asset.position * (asset.asset.latest_price or 0)
+        currency = asset.asset.currency
+        if currency not in rates:
+            rates[currency] = fx.get_rate(currency, portfolio.currency) if currency != portfolio.currency else Decimal(1)
+        if rates[currency] is None:
+            logger.error(f"Could not convert {currency} to {portfolio.currency} for portfolio {portfolio.id}")
+            converted_value = Decimal(0)
+        else:
+            converted_value = market_value * rates[currency]
+        values.append((asset, market_value, converted_value))
+    total_value = sum((converted_value for _, _, converted_value in values), Decimal(0))
+
+    updates = []
+    for asset, market_value, converted_value in values:
+        asset_ratio = (converted_value / total_value) * 100 if total_value else 0
         updates.append({
             'id': asset.id,
             'market_value': float(market_value),
@@ -125,32 +142,62 @@ def refresh_portfolio_data(portfolio):
     }
 
 
-def convert_currency(amount, from_currency, to_currency):
-    """Convert the amount from one currency to another using the exchange rate"""
+def parse_position_edits(assets_data):
+    """Validate submitted [{id, position}] rows up front and return a {portfolio_asset_id: position} dict"""
+    edits = {}
+    for asset_data in assets_data:
+        try:
+            asset_id = int(asset_data['id'])
+            position = int(asset_data['position'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"Invalid asset row: {asset_data}")
+        if position < 0:
+            raise ValueError(f"Position must not be negative for asset {asset_id}")
+        edits[asset_id] = position
+    return edits
+
+
+def update_positions(portfolio, edits):
+    """
+    Apply {portfolio_asset_id: position} edits to the portfolio in one bulk update and
+    return the portfolio's holdings with their assets, as written
+    """
+    portfolio_assets = list(PortfolioAsset.objects.filter(portfolio=portfolio).select_related('asset'))
+    unknown = set(edits) - {asset.id for asset in portfolio_assets}
+    if unknown:
+        raise ValueError(f"Assets {sorted(unknown)} are not in this portfolio")
+
+    changed = []
+    for asset in portfolio_assets:
+        if asset.id in edits and asset.position != edits[asset.id]:
+            asset.position = edits[asset.id]
+            changed.append(asset)
+
+    if changed:
+        with transaction.atomic():
+            PortfolioAsset.objects.bulk_update(changed, ['position'], batch_size=1000)
+        versions.bump_user_version(portfolio.user_id)  # bulk_update sends no signals
+    return portfolio_assets
+
+
+def convert_currency(amount, from_currency, to_currency, day=None):
+    """Convert the amount from one currency to another using the latest rate, or the rate on a past day"""
     if from_currency == to_currency:
         return Decimal(amount)
-    
-    cache_key = f'exchange_rate_{from_currency}_{to_currency}'
-    exchange_rate = cache.get(cache_key)
-    
+
+    if day is None:
+        exchange_rate = fx.get_rate(from_currency, to_currency)
+    else:
+        exchange_rate = fx.get_historical_rate(from_currency, to_currency, day)
     if exchange_rate is None:
-        exchange_rate = api.get_exchange_rate(from_currency, to_currency)
-        cache.set(cache_key, exchange_rate, 3600)  # Cache for 1 hour
+        return None
 
-    return amount * Decimal(str(exchange_rate))
+    return amount * exchange_rate
 
 
 def get_total_value(user):
     """Get the total value of all portfolios for the user in the user's currency"""
-    total_value = Decimal(0)
-    for portfolio in Portfolio.objects.filter(user=user):
-        portfolio_value = get_portfolio_value(portfolio)
-        converted_value = convert_currency(portfolio_value, portfolio.currency, user.default_currency)
-        if converted_value is not None:
-            total_value += converted_value
-        else:
-            logger.error(f"Error converting currency for portfolio: {portfolio.name}")
-    return total_value
+    return valuation.get_user_valuation(user).user_values().get(user.id, Decimal(0))
 
 
 def get_asset_value_in_user_currency(portfolio_asset, user):
@@ -160,56 +207,205 @@ def get_asset_value_in_user_currency(portfolio_asset, user):
     return converted_value
 
 
+def get_history_timestamp(day):
+    """History entries are stamped at the start of their day"""
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def upsert_history_entries(entries, batch_size=None):
+    """Insert history entries or update the existing entries for the same user and day, in one statement per batch"""
+    TotalValueHistory.objects.bulk_create(
+        entries,
+        batch_size=batch_size,
+        update_conflicts=True,
+        unique_fields=['user', 'day'],
+        update_fields=['timestamp', 'total_value', 'updated_at'],
+    )
+    versions.bump_user_versions({entry.user_id for entry in entries})  # bulk_create sends no signals
+
+
+def write_total_values(totals, day=None):
+    """Upsert one history entry per user for the day from a {user_id: total_value} dict"""
+    if not totals:
+        return 0
+    day = day or timezone.localdate()
+    timestamp = get_history_timestamp(day)
+    upsert_history_entries([
+        TotalValueHistory(user_id=user_id, day=day, timestamp=timestamp, total_value=total_value)
+        for user_id, total_value in totals.items()
+    ])
+    return len(totals)
+
+
 def update_total_value_history(user):
     """Update the total value history for the user"""
-    today = timezone.now().date()
-    
-    with transaction.atomic():
-        # Check if an entry already exists for today
-        existing_entry = TotalValueHistory.objects.filter(user=user, timestamp__date=today).first()
-        
-        total_value = get_total_value(user)
-        
-        if existing_entry:
-            # Update the existing entry if the value has changed
-            if existing_entry.total_value != total_value:
-                existing_entry.total_value = total_value
-                existing_entry.save()
-        else:
-            # Create a new entry if one doesn't exist for today
-            TotalValueHistory.objects.create(user=user, total_value=total_value, timestamp=timezone.now())
+    write_total_values({user.id: get_total_value(user)})
 
 
-def update_all_assets():
-    """Update the latest price for all existing assets in the database"""
-    assets = Asset.objects.all()
-    updated_count = 0
-    failed_count = 0
+def update_all_total_value_history(chunk_size=None, progress=None, id_range=None):
+    """
+    Record today's total value for every user, one holdings query and one upsert per chunk of users.
+    An optional [start, end) id range limits the update to one shard of users.
+    The optional progress callback receives (processed, total) after each chunk.
+    """
+    chunk_size = chunk_size or settings.HISTORY_UPDATE_CHUNK_SIZE
+    users = get_user_model().objects.order_by('id')
+    if id_range:
+        users = users.filter(id__gte=id_range[0], id__lt=id_range[1])
+    total = users.count()
+    today = timezone.localdate()
+    processed = 0
+    last_id = 0
+
+    # Page through the users by id so only one chunk of ids and holdings is held in memory at a time
+    while True:
+        user_ids = list(users.filter(id__gt=last_id).values_list('id', flat=True)[:chunk_size])
+        if not user_ids:
+            break
+        last_id = user_ids[-1]
+
+        holdings = PortfolioAsset.objects.filter(portfolio__user_id__gte=user_ids[0], portfolio__user_id__lte=last_id)
+        user_values = valuation.Valuation.load(holdings).user_values()
+        write_total_values({user_id: user_values.get(user_id, Decimal(0)) for user_id in user_ids}, today)
+
+        processed += len(user_ids)
+        if progress:
+            progress(processed, total)
+
+    return processed
+
+
+ASSET_UPDATE_FIELDS = ['latest_price', 'name', 'asset_type', 'currency', 'timezone_full_name', 'timezone_short_name', 'updated_at']
+
+
+def apply_asset_data(asset, data):
+    """Copy fetched API data onto an asset instance without saving it"""
+    asset.latest_price = data.get('latest_price')
+    asset.name = data.get('name') or data.get('long_name') or asset.name
+    asset.asset_type = data.get('asset_type') or asset.asset_type
+    asset.currency = data.get('currency') or asset.currency
+    asset.timezone_full_name = data.get('timezone_full_name') or asset.timezone_full_name
+    asset.timezone_short_name = data.get('timezone_short_name') or asset.timezone_short_name
+
+
+def resolve_assets(symbols):
+    """
+    Return ({symbol: asset}, {symbol: error}) for a batch of symbols. Unknown symbols and known assets
+    without a fresh price are fetched in one request, then written with one bulk update and one bulk insert.
+    Known assets whose refresh fails are still returned with their stored data.
+    """
+    symbols = list(dict.fromkeys(symbols))
+    assets = {}
+    for asset in Asset.objects.filter(symbol__in=symbols).order_by('id'):
+        assets.setdefault(asset.symbol, asset)  # Symbols are not unique, keep the first asset stored
+
+    cutoff = timezone.now() - timedelta(seconds=settings.PRICE_SCHEDULER['OPEN_MAX_AGE'])
+    to_fetch = [
+        symbol for symbol in symbols
+        if symbol not in assets or assets[symbol].latest_price is None or assets[symbol].updated_at < cutoff
+    ]
+    if not to_fetch:
+        return assets, {}
+
+    asset_data, failures = api.get_asset_data_with_failures(to_fetch)
+    now = timezone.now()
+    updated = []
+    created = []
+    errors = {}
+    for symbol in to_fetch:
+        data = asset_data.get(symbol)
+        if data is None:
+            if symbol not in assets:
+                errors[symbol] = failures.get(symbol, 'No data returned')
+            logger.error(f"No data returned for symbol: {symbol}")
+            continue
+        asset = assets.get(symbol) or Asset(symbol=symbol, name='Unknown', asset_type='Unknown')
+        apply_asset_data(asset, data)
+        asset.updated_at = now  # bulk_update does not apply auto_now
+        (updated if asset.pk else created).append(asset)
+        assets[symbol] = asset
+
+    with transaction.atomic():
+        Asset.objects.bulk_update(updated, ASSET_UPDATE_FIELDS)
+        Asset.objects.bulk_create(created)
+    if updated or created:
+        versions.bump_price_epoch()  # Bulk writes send no signals
+    logger.info(f"Resolved {len(symbols)} symbols: fetched {len(to_fetch)}, created {len(created)}, failed {len(errors)}")
+    return assets, errors
 
-    # Get all asset symbols
-    symbols = list(assets.values_list('symbol', flat=True))
 
-    # Fetch data for all symbols in one API call
-    asset_data = api.get_asset_data(symbols)
+def update_asset_chunk(assets):
+    """Fetch data for a chunk of assets and write them back in a single bulk update"""
+    asset_data = api.get_asset_data([asset.symbol for asset in assets])
+    now = timezone.now()
+    updated = []
+    failed_count = 0
 
     for asset in assets:
-        if asset.symbol in asset_data:
-            data = asset_data[asset.symbol]
-            try:
-                asset.latest_price = data.get('latest_price')
-                asset.name = data.get('name') or data.get('long_name', asset.name)
-                asset.asset_type = data.get('asset_type', asset.asset_type)
-                asset.currency = data.get('currency', asset.currency)
-                asset.timezone_full_name = data.get('timezone_full_name', asset.timezone_full_name)
-                asset.timezone_short_name = data.get('timezone_short_name', asset.timezone_short_name)
-                asset.save()
-                updated_count += 1
-                logger.info(f"Updated asset: {asset.name} ({asset.symbol})")
-            except Exception as e:
-                failed_count += 1
-                logger.error(f"Error updating asset {asset.symbol}: {e}")
-        else:
+        data = asset_data.get(asset.symbol)
+        if data is None:
             failed_count += 1
             logger.error(f"No data returned for symbol: {asset.symbol}")
+            continue
+        try:
+            apply_asset_data(asset, data)
+            asset.updated_at = now  # bulk_update does not apply auto_now
+            updated.append(asset)
+        except Exception as e:
+            failed_count += 1
+            logger.error(f"Error updating asset {asset.symbol}: {e}")
+
+    with transaction.atomic():
+        Asset.objects.bulk_update(updated, ASSET_UPDATE_FIELDS)
+    if updated:
+        versions.bump_price_epoch()  # bulk_update sends no signals
+    logger.info(f"Updated {len(updated)} assets: {', '.join(asset.symbol for asset in updated)}")
+    return len(updated), failed_count
+
+
+def update_assets(assets, chunk_size=None, progress=None, shard=None):
+    """
+    Update the given assets chunk by chunk, one fetch and one bulk update per chunk.
+    When an (index, count) shard is given only the assets whose symbol hashes into it are updated.
+    The optional progress callback receives (processed, total, updated, failed) after each chunk.
+    """
+    chunk_size = chunk_size or settings.ASSET_UPDATE_CHUNK_SIZE
+    if shard:
+        total = sum(1 for symbol in assets.values_list('symbol', flat=True).iterator() if sharding.symbol_in_shard(symbol, shard))
+        page_size = chunk_size * shard[1]  # Pages hold about one chunk of the shard's assets
+    else:
+        total = assets.count()
+        page_size = chunk_size
+    processed = 0
+    updated_count = 0
+    failed_count = 0
+    last_id = 0
+
+    # Page through the assets by id so only one chunk is held in memory at a time
+    while True:
+        page = list(assets.filter(id__gt=last_id).order_by('id')[:page_size])
+        if not page:
+            break
+        last_id = page[-1].id
+        chunk = [asset for asset in page if sharding.symbol_in_shard(asset.symbol, shard)] if shard else page
+        if not chunk:
+            continue
+
+        try:
+            chunk_updated, chunk_failed = update_asset_chunk(chunk)
+        except Exception as e:
+            chunk_updated, chunk_failed = 0, len(chunk)
+            logger.error(f"Error updating asset chunk ending at id {last_id}: {e}")
+
+        processed += len(chunk)
+        updated_count += chunk_updated
+        failed_count += chunk_failed
+        if progress:
+            progress(processed, total, updated_count, failed_count)
+
+    return updated_count, failed_count
+
 
-    return updated_count, failed_count
\ No newline at end of file
+def update_all_assets(chunk_size=None, progress=None, shard=None):
+    """Update the latest price for all existing assets in the database, or for one shard of them"""
+    return update_assets(Asset.objects.all(), chunk_size=chunk_size, progress=progress, shard=shard)
@@ -0,0 +1,111 @@
+import logging
+from decimal import Decimal
+from typing import Dict
+import numpy as np
+from django.db.models import F, BigIntegerField
+from django.db.models.functions import Cast, Round
+from .models import PortfolioAsset
+from . import fx
+from . import money
+
+# This file contains the vectorized valuation engine
+# Holdings are loaded as columnar NumPy arrays of fixed-point units and valued with a currency matrix,
+# values are converted back to Decimal only when returned (see money.py for the rounding rules)
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+HOLDING_FIELDS = (
+    'portfolio_id',
+    'portfolio__user_id',
+    'asset_id',
+    'position',
+    'price_units',
+    'asset__currency',
+    'portfolio__currency',
+    'portfolio__user__default_currency',
+)
+
+# Scale prices to fixed-point units in the database so rows arrive as plain integers
+PRICE_UNITS = Cast(Round(F('asset__latest_price') * money.SCALE), BigIntegerField())
+
+
+def get_fx_matrix(currencies):
+    """
+    Build a matrix where matrix[i, j] converts an amount in currencies[i] into currencies[j].
+    Currencies without a rate get NaN rows and columns.
+    """
+    rates = fx.get_rates() or {}
+    base_rates = np.array([float(rates[c]) if c in rates else np.nan for c in currencies], dtype=np.float64)
+    matrix = base_rates[np.newaxis, :] / base_rates[:, np.newaxis]
+    np.fill_diagonal(matrix, 1.0)  # Same-currency conversions never need a rate
+    return matrix
+
+
+class Valuation:
+    """Values of a set of holdings in asset, portfolio and user currencies"""
+
+    def __init__(self, rows):
+        columns = list(zip(*rows)) if rows else [()] * len(HOLDING_FIELDS)
+        portfolio_ids, user_ids, asset_ids, positions, price_units, asset_currencies, portfolio_currencies, user_currencies = columns
+
+        self.size = len(portfolio_ids)
+        self.portfolio_ids = np.array(portfolio_ids, dtype=np.int64)
+        self.user_ids = np.array(user_ids, dtype=np.int64)
+        self.asset_ids = np.array(asset_ids, dtype=np.int64)
+        self.positions = np.array(positions, dtype=np.int64)
+        self.missing_prices = np.array([units is None for units in price_units], dtype=bool)
+        self.price_units = np.array([0 if units is None else units for units in price_units], dtype=np.int64)
+
+        # Encode currencies as indexes into one currency list shared by the FX matrix
+        self.currencies = sorted(set(asset_currencies) | set(portfolio_currencies) | set(user_currencies))
+        index = {currency: i for i, currency in enumerate(self.currencies)}
+        self.asset_currency_idx = np.array([index[c] for c in asset_currencies], dtype=np.int64)
+        self.portfolio_currency_idx = np.array([index[c] for c in portfolio_currencies], dtype=np.int64)
+        self.user_currency_idx = np.array([index[c] for c in user_currencies], dtype=np.int64)
+        self.fx_matrix = get_fx_matrix(self.currencies) if self.size else np.ones((0, 0))
+
+        # Whole positions times fixed-point prices stay exact in int64
+        self.local_units = self.positions * self.price_units
+        if self.missing_prices.any():
+            logger.warning(f"Skipping {int(self.missing_prices.sum())} holdings without a latest price")
+
+    @classmethod
+    def load(cls, queryset=None):
+        """Load holdings from a PortfolioAsset queryset in a single query"""
+        queryset = PortfolioAsset.objects.all() if queryset is None else queryset
+        return cls(list(queryset.annotate(price_units=PRICE_UNITS).values_list(*HOLDING_FIELDS)))
+
+    def holding_values(self, target='user'):
+        """
+        Return the value of every holding in its asset, portfolio or user currency as int64 units,
+        and a mask of the holdings that could not be valued
+        """
+        if target == 'asset':
+            return self.local_units, self.missing_prices
+        target_idx = self.portfolio_currency_idx if target == 'portfolio' else self.user_currency_idx
+        rates = self.fx_matrix[self.asset_currency_idx, target_idx]
+        missing_rates = np.isnan(rates)
+        if (missing_rates & ~self.missing_prices).any():
+            logger.error(f"Missing exchange rates for {int((missing_rates & ~self.missing_prices).sum())} holdings, skipping them")
+        values = money.convert_units_array(self.local_units, np.where(missing_rates, 0.0, rates))
+        return values, self.missing_prices | missing_rates
+
+    def group_sum(self, keys, values) -> Dict[int, Decimal]:
+        """Sum the valued holdings per key and return the totals as Decimals"""
+        units, missing = values
+        totals = money.sum_units(keys, np.where(missing, 0, units))
+        return {key: money.from_units(total) for key, total in totals.items()}
+
+    def portfolio_values(self) -> Dict[int, Decimal]:
+        """Total value of each portfolio in the portfolio currency"""
+        return self.group_sum(self.portfolio_ids, self.holding_values('portfolio'))
+
+    def user_values(self) -> Dict[int, Decimal]:
+        """Total value of each user's holdings in the user's default currency"""
+        return self.group_sum(self.user_ids, self.holding_values('user'))
+
+
+def get_user_valuation(user):
+    """Load a valuation of all the user's holdings"""
+    return Valuation.load(PortfolioAsset.objects.filter(portfolio__user=user))
@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.db.models import F
+from .models import CacheVersion
+
+# This file contains the cache version counters used to build cache keys
+# A per-user version changes whenever the user's data changes and a global price epoch
+# changes whenever prices or exchange rates change, so cached values never need deleting
+# The counters live in a table rather than the cache, so they are never culled or expired,
+# and every bump is an atomic in-database increment
+
+USER_VERSION_KEY = 'user_{user_id}_version'
+PRICE_EPOCH_KEY = 'price_epoch'
+BUMP_BATCH_SIZE = 1000  # Counters per insert and update statement
+
+
+def bump(name):
+    """Increment a version counter, creating it if it does not exist"""
+    if not CacheVersion.objects.filter(name=name).update(version=F('version') + 1):
+        bump_many([name])
+
+
+def bump_many(names):
+    """Increment many counters with one insert of the missing ones and one update per batch"""
+    names = list(names)
+    for start in range(0, len(names), BUMP_BATCH_SIZE):
+        batch = names[start:start + BUMP_BATCH_SIZE]
+        CacheVersion.objects.bulk_create([CacheVersion(name=name) for name in batch], ignore_conflicts=True)
+        CacheVersion.objects.filter(name__in=batch).update(version=F('version') + 1)
+
+
+def bump_user_version(user_id):
+    bump(USER_VERSION_KEY.format(user_id=user_id))
+
+
+def bump_user_versions(user_ids):
+    """Bump many user versions in two statements per thousand users, for bulk write paths"""
+    bump_many(USER_VERSION_KEY.format(user_id=user_id) for user_id in user_ids)
+
+
+def bump_price_epoch():
+    bump(PRICE_EPOCH_KEY)
+
+
+def get_versions(names):
+    return dict(CacheVersion.objects.filter(name__in=names).values_list('name', 'version'))
+
+
+def user_cache_key(user_id, name):
+    """Return a cache key for a per-user value that embeds the user version and the price epoch"""
+    user_version_key = USER_VERSION_KEY.format(user_id=user_id)
+    versions = get_versions([user_version_key, PRICE_EPOCH_KEY])
+    return f'user_{user_id}_{name}_v{versions.get(user_version_key, 0)}_e{versions.get(PRICE_EPOCH_KEY, 0)}'
+
+
+def get_cache_ttl():
+    """Versioned keys can be cached for a long time since changes move readers to new keys"""
+    return settings.VERSIONED_CACHE_TTL
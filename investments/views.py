@@ -1,21 +1,29 @@
 from django.shortcuts import render, redirect
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_http_methods
 from django.shortcuts import get_object_or_404
 from django.http import JsonResponse
 from django.contrib import messages
-from django.db.models import Sum, Count, F, FloatField, DecimalField, ExpressionWrapper, Prefetch, Case, When, Value, CharField
+from django.db.models import Sum, Count, F, FloatField, DecimalField, ExpressionWrapper, Prefetch
 from django.db.models.functions import TruncDate, Cast
 from django.core.serializers.json import DjangoJSONEncoder
-from django.core.cache import cache
-from .models import Asset, PortfolioAsset, Portfolio, TotalValueHistory
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import Asset, PortfolioAsset, Portfolio
 from .forms import PortfolioForm
-from .constants import TIMEZONE_TO_REGION
 from . import utils
-from . import api
+from . import search
+from .snapshot import get_holdings_snapshot
+from . import versions
+from . import caching
+from . import aggregates
+from . import history
+from . import jobs
+from . import responses
 import logging
 import json
-from decimal import Decimal, InvalidOperation
+from decimal import Decimal
 from datetime import date
 
 
@@ -37,202 +45,162 @@ class CustomJSONEncoder(json.JSONEncoder):
 @login_required
 def dashboard(request):
     user = request.user
-    top_assets = get_top_assets(user)
+    snapshot = get_holdings_snapshot(user)
     context = {
-        'total_value': get_total_value(user),
+        'total_value': get_total_value(user, snapshot),
         'portfolio_count': Portfolio.objects.filter(user=user).count(),
-        'top_assets': top_assets,
+        'top_assets': get_top_assets(user, snapshot),
     }
+    if settings.DASHBOARD_INLINE_PAYLOAD:
+        # Embed the widget data so the charts render without another request
+        context['dashboard_payload'] = get_dashboard_payload(user, snapshot)
     # print("Top assets in dashboard view:", top_assets)  # Debug print
     return render(request, 'investments/dashboard.html', context)
 
 
-def get_total_value(user):
-    cache_key = f'user_{user.id}_total_value'
-    total_value = cache.get(cache_key)
-    if total_value is None:
-        portfolio_assets = PortfolioAsset.objects.filter(portfolio__user=user).select_related('asset')
-        total_value = sum(
-            utils.convert_currency(
-                asset.position * asset.asset.latest_price,
-                asset.asset.currency,
-                user.default_currency
-            )
-            for asset in portfolio_assets
-        )
-        cache.set(cache_key, total_value, 300)  # Cache for 5 minutes
-    return total_value
-
-
-def get_top_assets(user):
-    cache_key = f'user_{user.id}_top_assets'
-    top_assets = cache.get(cache_key)
-    if top_assets is None:
-        portfolio_assets = PortfolioAsset.objects.filter(portfolio__user=user).select_related('asset')
-        asset_values = {}
-        for asset in portfolio_assets:
-            value = utils.convert_currency(
-                asset.position * asset.asset.latest_price,
-                asset.asset.currency,
-                user.default_currency
-            )
-            if asset.asset.symbol in asset_values:
-                asset_values[asset.asset.symbol]['total_value'] += value
-            else:
-                asset_values[asset.asset.symbol] = {
-                    'asset__symbol': asset.asset.symbol,
-                    'asset__name': asset.asset.name,
-                    'total_value': value
-                }
-        top_assets = sorted(asset_values.values(), key=lambda x: x['total_value'], reverse=True)[:5]
-        cache.set(cache_key, top_assets, 300)  # Cache for 5 minutes
-    
-    # Convert Decimal to float for JSON serialization
-    for asset in top_assets:
-        asset['total_value'] = float(asset['total_value'])
-    
-    return top_assets
+def get_total_value(user, snapshot=None):
+    snapshot = snapshot or get_holdings_snapshot(user)
+    return snapshot.total_value
 
 
-def value_history_data(request):
-    user = request.user
-    cache_key = f'user_{user.id}_value_history'
-    data = cache.get(cache_key)
-    if data is None:
-        history = TotalValueHistory.objects.filter(user=user).order_by('timestamp')
-        data = [
+def get_top_assets(user, snapshot=None):
+    snapshot = snapshot or get_holdings_snapshot(user)
+    # Convert Money to float for JSON serialization
+    return [
+        {
+            'asset__symbol': asset['symbol'],
+            'asset__name': asset['name'],
+            'total_value': float(asset['value'])
+        }
+        for asset in snapshot.top_assets()
+    ]
+
+
+def get_value_history(user, range_name='all', resolution='auto'):
+    """Return the user's cached value history chart points"""
+    def compute():
+        return [
             {
-                'timestamp': entry.timestamp,
-                'total_value': float(entry.total_value)  # Assuming total_value is already in user's default currency
+                'timestamp': timestamp,
+                'total_value': float(total_value)  # Assuming total_value is already in user's default currency
             }
-            for entry in history
+            for timestamp, total_value in history.get_history_points(user, range_name, resolution)
         ]
-        cache.set(cache_key, data, 3600)  # Cache for 1 hour
-    return JsonResponse(data, safe=False)
 
+    cache_key = versions.user_cache_key(user.id, f'value_history_{range_name}_{resolution}')
+    return caching.get_or_set(cache_key, compute, versions.get_cache_ttl())
 
-def geographic_distribution_data(request):
-    user = request.user
-    cache_key = f'user_{user.id}_geographic_distribution'
-    data = cache.get(cache_key)
 
-    if data is None:
-        try:
-            portfolio_assets = PortfolioAsset.objects.filter(portfolio__user=user).select_related('asset')
-            
-            geographic_distribution = {}
-            for portfolio_asset in portfolio_assets:
-                region = next((region for tz, region in TIMEZONE_TO_REGION.items() 
-                               if portfolio_asset.asset.timezone_full_name == tz), 'Other')
-                
-                asset_value = utils.convert_currency(
-                    portfolio_asset.position * portfolio_asset.asset.latest_price,
-                    portfolio_asset.asset.currency,
-                    user.default_currency
-                )
-                geographic_distribution[region] = geographic_distribution.get(region, Decimal(0)) + asset_value
-
-            data = [
-                {'region': region, 'total_value': float(value)}
-                for region, value in geographic_distribution.items()
-            ]
-            data.sort(key=lambda x: x['total_value'], reverse=True)
+def get_region_data(snapshot):
+    data = [
+        {'region': region, 'total_value': float(value)}
+        for region, value in snapshot.region_totals().items()
+    ]
+    data.sort(key=lambda x: x['total_value'], reverse=True)
+    return data
 
-            cache.set(cache_key, data, 3600)  # Cache for 1 hour
-            
-            logger.debug(f"Geographic distribution data for user {user.id}: {data}")
-        except Exception as e:
-            logger.error(f"Error calculating geographic distribution for user {user.id}: {str(e)}")
-            data = []
 
-    return JsonResponse(data, safe=False)
+def get_category_data(snapshot):
+    return [
+        {'category': category, 'total_value': float(total_value)}
+        for category, total_value in snapshot.category_totals().items()
+    ]
 
 
-def asset_types_data(request):
+def get_dashboard_payload(user, snapshot=None):
+    """Every dashboard widget's data, from one holdings snapshot"""
+    snapshot = snapshot or get_holdings_snapshot(user)
+    return {
+        'currency': user.default_currency,
+        'total_value': float(snapshot.total_value),
+        'top_assets': get_top_assets(user, snapshot),
+        'history': get_value_history(user),
+        'regions': get_region_data(snapshot),
+        'categories': get_category_data(snapshot),
+    }
+
+
+@login_required
+def dashboard_data(request):
     user = request.user
-    cache_key = f'user_{user.id}_asset_types'
-    data = cache.get(cache_key)
+    return responses.cached_json_response(
+        request, f'dashboard_{user.default_currency}', lambda: get_dashboard_payload(user)
+    )
 
-    if data is None:
-        try:
-            asset_types = PortfolioAsset.objects.filter(portfolio__user=user)\
-                .select_related('asset')\
-                .annotate(
-                    asset_value=ExpressionWrapper(
-                        F('position') * F('asset__latest_price'),
-                        output_field=DecimalField(max_digits=19, decimal_places=4)
-                    ),
-                    category=Case(
-                        When(asset__asset_type__in=['STOCK', 'EQUITY'], then=Value('Aggressive')),
-                        default=Value('Passive'),
-                        output_field=CharField()
-                    )
-                )\
-                .values('category', 'asset_value', 'asset__currency')
-
-            logger.debug(f"Raw asset types query result for user {user.id}: {list(asset_types)}")
-
-            processed_data = {'Aggressive': Decimal('0'), 'Passive': Decimal('0')}
-            for item in asset_types:
-                category = item['category']
-                asset_currency = item['asset__currency']
-                try:
-                    asset_value = Decimal(item['asset_value'] or 0)
-                    converted_value = utils.convert_currency(
-                        asset_value,
-                        asset_currency,
-                        user.default_currency
-                    )
-                    processed_data[category] += converted_value
-                except (InvalidOperation, TypeError) as e:
-                    logger.error(f"Error processing asset value for user {user.id}: {e}")
-                    logger.error(f"Problematic item: {item}")
-
-            data = [
-                {'category': category, 'total_value': float(total_value)}
-                for category, total_value in processed_data.items()
-            ]
 
-            logger.debug(f"Processed asset types data for user {user.id}: {data}")
+@login_required
+def value_history_data(request):
+    """
+    Return the value history points. With a since timestamp only the points at or after it are returned,
+    the client replaces its points from since onwards with them.
+    """
+    user = request.user
+    range_name = request.GET.get('range', 'all')
+    resolution = request.GET.get('resolution', 'auto')
+    if range_name not in history.RANGES or resolution not in history.RESOLUTIONS:
+        return JsonResponse({'error': 'Invalid range or resolution'}, status=400)
+    since = request.GET.get('since')
+    if since:
+        since = parse_datetime(since)
+        if since is None:
+            return JsonResponse({'error': 'Invalid since timestamp'}, status=400)
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+
+    # Validators follow the latest history entry, so a client polling with since gets a 304 until it changes
+    last_modified = history.get_last_modified(user)
+    if since:
+        # Filter the cached points rather than caching a body per since timestamp
+        data = [point for point in get_value_history(user, range_name, resolution) if point['timestamp'] >= since]
+        return responses.json_response(request, data, last_modified)
+
+    return responses.cached_json_response(
+        request, 'value_history', lambda: get_value_history(user, range_name, resolution), last_modified
+    )
 
-            cache.set(cache_key, data, 3600)  # Cache for 1 hour
-        except Exception as e:
-            logger.error(f"Error calculating asset types for user {user.id}: {str(e)}")
-            logger.exception("Full traceback:")
-            data = []
 
-    return JsonResponse(data, safe=False)
+@login_required
+def geographic_distribution_data(request):
+    user = request.user
+
+    def compute():
+        data = get_region_data(get_holdings_snapshot(user))
+        logger.debug(f"Geographic distribution data for user {user.id}: {data}")
+        return data
+
+    try:
+        return responses.cached_json_response(request, f'regions_{user.default_currency}', compute)
+    except Exception as e:
+        # Errors are not cached, the next request tries again
+        logger.error(f"Error calculating geographic distribution for user {user.id}: {str(e)}")
+        return JsonResponse([], safe=False, status=500)
 
 
-# List all portfolios
 @login_required
-def list_portfolios(request):
-    cache_key = f'user_{request.user.id}_portfolios'
-    portfolios = cache.get(cache_key)
+def asset_types_data(request):
+    user = request.user
 
-    if portfolios is None:
-        portfolios = list(Portfolio.objects.filter(user=request.user)
-            .prefetch_related('portfolio_assets__asset'))
-        
-        # Update portfolio information
-        for portfolio in portfolios:
-            portfolio.asset_count = portfolio.portfolio_assets.count()
-            portfolio.portfolio_value = utils.get_portfolio_value(portfolio)
+    def compute():
+        data = get_category_data(get_holdings_snapshot(user))
+        logger.debug(f"Processed asset types data for user {user.id}: {data}")
+        return data
 
-        cache.set(cache_key, portfolios, 300)  # Cache for 5 minutes
-    else:
-        # Refresh data for cached portfolios
-        for portfolio in portfolios:
-            try:
-                portfolio.refresh_from_db()
-                portfolio.asset_count = portfolio.portfolio_assets.count()
-                portfolio.portfolio_value = utils.get_portfolio_value(portfolio)
-            except Portfolio.DoesNotExist:
-                # Portfolio was deleted, so we don't include it
-                portfolios.remove(portfolio)
-
-        # Update the cache with refreshed data
-        cache.set(cache_key, portfolios, 300)
+    try:
+        return responses.cached_json_response(request, f'categories_{user.default_currency}', compute)
+    except Exception as e:
+        # Errors are not cached, the next request tries again
+        logger.error(f"Error calculating asset types for user {user.id}: {str(e)}")
+        logger.exception("Full traceback:")
+        return JsonResponse([], safe=False, status=500)
+
+
+# List all portfolios
+@login_required
+def list_portfolios(request):
+    user = request.user
+    cache_key = versions.user_cache_key(user.id, 'portfolio_summaries')
+    rows = caching.get_or_set(cache_key, lambda: aggregates.get_portfolio_summaries(user), versions.get_cache_ttl())
+    portfolios = [aggregates.PortfolioSummary(*row) for row in rows]
 
     return render(request, 'investments/portfolios.html', {'portfolios': portfolios})
 
@@ -246,9 +214,6 @@ def add_portfolio(request):
             portfolio = form.save(commit=False)
             portfolio.user = request.user
             portfolio.save()
-            # Invalidate the cache
-            cache_key = f'user_{request.user.id}_portfolios'
-            cache.delete(cache_key)
             messages.success(request, 'Portfolio created successfully.')
             return redirect('list_portfolios')
     else:
@@ -276,17 +241,15 @@ def portfolio_detail(request, portfolio_id):
         assets_to_update = data.get('assets', [])
 
         try:
-            for asset_data in assets_to_update:
-                portfolio_asset = portfolio_assets.get(id=asset_data['id'])
-                new_position = int(asset_data['position'])
-                portfolio_asset.position = new_position
-                portfolio_asset.save()
+            # Validate every row before writing any of them
+            edits = utils.parse_position_edits(assets_to_update)
+            updated_assets = utils.update_positions(portfolio, edits)
 
-            # Update the portfolio value, asset market value, and asset ratios
-            updates = utils.refresh_portfolio_data(portfolio)
+            # Update the portfolio value, asset market value, and asset ratios from the rows just written
+            updates = utils.refresh_portfolio_data(portfolio, updated_assets)
 
-            # Update the total value history
-            utils.update_total_value_history(request.user)
+            # Queue the total value history update so the response does not wait for it
+            jobs.enqueue_total_value_update(request.user.id)
             return JsonResponse({
                 'success': True,
                 'portfolio_value': updates['portfolio_value'],
@@ -305,6 +268,7 @@ def portfolio_detail(request, portfolio_id):
 
             # Refresh asset data after deletion
             updates = utils.refresh_portfolio_data(portfolio)
+            jobs.enqueue_total_value_update(request.user.id)
 
             return JsonResponse({
                 'success': True,
@@ -360,10 +324,6 @@ def delete_portfolio(request, portfolio_id):
     if request.method == 'POST':
         portfolio.delete()
         
-        # Invalidate the cache
-        cache_key = f'user_{request.user.id}_portfolios'
-        cache.delete(cache_key)
-        
         messages.success(request, 'Portfolio deleted successfully.')
         return redirect('list_portfolios')
     
@@ -396,8 +356,8 @@ def search_assets(request):
     if len(query) < 3:
         return JsonResponse({'results': []})
     
-    try:
-        results = api.search_assets(query)
+    def compute():
+        results, complete = search.search_with_status(query)
 
         if portfolio_id:
             # Get existing assets in the portfolio
@@ -410,7 +370,14 @@ def search_assets(request):
         if not results:
             results = [{'symbol': 'No results found', 'name': '', 'exists_in_portfolio': False}]
         
-        return JsonResponse({'results': results})
+        if not complete:
+            # The upstream search failed, so only serve these results until it recovers
+            raise responses.Uncacheable({'results': results})
+        return {'results': results}
+
+    try:
+        # Portfolio changes bump the user version, so cached results never show stale membership
+        return responses.cached_json_response(request, 'search_assets', compute)
     except Exception as e:
         print(f"Error in search_assets: {e}")  # Debug print
         logger.error(f"Error in search_assets view: {e}")
@@ -435,39 +402,44 @@ def add_assets(request, portfolio_id):
 
             added_assets = []
             existing_assets = []
+            failed_assets = []
 
-            for asset_data in assets:
-                symbol = asset_data.get('symbol')
-                quantity = asset_data.get('quantity')
-                
-                if not symbol or not quantity:
-                    continue
+            rows = [
+                (asset_data.get('symbol'), asset_data.get('quantity'))
+                for asset_data in assets
+                if asset_data.get('symbol') and asset_data.get('quantity')
+            ]
+            symbols = [symbol for symbol, _ in rows]
 
-                # Check if the asset already exists in the portfolio
-                existing_portfolio_asset = PortfolioAsset.objects.filter(portfolio=portfolio, asset__symbol=symbol).first()
+            # Check which assets already exist in the portfolio in one query
+            held = {
+                portfolio_asset.asset.symbol: portfolio_asset
+                for portfolio_asset in PortfolioAsset.objects.filter(portfolio=portfolio, asset__symbol__in=symbols)
+                .select_related('asset')
+            }
 
-                if existing_portfolio_asset:
+            # Create or update the other assets with one upstream request
+            resolved, failures = utils.resolve_assets([symbol for symbol in symbols if symbol not in held])
+
+            new_portfolio_assets = []
+            for symbol, quantity in rows:
+                if symbol in held:
                     existing_assets.append({
                         'symbol': symbol,
-                        'name': existing_portfolio_asset.asset.name,
-                        'current_quantity': existing_portfolio_asset.position
+                        'name': held[symbol].asset.name,
+                        'current_quantity': held[symbol].position
                     })
                     continue
 
-                # Create or update the asset
-                asset = utils.create_asset(symbol)
-                # print(asset)
+                asset = resolved.get(symbol)
                 if not asset:
                     logger.warning(f"Failed to create asset for symbol: {symbol}")
+                    failed_assets.append({'symbol': symbol, 'error': failures.get(symbol, 'Unknown error')})
                     continue
 
-                # Add the asset to the portfolio
-                portfolio_asset = PortfolioAsset.objects.create(
-                    portfolio=portfolio,
-                    asset=asset,
-                    position=quantity
-                )
-
+                portfolio_asset = PortfolioAsset(portfolio=portfolio, asset=asset, position=quantity)
+                new_portfolio_assets.append(portfolio_asset)
+                held[symbol] = portfolio_asset  # A repeated symbol counts as existing, as it did when added one by one
                 added_assets.append({
                     'symbol': symbol,
                     'name': asset.name,
@@ -475,16 +447,22 @@ def add_assets(request, portfolio_id):
                 })
                 logger.info(f"Added asset to portfolio: {symbol}")
 
+            # Add the assets to the portfolio
+            PortfolioAsset.objects.bulk_create(new_portfolio_assets)
+            if new_portfolio_assets:
+                versions.bump_user_version(request.user.id)  # bulk_create sends no signals
+
             logger.info(f"Successfully processed assets. Added: {len(added_assets)}, Already existing: {len(existing_assets)}")
 
-            # Update the total value history
-            utils.update_total_value_history(request.user)
+            # Queue the total value history update so the response does not wait for it
+            jobs.enqueue_total_value_update(request.user.id)
 
             return JsonResponse({
                 'success': True, 
                 'message': 'Assets processed successfully',
                 'added_assets': added_assets,
-                'existing_assets': existing_assets
+                'existing_assets': existing_assets,
+                'failed_assets': failed_assets
             })
         
         except json.JSONDecodeError: